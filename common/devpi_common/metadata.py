@@ -1,10 +1,15 @@
 import posixpath
 import re
 import py
-from pkg_resources import parse_version, Requirement
+from pkg_resources import parse_version as _parse_version
+from pkg_resources import Requirement
 from .types import CompareMixin
 from .types import cached_property
 from .validation import normalize_name
+try:
+    from functools import lru_cache
+except ImportError:  # Python 2
+    lru_cache = None
 
 
 ALLOWED_ARCHIVE_EXTS = set(
@@ -59,6 +64,32 @@ _legacy_nameversion_re = re.compile(
     r")$")
 
 
+PARSE_VERSION_CACHE_SIZE = 10000
+
+
+def parse_version(version):
+    """ memoizing wrapper around ``pkg_resources.parse_version``.
+
+    The parsed versions are immutable, so they can be shared.  The least
+    recently used of more than ``PARSE_VERSION_CACHE_SIZE`` versions are
+    evicted.  On Python 2 nothing is memoized. """
+    return _parse_version(version)
+
+
+if lru_cache is not None:
+    parse_version = lru_cache(maxsize=PARSE_VERSION_CACHE_SIZE)(parse_version)
+
+
+def is_prerelease(parsed_version):
+    if hasattr(parsed_version, 'is_prerelease'):
+        return parsed_version.is_prerelease
+    # backward compatibility
+    for x in parsed_version:
+        if x.startswith('*') and x < '*final':
+            return True
+    return False
+
+
 def get_pyversion_filetype(basename):
     _,_,suffix = splitbasename(basename)
     if suffix in (".zip", ".tar.gz", ".tgz", "tar.bz2"):
@@ -140,13 +171,7 @@ class Version(CompareMixin):
         return "Version(%r)" % self.string
 
     def is_prerelease(self):
-        if hasattr(self.cmpval, 'is_prerelease'):
-            return self.cmpval.is_prerelease
-        # backward compatibility
-        for x in self.cmpval:
-            if x.startswith('*') and x < '*final':
-                return True
-        return False
+        return is_prerelease(self.cmpval)
 
 
 class BasenameMeta(CompareMixin):
@@ -179,19 +204,20 @@ def sorted_sameproject_links(links):
 def get_latest_version(seq, stable=False):
     if not seq:
         return
-    versions = map(Version, seq)
+    versions = seq
     if stable:
-        versions = [x for x in versions if not x.is_prerelease()]
+        versions = [
+            x for x in versions if not is_prerelease(parse_version(x))]
         if not versions:
             return
-    return max(versions).string
+    return max(versions, key=parse_version)
 
 
 def get_sorted_versions(versions, reverse=True, stable=False):
-    versions = sorted(map(Version, versions), reverse=reverse)
+    versions = sorted(versions, key=parse_version, reverse=reverse)
     if stable:
-        versions = [x for x in versions if not x.is_prerelease()]
-    return [x.string for x in versions]
+        versions = [x for x in versions if not is_prerelease(parse_version(x))]
+    return versions
 
 
 def is_archive_of_project(basename, targetname):
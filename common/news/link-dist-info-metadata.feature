@@ -0,0 +1 @@
+Links parsed from simple pages now provide the value of the PEP 658 ``data-dist-info-metadata`` or PEP 714 ``data-core-metadata`` attribute as ``dist_info_metadata``.
@@ -0,0 +1 @@
+``parse_version`` in ``devpi_common.metadata`` now memoizes parsed versions in a bounded cache, and ``get_sorted_versions`` and ``get_latest_version`` sort with it directly instead of wrapping each version in a ``Version`` object.
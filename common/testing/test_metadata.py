@@ -2,6 +2,8 @@ from devpi_common.metadata import BasenameMeta
 from devpi_common.metadata import Version
 from devpi_common.metadata import get_pyversion_filetype
 from devpi_common.metadata import get_latest_version
+from devpi_common.metadata import get_sorted_versions
+from devpi_common.metadata import parse_version
 from devpi_common.metadata import parse_requirement
 from devpi_common.metadata import sorted_sameproject_links
 from devpi_common.metadata import splitbasename
@@ -106,6 +108,29 @@ def test_version():
     assert max([ver1, ver2]) == ver2
 
 
+def test_get_sorted_versions():
+    versions = ["1.0", "1.10", "1.2rc1", "1.2", "0.9"]
+    assert get_sorted_versions(versions) == [
+        "1.10", "1.2", "1.2rc1", "1.0", "0.9"]
+    assert get_sorted_versions(versions, reverse=False) == [
+        "0.9", "1.0", "1.2rc1", "1.2", "1.10"]
+    assert get_sorted_versions(versions, stable=True) == [
+        "1.10", "1.2", "1.0", "0.9"]
+
+
+@pytest.mark.skipif(
+    not hasattr(parse_version, "cache_info"), reason="no lru_cache")
+def test_parse_version_memo():
+    from devpi_common.metadata import PARSE_VERSION_CACHE_SIZE
+    parse_version.cache_clear()
+    assert parse_version("1.0") is parse_version("1.0")
+    assert parse_version("1.0") < parse_version("1.1")
+    info = parse_version.cache_info()
+    assert info.currsize == 2
+    # the memo is bounded
+    assert info.maxsize == PARSE_VERSION_CACHE_SIZE
+
+
 class TestBasenameMeta:
     def test_doczip(self):
         meta1 = BasenameMeta("x-1.0.doc.zip")
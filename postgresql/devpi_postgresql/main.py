@@ -1,5 +1,6 @@
 from devpi_common.types import cached_property
 from devpi_server.fileutil import dumps, loads
+from devpi_server.keyfs_delta import encode_value, resolve_changes
 from devpi_server.log import threadlog, thread_push_log, thread_pop_log
 from devpi_server.readonly import ReadonlyView
 from devpi_server.readonly import ensure_deeply_readonly, get_mutable_deepcopy
@@ -151,6 +152,7 @@ class Connection:
         if changes is None:
             data = self.get_raw_changelog_entry(serial)
             changes, rel_renames = loads(data)
+            changes = resolve_changes(self, changes)
             # make values in changes read only so no calling site accidentally
             # modifies data
             changes = ensure_deeply_readonly(changes)
@@ -300,6 +302,7 @@ class Writer:
         # at __exit__ time we write out changes to the _changelog_cache
         # so we protect here against the caller modifying the value later
         value = get_mutable_deepcopy(value)
+        value = encode_value(self.conn, typedkey.relpath, back_serial, value)
         self.changes[typedkey.relpath] = (typedkey.name, back_serial, value)
 
     def __enter__(self):
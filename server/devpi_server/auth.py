@@ -1,12 +1,14 @@
 from __future__ import unicode_literals
 import base64
 import hashlib
+import hmac
 import itsdangerous
 import py
 import secrets
 from .log import threadlog
 from passlib.context import CryptContext
 from passlib.utils.handlers import MinimalHandler
+from repoze.lru import ExpiringLRUCache
 
 
 notset = object()
@@ -16,6 +18,34 @@ class AuthException(Exception):
     """ Raised by external plugins in case of an error. """
 
 
+class CredentialsCache:
+    """ Bounded cache of successful password validations.
+
+    Entries are keyed by a keyed hash of the username, the stored password
+    hash and the password, so no passwords are kept in memory and changing
+    the password invalidates the entry.  Entries expire after ``ttl``
+    seconds, a ``ttl`` of 0 disables the cache. """
+
+    def __init__(self, ttl, size=1000):
+        self.ttl = ttl
+        self._secret = secrets.token_bytes(32)
+        self._entries = ExpiringLRUCache(size, default_timeout=ttl)
+
+    def _key(self, username, password, pwhash):
+        msg = "\0".join((username, pwhash, password)).encode("utf-8")
+        return hmac.new(self._secret, msg, hashlib.sha256).digest()
+
+    def is_valid(self, username, password, pwhash):
+        if not self.ttl:
+            return False
+        key = self._key(username, password, pwhash)
+        return self._entries.get(key, False)
+
+    def add(self, username, password, pwhash):
+        if self.ttl:
+            self._entries.put(self._key(username, password, pwhash), True)
+
+
 class Auth:
     LOGIN_EXPIRATION = 60 * 60 * 10  # 10 hours
 
@@ -27,6 +57,7 @@ class Auth:
         self.serializer = itsdangerous.TimedSerializer(secret)
         self.hook = self.model.xom.config.hook.devpiserver_auth_request
         self.legacy_hook = self.model.xom.config.hook.devpiserver_auth_user
+        self.credentials_cache = self.model.xom.credentials_cache
 
     def _legacy_auth(self, authuser, authpassword, is_root, user):
         results = []
@@ -90,15 +121,29 @@ class Auth:
         # first get a potentially cached value
         result = getattr(request, '__devpiserver_user_validate_result', notset)
         if result is notset:
-            result = user.validate(authpassword)
-            # cache result on request if available
-            if request is not None:
+            if request is None:
+                result = user.validate(authpassword)
+            else:
+                result = self._validate_cached(user, authuser, authpassword)
+                # cache result on request
                 # we have to use setattr to avoid name mangling of prefix dunder
                 setattr(request, '__devpiserver_user_validate_result', result)
         if result:
             return dict(status="ok", from_user_object=True)
         return dict(status="reject")
 
+    def _validate_cached(self, user, authuser, authpassword):
+        # the stored password hash is part of the key,
+        # so changing the password invalidates the entry
+        userconfig = user.key.get()
+        pwhash = "%s:%s" % (userconfig.get("pwsalt"), userconfig.get("pwhash"))
+        if self.credentials_cache.is_valid(authuser, authpassword, pwhash):
+            return True
+        result = user.validate(authpassword)
+        if result:
+            self.credentials_cache.add(authuser, authpassword, pwhash)
+        return result
+
     def _get_auth_status(self, authuser, authpassword, request=None):
         try:
             val = self.serializer.loads(authpassword, max_age=self.LOGIN_EXPIRATION)
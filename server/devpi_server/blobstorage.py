@@ -0,0 +1,337 @@
+"""
+Storage of the content of release files in a blob store.
+
+By default the keyfs storage backend keeps the files itself, either on
+the file system or inside the database. With ``--blob-storage`` the
+content goes to a separate blob store selected via the
+``devpiserver_blob_storage_backend`` hook instead, while the storage
+backend only keeps the database. Files are deleted from the blob store
+when they are deleted in the database, so each server needs a blob store
+of its own.
+
+Files written during a transaction are spooled to local temporary files
+and uploaded in parallel before the database commit, so the database
+never references missing content. Other write transactions wait until
+the uploads are done. Deleted files are removed from the blob store
+after the commit.
+"""
+from .config import hookimpl
+from .fileutil import rename
+from .log import threadlog
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import contextlib
+import os
+import shutil
+import sys
+import tempfile
+import uuid
+
+
+class BlobStore(object):
+    """ Base class for blob stores.
+
+    Subclasses implement ``exists``, ``size``, ``open``, ``delete`` and
+    ``os_path`` as well as ``put_single`` and the ``multipart_*`` methods
+    used by ``put`` to upload files in one piece or in parts. """
+
+    # files larger than this are uploaded in parts
+    multipart_threshold = 64 * 1024 * 1024
+    part_size = 16 * 1024 * 1024
+    # number of parallel uploads of files and of the parts of a file
+    max_workers = 4
+
+    def os_path(self, path):
+        """ return the local path of the blob if there is one, which can
+        then be served directly by the web server. """
+        return None
+
+    def put(self, path, f, size):
+        """ store the content of the file object ``f`` with the given size
+        at path, reading it in parts for large files. """
+        if size <= self.multipart_threshold:
+            return self.put_single(path, f)
+        upload = self.multipart_start(path)
+        try:
+            parts = self._put_parts(upload, f)
+        except BaseException:
+            self.multipart_abort(upload)
+            raise
+        self.multipart_complete(upload, parts)
+
+    def _put_parts(self, upload, f):
+        parts = []
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            number = 0
+            while 1:
+                data = f.read(self.part_size)
+                if not data:
+                    break
+                number += 1
+                pending.append(executor.submit(
+                    self.multipart_put, upload, number, data))
+                # bound the number of parts kept in memory
+                if len(pending) >= self.max_workers:
+                    parts.append(pending.popleft().result())
+            while pending:
+                parts.append(pending.popleft().result())
+        return parts
+
+
+class FSBlobStore(BlobStore):
+    """ Blob store with the blobs as files below a directory.
+
+    This is the stand-in for object storages in tests and can be used
+    with a directory on another mount. """
+
+    def __init__(self, basedir, path=None):
+        if path is None:
+            path = os.path.join(str(basedir), "+blobstore")
+        self.path = str(path)
+
+    def os_path(self, path):
+        return os.path.join(self.path, path)
+
+    def exists(self, path):
+        return os.path.exists(self.os_path(path))
+
+    def size(self, path):
+        try:
+            return os.path.getsize(self.os_path(path))
+        except OSError:
+            return None
+
+    def open(self, path):
+        return open(self.os_path(path), "rb")
+
+    def delete(self, path):
+        try:
+            os.remove(self.os_path(path))
+        except OSError:
+            pass
+
+    def _tmppath(self, path):
+        tmppath = "%s-%s-tmp" % (self.os_path(path), uuid.uuid4().hex)
+        dirname = os.path.dirname(tmppath)
+        if not os.path.exists(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # another thread might have created it in the meantime
+                if not os.path.isdir(dirname):
+                    raise
+        return tmppath
+
+    def put_single(self, path, f):
+        tmppath = self._tmppath(path)
+        with open(tmppath, "wb") as out:
+            shutil.copyfileobj(f, out)
+        rename(tmppath, self.os_path(path))
+
+    def multipart_start(self, path):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        return (path, tempfile.mkdtemp(prefix=".multipart-", dir=self.path))
+
+    def multipart_put(self, upload, number, data):
+        (path, partsdir) = upload
+        with open(os.path.join(partsdir, "%08d" % number), "wb") as f:
+            f.write(data)
+        return (number, len(data))
+
+    def multipart_complete(self, upload, parts):
+        (path, partsdir) = upload
+        tmppath = self._tmppath(path)
+        with open(tmppath, "wb") as out:
+            for number, size in sorted(parts):
+                with open(os.path.join(partsdir, "%08d" % number), "rb") as f:
+                    shutil.copyfileobj(f, out)
+        rename(tmppath, self.os_path(path))
+        shutil.rmtree(partsdir)
+
+    def multipart_abort(self, upload):
+        (path, partsdir) = upload
+        shutil.rmtree(partsdir, ignore_errors=True)
+
+
+@hookimpl
+def devpiserver_blob_storage_backend(settings):
+    blob_storage = FSBlobStore
+    if settings and settings.get("path"):
+        blob_storage = partial(
+            FSBlobStore, path=os.path.expanduser(settings["path"]))
+    return dict(
+        storage=blob_storage,
+        name="fs",
+        description="Files in a directory, by default '+blobstore' in the "
+                    "server directory. Use the path setting for another "
+                    "location, like a network mount")
+
+
+class BlobStorage(object):
+    """ Wraps a keyfs storage, so the content of files is kept in a blob
+    store instead. """
+
+    # the files are not kept by the wrapped storage, so its tiers are unused
+    tiers = None
+
+    def __init__(self, storage, blobstore):
+        self.storage = storage
+        self.blobstore = blobstore
+        self.spooldir = storage.basedir.join("+blobspool")
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    def get_connection(self, closing=True, write=False):
+        conn = BlobConnection(
+            self.storage.get_connection(closing=False, write=write), self)
+        if closing:
+            return contextlib.closing(conn)
+        return conn
+
+
+class BlobConnection(object):
+    def __init__(self, conn, storage):
+        self._conn = conn
+        self.storage = storage
+        self.blobstore = storage.blobstore
+        # maps the path to the spooled file or None for deleted files
+        self.dirty_files = {}
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def _spool(self, content):
+        spooldir = self.storage.spooldir.ensure(dir=1)
+        (fd, tmppath) = tempfile.mkstemp(dir=str(spooldir))
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        return tmppath
+
+    def _drop_dirty_files(self):
+        for tmppath in self.dirty_files.values():
+            if tmppath is not None:
+                os.remove(tmppath)
+        self.dirty_files.clear()
+
+    def _put_file(self, path, tmppath):
+        with open(tmppath, "rb") as f:
+            self.blobstore.put(path, f, os.path.getsize(tmppath))
+
+    def put_dirty_files(self):
+        """ upload spooled files to the blob store in parallel and return
+        the paths of deleted files. """
+        dirty_files = self.dirty_files
+        uploads = [
+            (path, tmppath) for path, tmppath in dirty_files.items()
+            if tmppath is not None]
+        if uploads:
+            with ThreadPoolExecutor(max_workers=self.blobstore.max_workers) as executor:
+                futures = [
+                    executor.submit(self._put_file, path, tmppath)
+                    for path, tmppath in uploads]
+                for future in futures:
+                    future.result()
+            threadlog.debug(
+                "uploaded to blob storage: %s",
+                ",".join(path for path, tmppath in uploads))
+        deleted = [
+            path for path, tmppath in dirty_files.items()
+            if tmppath is None]
+        self._drop_dirty_files()
+        return deleted
+
+    def delete_files(self, paths):
+        for path in paths:
+            self.blobstore.delete(path)
+
+    def close(self):
+        self._drop_dirty_files()
+        self._conn.close()
+
+    def rollback(self):
+        self._drop_dirty_files()
+        self._conn.rollback()
+
+    def io_file_os_path(self, path):
+        if path in self.dirty_files:
+            raise RuntimeError("Can't access file %s directly during transaction" % path)
+        return self.blobstore.os_path(path)
+
+    def io_file_stored_path(self, path):
+        return self.io_file_os_path(path)
+
+    def io_file_exists(self, path):
+        if path in self.dirty_files:
+            return self.dirty_files[path] is not None
+        return self.blobstore.exists(path)
+
+    def io_file_set(self, path, content):
+        old = self.dirty_files.get(path)
+        if old is not None:
+            os.remove(old)
+        self.dirty_files[path] = self._spool(content)
+
+    def io_file_open(self, path):
+        if path in self.dirty_files:
+            tmppath = self.dirty_files[path]
+            if tmppath is None:
+                raise IOError()
+            return open(tmppath, "rb")
+        return self.blobstore.open(path)
+
+    def io_file_get(self, path):
+        with self.io_file_open(path) as f:
+            return f.read()
+
+    def io_file_size(self, path):
+        if path in self.dirty_files:
+            tmppath = self.dirty_files[path]
+            if tmppath is None:
+                return None
+            return os.path.getsize(tmppath)
+        return self.blobstore.size(path)
+
+    def io_file_delete(self, path):
+        old = self.dirty_files.get(path)
+        if old is not None:
+            os.remove(old)
+        self.dirty_files[path] = None
+
+    def write_transaction(self):
+        return BlobWriter(self, self._conn.write_transaction())
+
+    def commit_files_without_increasing_serial(self):
+        deleted = self.put_dirty_files()
+        self._conn.commit_files_without_increasing_serial()
+        self.delete_files(deleted)
+
+
+class BlobWriter(object):
+    def __init__(self, conn, writer):
+        self.conn = conn
+        self._writer = writer
+
+    def __getattr__(self, name):
+        return getattr(self._writer, name)
+
+    def __enter__(self):
+        self._writer.__enter__()
+        return self
+
+    def __exit__(self, cls, val, tb):
+        deleted = []
+        if cls is None:
+            try:
+                deleted = self.conn.put_dirty_files()
+            except BaseException:
+                self._writer.__exit__(*sys.exc_info())
+                raise
+        else:
+            self.conn._drop_dirty_files()
+        result = self._writer.__exit__(cls, val, tb)
+        self.conn.delete_files(deleted)
+        return result
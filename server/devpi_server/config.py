@@ -32,6 +32,7 @@ DEFAULT_FILE_REPLICATION_THREADS = 5
 DEFAULT_ARGON2_MEMORY_COST = 524288
 DEFAULT_ARGON2_PARALLELISM = 8
 DEFAULT_ARGON2_TIME_COST = 16
+DEFAULT_CREDENTIALS_CACHE_TTL = 60
 
 
 def get_pluginmanager(load_entrypoints=True):
@@ -163,6 +164,17 @@ def add_web_options(parser, pluginmanager):
         help="use absolute URLs everywhere. "
              "This will become the default at some point.")
 
+    parser.addoption(
+        "--sendfile-header", type=str, metavar="NAME",
+        choices=["x-accel-redirect", "x-sendfile"], default=None,
+        help="let the web server in front of devpi-server send release "
+             "files after devpi-server checked the permissions. "
+             "With 'x-accel-redirect' nginx needs an internal location "
+             "for '/+files/' with the serverdir as root, "
+             "'x-sendfile' passes the full path of the file. "
+             "Only works if files are stored in the file system "
+             "and not used with a 'cold_dir' for the storage.")
+
     parser.addoption(
         "--profile-requests", type=int, metavar="NUM", default=0,
         help="profile NUM requests and print out cumulative stats. "
@@ -245,6 +257,17 @@ def add_storage_options(parser, pluginmanager):
         help="the storage backend to use.\n" + ", ".join(
              '"%s": %s' % (x['name'], x['description']) for x in backends))
 
+    blob_backends = sorted(
+        pluginmanager.hook.devpiserver_blob_storage_backend(settings=None),
+        key=itemgetter("name"))
+    parser.addoption(
+        "--blob-storage", type=str, metavar="NAME",
+        action="store",
+        help="keep the content of release files in the given blob "
+             "storage instead of the storage backend. Settings are "
+             "passed like for --storage.\n" + ", ".join(
+                 '"%s": %s' % (x['name'], x['description']) for x in blob_backends))
+
     parser.addoption(
         "--keyfs-cache-size", type=int, metavar="NUM",
         action="store", default=10000,
@@ -253,6 +276,33 @@ def add_storage_options(parser, pluginmanager):
              "improve performance. Each entry uses 1kb of memory on "
              "average. So by default about 10MB are used.")
 
+    parser.addoption(
+        "--file-dedup", action="store_true",
+        help="store files with the same content only once on disk, "
+             "for example when a release is pushed to other indexes "
+             "or mirrored by several mirror indexes. The files of all "
+             "entries with the same content are hard links to each "
+             "other. All limitations for hard links on your OS apply. "
+             "A replica can only link files with the same content if "
+             "the master uses this option as well.")
+
+
+def parse_backend_option(value):
+    """ return name and settings from a backend option value like
+    ``name:key=value,key=value``, or a dict with a name key. """
+    if isinstance(value, dict):
+        # a yaml config may return a dict
+        settings = dict(value)
+        name = settings.pop('name')
+    else:
+        name, sep, setting_str = value.partition(':')
+        settings = {}
+        if setting_str:
+            for item in setting_str.split(','):
+                key, value = item.split('=', 1)
+                settings[key] = value
+    return name, settings
+
 
 def add_init_options(parser, pluginmanager):
     parser.addoption(
@@ -349,6 +399,14 @@ def add_permission_options(parser, pluginmanager):
              "and modify users and indices. You have to add root "
              "explicitely if wanted.")
 
+    parser.addoption(
+        "--credentials-cache-ttl", type=int, metavar="SECONDS",
+        default=DEFAULT_CREDENTIALS_CACHE_TTL,
+        help="number of seconds a successful validation of a user "
+             "password is remembered, so clients sending the password "
+             "with each request don't need a full password hash "
+             "verification every time. Use 0 to disable.")
+
 
 def addoptions(parser, pluginmanager):
     add_help_option(parser, pluginmanager)
@@ -732,6 +790,10 @@ class Config(object):
     def hard_links(self):
         return getattr(self.args, 'hard_links', False)
 
+    @property
+    def file_dedup(self):
+        return getattr(self.args, 'file_dedup', False)
+
     @property
     def replica_cert(self):
         return getattr(self.args, 'replica_cert', None)
@@ -748,6 +810,15 @@ class Config(object):
     def requests_only(self):
         return getattr(self.args, 'requests_only', False)
 
+    @property
+    def sendfile_header(self):
+        return getattr(self.args, 'sendfile_header', None)
+
+    @property
+    def credentials_cache_ttl(self):
+        return getattr(
+            self.args, 'credentials_cache_ttl', DEFAULT_CREDENTIALS_CACHE_TTL)
+
     @property
     def request_timeout(self):
         return getattr(self.args, 'request_timeout', DEFAULT_REQUEST_TIMEOUT)
@@ -843,17 +914,7 @@ class Config(object):
 
     def _determine_storage(self):
         if self.args.storage:
-            if isinstance(self.args.storage, dict):
-                # a yaml config may return a dict
-                settings = dict(self.args.storage)
-                name = settings.pop('name')
-            else:
-                name, sep, setting_str = self.args.storage.partition(':')
-                settings = {}
-                if setting_str:
-                    for item in setting_str.split(','):
-                        key, value = item.split('=', 1)
-                        settings[key] = value
+            name, settings = parse_backend_option(self.args.storage)
         else:
             name = "sqlite"
             settings = {}
@@ -862,6 +923,19 @@ class Config(object):
             name=storage_info['name'],
             settings=settings)
 
+    @cached_property
+    def blob_storage(self):
+        from .main import fatal
+        if not self.args.blob_storage:
+            return None
+        name, settings = parse_backend_option(self.args.blob_storage)
+        blob_storages = self.pluginmanager.hook.devpiserver_blob_storage_backend(
+            settings=settings)
+        for blob_storage in blob_storages:
+            if blob_storage['name'] == name:
+                return blob_storage['storage']
+        fatal("The blob storage '%s' can't be found, is the plugin not installed?" % name)
+
     def sqlite_file_needed_but_missing(self):
         return (
             self.storage_info['name'] == 'sqlite'
@@ -20,6 +20,7 @@ from html.parser import HTMLParser
 from .config import hookimpl
 from .model import BaseStageCustomizer
 from .model import BaseStage, make_key_and_href, SimplelinkMeta
+from .model import ProjectNames
 from .model import ensure_boolean
 from .model import join_links_data
 from .readonly import ensure_deeply_readonly
@@ -31,6 +32,7 @@ class Link(URL):
     def __init__(self, url="", *args, **kwargs):
         self.requires_python = kwargs.pop('requires_python', None)
         self.yanked = kwargs.pop('yanked', None)
+        self.dist_info_metadata = kwargs.pop('dist_info_metadata', None)
         URL.__init__(self, url, *args, **kwargs)
 
 
@@ -103,7 +105,10 @@ class IndexParser:
         p = HTMLPage(html, disturl.url)
         seen = set()
         for link in p.links:
-            newurl = Link(link.url, requires_python=link.requires_python, yanked=link.yanked)
+            newurl = Link(
+                link.url, requires_python=link.requires_python,
+                yanked=link.yanked,
+                dist_info_metadata=getattr(link, 'dist_info_metadata', None))
             if not newurl.is_valid_http_url():
                 continue
             if is_archive_of_project(newurl, self.project):
@@ -132,10 +137,16 @@ class PyPIStage(BaseStage):
         self.offline = self.xom.config.offline_mode
         self.timeout = xom.config.request_timeout
         # list of locally mirrored projects
-        self.key_projects = self.keyfs.PROJNAMES(user=username, index=index)
+        self.key_projects = ProjectNames(self.keyfs, username, index)
         # used to log about stale projects only once
         self._offline_logging = set()
 
+    def bind_copy(self):
+        stage = super(PyPIStage, self).bind_copy()
+        # the offline mode can change at runtime
+        stage.offline = self.xom.config.offline_mode
+        return stage
+
     def httpget(self, url, allow_redirects, timeout=None, extra_headers=None):
         if self.xom.is_replica():
             if extra_headers is None:
@@ -206,10 +217,8 @@ class PyPIStage(BaseStage):
 
     def add_project_name(self, project):
         project = normalize_name(project)
-        projects = self.key_projects.get(readonly=False)
-        if project not in projects:
-            projects.add(project)
-            self.key_projects.set(projects)
+        if project not in self.key_projects:
+            self.key_projects.add(project)
 
     def del_project(self, project):
         if not self.is_project_cached(project):
@@ -221,11 +230,8 @@ class PyPIStage(BaseStage):
             for entry in entries:
                 entry.delete()
         self.key_projsimplelinks(project).delete()
-        projects = self.key_projects.get(readonly=False)
-        if project in projects:
-            projects.remove(project)
+        if self.key_projects.discard(project):
             self.cache_retrieve_times.expire(project)
-            self.key_projects.set(projects)
 
     def del_versiondata(self, project, version, cleanup=True):
         project = normalize_name(project)
@@ -254,10 +260,7 @@ class PyPIStage(BaseStage):
             links = ensure_deeply_readonly(
                 list(filter(self._is_file_cached, links)))
         if not links and cleanup:
-            projects = self.key_projects.get(readonly=False)
-            if project in projects:
-                projects.remove(project)
-                self.key_projects.set(projects)
+            self.key_projects.discard(project)
 
     @property
     def cache_projectnames(self):
@@ -344,7 +347,8 @@ class PyPIStage(BaseStage):
         """ return True if we have some cached simpelinks information. """
         return self.key_projsimplelinks(project).exists()
 
-    def _save_cache_links(self, project, links, requires_python, yanked, serial):
+    def _save_cache_links(self, project, links, requires_python, yanked, serial,
+                          dist_info_metadata=None):
         assert links != ()  # we don't store the old "Not Found" marker anymore
         assert isinstance(serial, int)
         assert project == normalize_name(project), project
@@ -352,6 +356,8 @@ class PyPIStage(BaseStage):
             "serial": serial, "links": links,
             "requires_python": requires_python,
             "yanked": yanked}
+        if dist_info_metadata:
+            data["dist_info_metadata"] = dist_info_metadata
         key = self.key_projsimplelinks(project)
         old = key.get()
         if old != data:
@@ -367,6 +373,26 @@ class PyPIStage(BaseStage):
         # keyfs.tx.on_commit_success(callback) method.
         self.cache_retrieve_times.refresh(project)
 
+    def _map_dist_info_metadata(self, releaselinks, entries):
+        # PEP 658 metadata files are passed through from upstream,
+        # otherwise we use the one extracted from a cached wheel
+        result = {}
+        for link, entry in zip(releaselinks, entries):
+            if link.dist_info_metadata:
+                hash_spec = link.dist_info_metadata
+                if "=" not in hash_spec:
+                    # the value is "true" if there is no hash
+                    hash_spec = None
+                md_entry = self.filestore.maplink_dist_info_metadata(
+                    entry, hash_spec)
+                if md_entry is not None:
+                    result[entry.relpath] = link.dist_info_metadata
+            elif entry.basename.endswith(".whl"):
+                md_entry = self.filestore.get_dist_info_metadata_entry(entry)
+                if md_entry is not None and md_entry.hash_spec:
+                    result[entry.relpath] = md_entry.hash_spec
+        return result
+
     def _load_cache_links(self, project):
         is_expired, links_with_data, serial = True, None, -1
 
@@ -494,7 +520,11 @@ class PyPIStage(BaseStage):
             links = [make_key_and_href(entry) for entry in entries]
             requires_python = [link.requires_python for link in releaselinks]
             yanked = [link.yanked for link in releaselinks]
-            self._save_cache_links(project, links, requires_python, yanked, serial)
+            dist_info_metadata = self._map_dist_info_metadata(
+                releaselinks, entries)
+            self._save_cache_links(
+                project, links, requires_python, yanked, serial,
+                dist_info_metadata)
             # make project appear in projects list even
             # before we next check up the full list with remote
             threadlog.info("setting projects cache for %r", project)
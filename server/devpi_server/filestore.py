@@ -6,12 +6,17 @@ for all indexes.
 from __future__ import unicode_literals
 import hashlib
 import mimetypes
+import os
+import uuid
+import zipfile
+from io import BytesIO
 from wsgiref.handlers import format_date_time
 import py
 import re
 import sys
 from devpi_common.metadata import splitbasename
 from devpi_common.types import cached_property, parse_hash_spec
+from .fileutil import BytesForHardlink
 from .log import threadlog
 
 
@@ -28,6 +33,18 @@ def get_default_hash_spec(content):
     return "sha256=" + hashlib.sha256(content).hexdigest()
 
 
+def get_file_checksum(f, hash_type, chunksize=65536):
+    """ return the hexdigest of the content of the file object ``f``,
+    which is read in chunks instead of all at once. """
+    hasher = getattr(hashlib, hash_type)()
+    while 1:
+        data = f.read(chunksize)
+        if not data:
+            break
+        hasher.update(data)
+    return hasher.hexdigest()
+
+
 def make_splitdir(hash_spec):
     parts = hash_spec.split("=")
     assert len(parts) == 2
@@ -35,6 +52,24 @@ def make_splitdir(hash_spec):
     return hash_value[:3], hash_value[3:16]
 
 
+def get_dist_info_metadata(basename, content):
+    """ return the content of the ``.dist-info/METADATA`` file of the
+    wheel ``content`` or None if it isn't a wheel or has no such file. """
+    if not basename.endswith(".whl"):
+        return None
+    try:
+        with zipfile.ZipFile(BytesIO(content)) as zf:
+            names = [
+                x for x in zf.namelist()
+                if x.count("/") == 1 and x.endswith(".dist-info/METADATA")]
+            if len(names) != 1:
+                return None
+            return zf.read(names[0])
+    except (zipfile.BadZipfile, EnvironmentError, KeyError, EOFError):
+        threadlog.warn("could not read METADATA of wheel %s", basename)
+        return None
+
+
 def unicode_if_bytes(val):
     if isinstance(val, py.builtin.bytes):
         val = py.builtin._totext(val)
@@ -109,6 +144,11 @@ class FileStore:
     def get_file_entry_from_key(self, key, meta=_nodefault, readonly=True):
         return FileEntry(key, meta=meta, readonly=readonly)
 
+    def get_partial_download(self, entry):
+        return PartialDownload(
+            self.keyfs.basedir.join("+partial", entry.relpath),
+            resumable=bool(entry.hash_spec))
+
     def store(self, user, index, basename, file_content, dir_hash_spec=None):
         if dir_hash_spec is None:
             dir_hash_spec = get_default_hash_spec(file_content)
@@ -119,6 +159,143 @@ class FileStore:
         entry.file_set_content(file_content)
         return entry
 
+    def get_dist_info_metadata_entry(self, entry):
+        """ return the entry for the PEP 658 metadata file which lives
+        next to the release file entry or None if there can't be one. """
+        if entry.key.name != "STAGEFILE":
+            return None
+        key = self.keyfs.STAGEFILE(
+            filename=entry.basename + ".metadata", **{
+                k: v for k, v in entry.key.params.items() if k != "filename"})
+        return FileEntry(key, readonly=False)
+
+    def store_dist_info_metadata(self, entry, content, hash_spec=None):
+        md_entry = self.get_dist_info_metadata_entry(entry)
+        if md_entry is None:
+            return None
+        md_entry.file_set_content(content, hash_spec=hash_spec)
+        md_entry.project = entry.project
+        if entry.version is not None:
+            md_entry.version = entry.version
+        return md_entry
+
+    def maplink_dist_info_metadata(self, entry, hash_spec):
+        """ map the metadata file an upstream index provides next to the
+        release file of the mirror entry. """
+        md_entry = self.get_dist_info_metadata_entry(entry)
+        if md_entry is None:
+            return None
+        md_entry.url = entry.url + ".metadata"
+        md_entry.hash_spec = unicode_if_bytes(hash_spec)
+        md_entry.project = entry.project
+        if entry.version is not None:
+            md_entry.version = entry.version
+        return md_entry
+
+
+class PartialDownload:
+    """ Keeps the already received bytes of an interrupted download on
+    disk, so a later attempt can continue with a HTTP Range request.
+
+    Only downloads with a known hash_spec are resumable, because the
+    checksum is the only way to verify the pieces fit together.
+    """
+
+    def __init__(self, path, resumable=True):
+        self.path = path
+        self.resumable = resumable
+        self.offset = 0
+        self._tmppath = None
+        self._f = None
+
+    def open(self):
+        """ Take over an existing partial file and open it for appending.
+
+        The rename makes sure concurrent downloads of the same file don't
+        write into the same partial file.  Returns the offset from which
+        the download has to be continued. """
+        self._tmppath = self.path.new(
+            basename="%s-%s" % (self.path.basename, uuid.uuid4().hex))
+        self._tmppath.dirpath().ensure(dir=1)
+        self.offset = 0
+        if self.resumable:
+            try:
+                os.rename(str(self.path), str(self._tmppath))
+            except OSError:
+                pass
+            else:
+                self.offset = self._tmppath.size()
+        self._f = open(str(self._tmppath), "ab")
+        return self.offset
+
+    def get_request_headers(self):
+        if self.offset:
+            return {str("Range"): str("bytes=%s-" % self.offset)}
+        return {}
+
+    def accept_response(self, response):
+        """ Check whether the response continues at our offset.
+
+        If the remote ignored the Range request, we start from scratch.
+        Returns False if the response can't be used. """
+        status_code = response.status_code
+        if status_code == 200:
+            if self.offset:
+                self.restart()
+            return True
+        if status_code == 206 and self.offset:
+            content_range = response.headers.get("content-range", "")
+            if content_range.startswith("bytes %s-" % self.offset):
+                return True
+            # unexpected range, the next attempt has to start from scratch
+            self.restart()
+        return False
+
+    def restart(self):
+        self._f.seek(0)
+        self._f.truncate()
+        self.offset = 0
+
+    def write(self, data):
+        self._f.write(data)
+
+    def read_existing(self, chunksize=65536):
+        """ Yields the bytes which were received in previous attempts. """
+        with open(str(self._tmppath), "rb") as f:
+            remaining = self.offset
+            while remaining > 0:
+                data = f.read(min(chunksize, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+
+    def getvalue(self):
+        self._f.flush()
+        with open(str(self._tmppath), "rb") as f:
+            return f.read()
+
+    def keep(self):
+        """ Store the received bytes for a later resume. """
+        if self._f is None:
+            return
+        self._f.close()
+        self._f = None
+        if self.resumable and self._tmppath.size():
+            os.rename(str(self._tmppath), str(self.path))
+            threadlog.info(
+                "keeping %s bytes of interrupted download at %s",
+                self.path.size(), self.path)
+        else:
+            self._tmppath.remove(ignore_errors=True)
+
+    def discard(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+        if self._tmppath is not None:
+            self._tmppath.remove(ignore_errors=True)
+
 
 def metaprop(name):
     def fget(self):
@@ -178,7 +355,8 @@ class FileEntry(object):
             return ValueError("%s: %s" %(self.relpath, err))
 
     def file_get_checksum(self, hash_type):
-        return getattr(hashlib, hash_type)(self.file_get_content()).hexdigest()
+        with self.file_open_read() as f:
+            return get_file_checksum(f, hash_type)
 
     @property
     def tx(self):
@@ -190,10 +368,64 @@ class FileEntry(object):
     def meta(self):
         return self.key.get(readonly=self.readonly)
 
+    @property
+    def blob_key(self):
+        """ key with the relpaths of all entries with the same content. """
+        hash_spec = self.hash_spec
+        if not hash_spec or not hash_spec.startswith("sha256="):
+            return None
+        return self.key.keyfs.FILEBLOB(sha256=hash_spec[7:])
+
+    def find_same_content_path(self, conn):
+        """ return the filesystem path of the file of another entry with
+        the same content or None. """
+        blob_key = self.blob_key
+        if blob_key is None:
+            return None
+        for relpath in sorted(blob_key.get()):
+            if relpath == self.relpath:
+                continue
+            try:
+                path = conn.io_file_os_path("/".join(("+files", relpath)))
+            except RuntimeError:
+                # the file was changed in the current transaction
+                continue
+            if path is None:
+                # the storage backend doesn't keep files on the filesystem
+                return None
+            if os.path.exists(path):
+                return path
+
+    def _add_blob_ref(self):
+        if not self.key.keyfs.file_dedup:
+            return
+        blob_key = self.blob_key
+        if blob_key is None:
+            return
+        refs = blob_key.get(readonly=False)
+        if self.relpath not in refs:
+            refs.add(self.relpath)
+            blob_key.set(refs)
+
+    def _remove_blob_ref(self):
+        if not self.key.keyfs.file_dedup:
+            return
+        blob_key = self.blob_key
+        if blob_key is None:
+            return
+        refs = blob_key.get(readonly=False)
+        if self.relpath in refs:
+            refs.remove(self.relpath)
+            if refs:
+                blob_key.set(refs)
+            else:
+                blob_key.delete()
+
     def file_exists(self):
         return self.tx.conn.io_file_exists(self._storepath)
 
     def file_delete(self):
+        self._remove_blob_ref()
         return self.tx.conn.io_file_delete(self._storepath)
 
     def file_size(self):
@@ -211,6 +443,15 @@ class FileEntry(object):
     def file_os_path(self):
         return self.tx.conn.io_file_os_path(self._storepath)
 
+    def file_stored_path(self):
+        """ Like file_os_path, but without fetching the file into the
+        local cache of a tiered storage. """
+        io_file_stored_path = getattr(self.tx.conn, "io_file_stored_path", None)
+        if io_file_stored_path is None:
+            # storage backend without tiers
+            return self.file_os_path()
+        return io_file_stored_path(self._storepath)
+
     def file_set_content(self, content, last_modified=None, hash_spec=None):
         assert isinstance(content, bytes)
         if last_modified != -1:
@@ -223,8 +464,16 @@ class FileEntry(object):
                 raise ValueError(err)
         else:
             hash_spec = get_default_hash_spec(content)
+        if self.hash_spec != hash_spec:
+            self._remove_blob_ref()
         self.hash_spec = hash_spec
+        if self.key.keyfs.file_dedup and not isinstance(content, BytesForHardlink):
+            path = self.find_same_content_path(self.tx.conn)
+            if path is not None and os.path.getsize(path) == len(content):
+                content = BytesForHardlink(content)
+                content.devpi_srcpath = path
         self.tx.conn.io_file_set(self._storepath, content)
+        self._add_blob_ref()
         # we make sure we always refresh the meta information
         # when we set the file content. Otherwise we might
         # end up only committing file content without any keys
@@ -254,9 +503,9 @@ class FileEntry(object):
         return hash(self.relpath)
 
     def delete(self, **kw):
+        self.file_delete()
         self.key.delete()
         self.meta = {}
-        self.file_delete()
 
     def has_existing_metadata(self):
         return self.hash_spec and self.last_modified
@@ -0,0 +1,228 @@
+"""
+Tiered storage for the files of the sqlite storage backend.
+
+All files are kept in a cold directory, for example on a large, but
+slow mount. The files in the server directory become a cache of the
+recently used files, which is bounded by size. If it grows above the
+limit, the least recently accessed files are evicted from it. Files
+which aren't in the cache are copied back from the cold directory on
+access.
+"""
+from .fileutil import rename
+from .log import threadlog
+from collections import OrderedDict
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+
+
+size_matcher = re.compile(r"^(\d+)([KMGT]?)B?$", re.IGNORECASE)
+size_units = dict(k=1024, m=1024 ** 2, g=1024 ** 3, t=1024 ** 4)
+
+
+def parse_size(value):
+    """ return the number of bytes for a size like ``500M`` or ``2G``. """
+    m = size_matcher.match(str(value).strip())
+    if m is None:
+        raise ValueError("Invalid size '%s'." % value)
+    (number, unit) = m.groups()
+    return int(number) * size_units.get(unit.lower(), 1)
+
+
+def copy_file(source, dest):
+    tmppath = "%s-%s-tmp" % (dest, uuid.uuid4().hex)
+    destdir = os.path.dirname(dest)
+    if not os.path.exists(destdir):
+        try:
+            os.makedirs(destdir)
+        except OSError:
+            # another thread might have created it in the meantime
+            if not os.path.isdir(destdir):
+                raise
+    try:
+        shutil.copy2(source, tmppath)
+        rename(tmppath, dest)
+    except BaseException:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+
+
+class FileTiers(object):
+    def __init__(self, basedir, cold_dir, max_size):
+        self.basedir = str(basedir)
+        self.cold_dir = str(cold_dir)
+        self.max_size = max_size
+        self.size = 0
+        self._lock = threading.RLock()
+        self._hot = None
+
+    def cold_path(self, path):
+        return os.path.join(
+            self.cold_dir, os.path.relpath(path, self.basedir))
+
+    @property
+    def hot(self):
+        """ The files in the cache with their size, ordered by the time
+        they were last accessed. """
+        with self._lock:
+            if self._hot is None:
+                self._hot = self._scan_hot()
+            return self._hot
+
+    def _scan_hot(self):
+        files = []
+        for dirpath, dirnames, filenames in os.walk(
+                os.path.join(self.basedir, "+files")):
+            for filename in filenames:
+                if filename.endswith("-tmp"):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_atime, path, st.st_size))
+        files.sort()
+        hot = OrderedDict()
+        self.size = 0
+        for atime, path, size in files:
+            hot[path] = size
+            self.size += size
+        return hot
+
+    def _add(self, path):
+        size = os.path.getsize(path)
+        with self._lock:
+            old_size = self.hot.pop(path, None)
+            if old_size is not None:
+                self.size -= old_size
+            self.hot[path] = size
+            self.size += size
+
+    def _discard(self, path):
+        with self._lock:
+            size = self.hot.pop(path, None)
+            if size is not None:
+                self.size -= size
+
+    def accessed(self, path):
+        """ Mark the file as recently used, so it is evicted last.
+
+        The access time is set explicitly, so the order survives restarts
+        regardless of the atime options of the mount. """
+        with self._lock:
+            if path in self.hot:
+                self.hot.move_to_end(path)
+        try:
+            os.utime(path, (time.time(), os.path.getmtime(path)))
+        except OSError:
+            pass
+
+    def exists(self, path):
+        if os.path.exists(path):
+            return True
+        return os.path.exists(self.cold_path(path))
+
+    def getsize(self, path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return os.path.getsize(self.cold_path(path))
+
+    def stored_path(self, path):
+        """ Return the path of the authoritative copy of the file without
+        fetching it into the cache. That is the copy in the cold directory,
+        unless copying it there failed so far. """
+        cold_path = self.cold_path(path)
+        if os.path.exists(cold_path):
+            return cold_path
+        return path
+
+    def fetch(self, path):
+        """ Make sure the file is in the cache, copying it from the cold
+        directory if needed. Returns False if it doesn't exist at all. """
+        if os.path.exists(path):
+            self.accessed(path)
+            return True
+        try:
+            copy_file(self.cold_path(path), path)
+        except (IOError, OSError):
+            return False
+        threadlog.debug("fetched %s from cold storage", path)
+        self._add(path)
+        self.accessed(path)
+        self.evict(keep=path)
+        return True
+
+    def commit(self, files_commit, files_del):
+        """ Copy newly committed files to the cold directory and remove
+        deleted files from it. The paths are relative to basedir.
+
+        This runs after the database commit, so errors are only logged.
+        Files which couldn't be copied stay in the cache, eviction copies
+        them to the cold directory later. """
+        for relpath in files_commit:
+            path = os.path.join(self.basedir, relpath)
+            try:
+                copy_file(path, self.cold_path(path))
+            except (IOError, OSError) as e:
+                threadlog.error(
+                    "could not copy %s to cold storage: %s", path, e)
+            self._add(path)
+        for relpath in files_del:
+            path = os.path.join(self.basedir, relpath)
+            try:
+                os.remove(self.cold_path(path))
+            except OSError:
+                pass
+            self._discard(path)
+        self.evict()
+
+    def _next_eviction(self, keep, skip):
+        with self._lock:
+            if self.size <= self.max_size:
+                return None
+            for path in self.hot:
+                if path == keep:
+                    return None
+                if path not in skip:
+                    return path
+        return None
+
+    def evict(self, keep=None):
+        """ Remove the least recently used files from the cache until its
+        size is below the limit.
+
+        Missing cold copies are made without holding the lock, so fetching
+        and accessing other files isn't blocked by the copying. """
+        skip = set()
+        while True:
+            path = self._next_eviction(keep, skip)
+            if path is None:
+                return
+            cold_path = self.cold_path(path)
+            if not os.path.exists(cold_path) and os.path.exists(path):
+                # file from before the cold directory was used or
+                # which couldn't be copied at commit time
+                try:
+                    copy_file(path, cold_path)
+                except (IOError, OSError) as e:
+                    threadlog.error(
+                        "could not copy %s to cold storage, keeping "
+                        "it in the cache: %s", path, e)
+                    skip.add(path)
+                    continue
+            with self._lock:
+                if self._next_eviction(keep, skip) != path:
+                    # the file was accessed or removed during the copy
+                    continue
+                self._discard(path)
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            threadlog.debug("evicted %s from cache", path)
@@ -4,17 +4,78 @@ from .config import add_help_option
 from .config import add_storage_options
 from .config import parseoptions, get_pluginmanager
 from .filestore import FileEntry
+from .filestore import get_file_checksum
 from .log import configure_cli_logging
 from .main import Fatal
 from .main import xom_from_config
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
 import py
 import sys
 import time
 
 
-def fsck():
+def check_file(task):
+    """ Return the task together with the checksum of the file at the path
+    of the task, or None as checksum if the file can't be read.
+
+    Runs without a transaction, so it can be used in worker processes. """
+    (serial, relpath, keyname, path, hash_type, hash_value) = task
+    try:
+        with open(path, "rb") as f:
+            if not hash_type:
+                return (task, "")
+            return (task, get_file_checksum(f, hash_type))
+    except (IOError, OSError):
+        return (task, None)
+
+
+def iter_ordered_results(func, tasks, workers):
+    """ Yields the results of func for each task in the order of tasks.
+
+    With more than one worker the tasks run in a pool of processes. The
+    number of pending tasks is bounded, so the tasks can be produced
+    lazily while the results are consumed. """
+    if workers <= 1:
+        for task in tasks:
+            yield func(task)
+        return
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for task in tasks:
+            pending.append(executor.submit(func, task))
+            if len(pending) >= workers * 16:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def read_checkpoint(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError):
+        return None
+
+
+def write_checkpoint(path, state):
+    tmppath = path + "-tmp"
+    with open(tmppath, "w") as f:
+        json.dump(state, f, sort_keys=True)
+    os.replace(tmppath, path)
+
+
+def fsck(pluginmanager=None, argv=None):
     """ devpi-fsck command line entry point. """
-    pluginmanager = get_pluginmanager()
+    if argv is None:
+        argv = sys.argv
+    else:
+        # for tests
+        argv = [str(x) for x in argv]
+    if pluginmanager is None:
+        pluginmanager = get_pluginmanager()
     try:
         parser = MyArgumentParser(
             description="Run a file consistency check of the devpi-server database.",
@@ -22,52 +83,135 @@ def fsck():
         add_help_option(parser, pluginmanager)
         add_configfile_option(parser, pluginmanager)
         add_storage_options(parser, pluginmanager)
-        config = parseoptions(pluginmanager, sys.argv, parser=parser)
+        parser.addoption(
+            "--workers", type=int, metavar="NUM", default=os.cpu_count(),
+            help="number of processes used to hash files. "
+                 "By default the number of CPUs.")
+        parser.addoption(
+            "--since-serial", type=int, metavar="SERIAL", default=-1,
+            help="only check files which changed after the given serial. "
+                 "Use the serial from the summary of a previous run for "
+                 "incremental checks.")
+        parser.addoption(
+            "--checkpoint", type=str, metavar="PATH", default=None,
+            help="file to regularly store the progress in. If it exists, "
+                 "the check continues where the previous run stopped. "
+                 "The file is removed when the check is complete.")
+        parser.addoption(
+            "--json", action="store_true",
+            help="print a summary as JSON to stdout when done.")
+        config = parseoptions(pluginmanager, argv, parser=parser)
         configure_cli_logging(config.args)
         xom = xom_from_config(config)
         log = xom.log
         log.info("serverdir: %s" % xom.config.serverdir)
         log.info("uuid: %s" % xom.config.nodeinfo["uuid"])
+        args = xom.config.args
         keyfs = xom.keyfs
         keys = (keyfs.get_key('PYPIFILE_NOMD5'), keyfs.get_key('STAGEFILE'))
+        state = dict(
+            since_serial=args.since_serial, position=None,
+            processed=0, missing=0, mismatches=0)
+        if args.checkpoint:
+            checkpoint = read_checkpoint(args.checkpoint)
+            if checkpoint is None:
+                pass
+            elif checkpoint["since_serial"] != args.since_serial:
+                log.warn(
+                    "Ignoring checkpoint %s which was created with "
+                    "--since-serial %s" % (
+                        args.checkpoint, checkpoint["since_serial"]))
+            else:
+                state = checkpoint
+                log.info(
+                    "Continuing after %s at serial %s from checkpoint."
+                    % (state["position"][1], state["position"][0]))
+        position = None
+        if state["position"] is not None:
+            position = tuple(state["position"])
         last_time = time.time()
-        processed = 0
-        missing_files = 0
+        completed = False
         with xom.keyfs.transaction(write=False) as tx:
             log.info("Checking at serial %s" % tx.at_serial)
-            relpaths = tx.iter_relpaths_at(keys, tx.at_serial)
-            for item in relpaths:
-                if item.value is None:
-                    continue
-                if time.time() - last_time > 5:
-                    last_time = time.time()
-                    log.info(
-                        "Processed a total of %s files so far."
-                        % processed)
-                processed = processed + 1
-                key = keyfs.get_key_instance(item.keyname, item.relpath)
-                entry = FileEntry(key, item.value)
-                if not entry.last_modified:
-                    continue
+            workers = args.workers
+            if tx.conn.io_file_os_path("+files") is None:
+                # the files can only be read through the transaction
+                workers = 1
+
+            def check_entry(task):
+                (serial, relpath, keyname, path, hash_type, hash_value) = task
+                if path is not None:
+                    return check_file(task)
+                entry = FileEntry(keyfs.get_key_instance(keyname, relpath))
                 if not entry.file_exists():
-                    missing_files += 1
-                    if missing_files < 10:
-                        log.error("Missing file %s" % entry.relpath)
-                    elif missing_files == 10:
-                        log.error("Further missing files will be ommited.")
-                    continue
-                checksum = entry.file_get_checksum(entry.hash_type)
-                if entry.hash_value != checksum:
-                    log.error(
-                        "%s - %s mismatch, got %s, expected %s"
-                        % (entry.relpath, entry.hash_type, checksum, entry.hash_value))
+                    return (task, None)
+                if not hash_type:
+                    return (task, "")
+                return (task, entry.file_get_checksum(hash_type))
+
+            def iter_tasks():
+                items = tx.iter_current_relpaths(
+                    keys, since_serial=args.since_serial)
+                for item in items:
+                    if item.value is None:
+                        continue
+                    if position is not None:
+                        if (item.serial, item.relpath) <= position:
+                            continue
+                    key = keyfs.get_key_instance(item.keyname, item.relpath)
+                    entry = FileEntry(key, item.value)
+                    if not entry.last_modified:
+                        continue
+                    yield (
+                        item.serial, item.relpath, item.keyname,
+                        entry.file_stored_path(), entry.hash_type,
+                        entry.hash_value)
+
+            func = check_file if workers > 1 else check_entry
+            try:
+                for task, checksum in iter_ordered_results(func, iter_tasks(), workers):
+                    (serial, relpath, keyname, path, hash_type, hash_value) = task
+                    state["position"] = [serial, relpath]
+                    state["processed"] += 1
+                    if checksum is None:
+                        state["missing"] += 1
+                        if state["missing"] < 10:
+                            log.error("Missing file %s" % relpath)
+                        elif state["missing"] == 10:
+                            log.error("Further missing files will be ommited.")
+                    elif hash_type and checksum != hash_value:
+                        state["mismatches"] += 1
+                        log.error(
+                            "%s - %s mismatch, got %s, expected %s"
+                            % (relpath, hash_type, checksum, hash_value))
+                    if time.time() - last_time > 5:
+                        last_time = time.time()
+                        log.info(
+                            "Processed a total of %s files so far."
+                            % state["processed"])
+                        if args.checkpoint:
+                            write_checkpoint(args.checkpoint, state)
+                completed = True
+            finally:
+                if args.checkpoint and not completed and state["position"]:
+                    write_checkpoint(args.checkpoint, state)
             log.info(
                 "Processed a total of %s files."
-                % processed)
-            if missing_files:
+                % state["processed"])
+            if state["missing"]:
                 log.error(
                     "A total of %s files are missing."
-                    % missing_files)
+                    % state["missing"])
+            if args.checkpoint and os.path.exists(args.checkpoint):
+                os.remove(args.checkpoint)
+            if args.json:
+                summary = dict(
+                    serial=tx.at_serial,
+                    since_serial=args.since_serial,
+                    processed=state["processed"],
+                    missing=state["missing"],
+                    mismatches=state["mismatches"])
+                sys.stdout.write(json.dumps(summary, sort_keys=True) + "\n")
     except Fatal as e:
         tw = py.io.TerminalWriter(sys.stderr)
         tw.line("fatal: %s" % e.args[0], red=True)
@@ -0,0 +1,194 @@
+from .config import MyArgumentParser
+from .config import add_configfile_option
+from .config import add_help_option
+from .config import add_storage_options
+from .config import parseoptions, get_pluginmanager
+from .keyfs_sqlite_fs import tmp_file_matcher
+from .log import configure_cli_logging
+from .main import Fatal
+from .main import fatal
+from .main import xom_from_config
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+import os
+import py
+import sys
+import time
+
+
+def _scan_dir(basedir, reldir):
+    files = []
+    dirs = []
+    path = os.path.join(basedir, reldir) if reldir else basedir
+    with os.scandir(path) as entries:
+        for entry in entries:
+            relpath = "%s/%s" % (reldir, entry.name) if reldir else entry.name
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(relpath)
+            else:
+                files.append(relpath)
+    return files, dirs
+
+
+def iter_files(basedir, workers=None):
+    """ Yields the paths of all files below basedir relative to it.
+
+    Each directory is scanned in a thread of a pool as soon as it was
+    found, so the file tree is walked in parallel and the results are
+    streamed instead of collected first. """
+    if not os.path.isdir(basedir):
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(_scan_dir, basedir, "")}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, dirs = future.result()
+                for reldir in dirs:
+                    pending.add(executor.submit(_scan_dir, basedir, reldir))
+                for relpath in files:
+                    yield relpath
+
+
+def _modified_after(path, timestamp):
+    if timestamp is None:
+        return False
+    try:
+        return os.path.getmtime(path) > timestamp
+    except OSError:
+        # removed in the meantime
+        return True
+
+
+def iter_garbage(tx, files_path, partial_path, workers=None,
+                 cold_files_path=None, keep_newer_than=None):
+    """ Yields tuples of a description and path of files which aren't
+    referenced by any file entry in the database.
+
+    Besides orphaned files, these are leftover ``-tmp`` files from crashed
+    transactions and partial downloads which can't be resumed anymore.
+    With tiered storage the files in the cold directory are checked as
+    well, without fetching anything into the cache.
+
+    Files modified after the ``keep_newer_than`` timestamp are kept, as
+    they might belong to a transaction which is still in progress or was
+    committed after the one used for the check. """
+    keys = (tx.keyfs.get_key('PYPIFILE_NOMD5'), tx.keyfs.get_key('STAGEFILE'))
+    live = set(
+        x.relpath for x in tx.iter_current_relpaths(keys)
+        if x.value is not None)
+    existing = set()
+    for basepath in (files_path, cold_files_path):
+        if basepath is None:
+            continue
+        for relpath in iter_files(basepath, workers=workers):
+            path = os.path.join(basepath, relpath)
+            if tmp_file_matcher.match(relpath) is not None:
+                kind = "tmp"
+            elif relpath not in live:
+                kind = "orphan"
+            else:
+                existing.add(relpath)
+                continue
+            if not _modified_after(path, keep_newer_than):
+                yield (kind, path)
+    for relpath in iter_files(partial_path, workers=workers):
+        path = os.path.join(partial_path, relpath)
+        if relpath in live and relpath not in existing:
+            continue
+        if not _modified_after(path, keep_newer_than):
+            yield ("partial", path)
+
+
+def gc(pluginmanager=None, argv=None):
+    """ devpi-gc command line entry point. """
+    if argv is None:
+        argv = sys.argv
+    else:
+        # for tests
+        argv = [str(x) for x in argv]
+    if pluginmanager is None:
+        pluginmanager = get_pluginmanager()
+    try:
+        parser = MyArgumentParser(
+            description="Remove files from the devpi-server data directory "
+                        "which are not referenced by the database anymore. "
+                        "Recently modified files are kept, as they might "
+                        "belong to transactions of a running server.",
+            add_help=False)
+        add_help_option(parser, pluginmanager)
+        add_configfile_option(parser, pluginmanager)
+        add_storage_options(parser, pluginmanager)
+        parser.addoption(
+            "--dry-run", action="store_true",
+            help="only report the files which would be removed.")
+        parser.addoption(
+            "--workers", type=int, metavar="NUM", default=None,
+            help="number of threads used to scan the file tree. "
+                 "By default it depends on the number of CPUs.")
+        parser.addoption(
+            "--min-age", type=int, metavar="SECONDS", default=3600,
+            help="only remove files which weren't modified for the given "
+                 "number of seconds, so files of uploads and downloads "
+                 "of a running server are kept.")
+        config = parseoptions(pluginmanager, argv, parser=parser)
+        configure_cli_logging(config.args)
+        if config.args.blob_storage:
+            fatal(
+                "Files in a blob storage are not collected, it is "
+                "managed outside of the server directory.")
+        xom = xom_from_config(config)
+        log = xom.log
+        log.info("serverdir: %s" % xom.config.serverdir)
+        log.info("uuid: %s" % xom.config.nodeinfo["uuid"])
+        dry_run = xom.config.args.dry_run
+        last_time = time.time()
+        keep_newer_than = last_time - xom.config.args.min_age
+        counts = dict(orphan=0, tmp=0, partial=0)
+        size = 0
+        with xom.keyfs.transaction(write=False) as tx:
+            files_path = tx.conn.io_file_os_path("+files")
+            if files_path is None:
+                fatal(
+                    "The storage backend doesn't keep files on the "
+                    "file system.")
+            partial_path = xom.keyfs.basedir.join("+partial").strpath
+            cold_files_path = None
+            tiers = getattr(tx.conn.storage, "tiers", None)
+            if tiers is not None:
+                cold_files_path = tiers.cold_path(files_path)
+            log.info("Collecting garbage at serial %s" % tx.at_serial)
+            garbage = iter_garbage(
+                tx, files_path, partial_path,
+                workers=xom.config.args.workers,
+                cold_files_path=cold_files_path,
+                keep_newer_than=keep_newer_than)
+            for kind, path in garbage:
+                if time.time() - last_time > 5:
+                    last_time = time.time()
+                    log.info(
+                        "Found a total of %s files so far."
+                        % sum(counts.values()))
+                try:
+                    file_size = os.path.getsize(path)
+                    if dry_run:
+                        log.info("Would remove %s file %s" % (kind, path))
+                    else:
+                        os.remove(path)
+                        log.info("Removed %s file %s" % (kind, path))
+                except OSError as e:
+                    log.error("Could not remove %s: %s" % (path, e))
+                    continue
+                counts[kind] += 1
+                size += file_size
+        log.info(
+            "%s %s orphaned, %s temporary and %s partial files "
+            "with a total of %s bytes."
+            % ("Would remove" if dry_run else "Removed",
+               counts["orphan"], counts["tmp"], counts["partial"], size))
+        return 0
+    except Fatal as e:
+        tw = py.io.TerminalWriter(sys.stderr)
+        tw.line("fatal: %s" % e.args[0], red=True)
+        return 1
@@ -76,6 +76,20 @@ def devpiserver_storage_backend(settings):
     """
 
 
+@hookspec
+def devpiserver_blob_storage_backend(settings):
+    """ return dict containing blob storage backend info.
+
+    A blob storage keeps the content of release files instead of the
+    storage backend, see ``devpi_server.blobstorage.BlobStore`` for the
+    API. The following keys are defined:
+
+        "storage" - the class implementing the blob storage API
+        "name" - name for selection from command line
+        "description" - a short description for the commandline help
+    """
+
+
 @hookspec
 def devpiserver_pyramid_configure(config, pyramid_config):
     """ called during initializing with the pyramid_config and the devpi_server
@@ -11,7 +11,9 @@ import re
 import contextlib
 import py
 from . import mythread
+from .blobstorage import BlobStorage
 from .fileutil import loads
+from .keyfs_delta import is_delta, resolve_value
 from .log import threadlog, thread_push_log, thread_pop_log
 from .readonly import get_mutable_deepcopy, ensure_deeply_readonly, \
                       is_deeply_readonly
@@ -216,17 +218,24 @@ class KeyFS(object):
     class ReadOnly(Exception):
         """ attempt to open write transaction while in readonly mode. """
 
-    def __init__(self, basedir, storage, readonly=False, cache_size=10000):
+    def __init__(self, basedir, storage, readonly=False, cache_size=10000,
+                 file_dedup=False, blob_storage=None):
         self.basedir = py.path.local(basedir).ensure(dir=1)
+        # hard link files with the same content, see FileEntry
+        self.file_dedup = file_dedup
         self._keys = {}
         self._threadlocal = mythread.threading.local()
         self._cv_new_transaction = mythread.threading.Condition()
         self._import_subscriber = {}
+        self._commit_subscribers = []
         self.notifier = TxNotificationThread(self)
         self._storage = storage(
             self.basedir,
             notify_on_commit=self._notify_on_commit,
             cache_size=cache_size)
+        if blob_storage is not None:
+            self._storage = BlobStorage(
+                self._storage, blob_storage(self.basedir))
         self._readonly = readonly
 
     def finalize_init(self):
@@ -240,6 +249,7 @@ class KeyFS(object):
                 assert next_serial == serial, (next_serial, serial)
                 for relpath, tup in changes.items():
                     keyname, back_serial, val = tup
+                    val = resolve_value(conn, relpath, back_serial, val)
                     typedkey = self.get_key_instance(keyname, relpath)
                     try:
                         fswriter.record_set(
@@ -266,6 +276,11 @@ class KeyFS(object):
         assert key.name not in self._import_subscriber
         self._import_subscriber[key.name] = subscriber
 
+    def subscribe_on_commit(self, subscriber):
+        """ subscriber(tx) is called in write transactions right before
+        the changes are written and may change further keys. """
+        self._commit_subscribers.append(subscriber)
+
     def _notify_on_commit(self, serial):
         self.release_all_wait_tx()
 
@@ -524,11 +539,40 @@ class Transaction(object):
                     continue
                 if relpath not in seen:
                     seen.add(relpath)
+                    if is_delta(val):
+                        val = self.conn.get_changes(serial)[relpath][2]
                     yield RelpathInfo(
                         relpath=relpath, keyname=keyname,
                         serial=serial, back_serial=back_serial,
                         value=val)
 
+    def iter_current_relpaths(self, typedkeys, since_serial=-1):
+        """ Yields RelpathInfo with the latest value of all keys of the
+        given types which were last changed after since_serial, ordered
+        by serial and relpath.
+
+        Keys which were changed after the serial of this transaction
+        are skipped. """
+        conn = self.conn
+        if not hasattr(conn, "db_read_typedkeys"):
+            # storage plugins without direct access to the key table
+            items = [
+                x for x in self.iter_relpaths_at(typedkeys, self.at_serial)
+                if x.serial > since_serial]
+            items.sort(key=lambda x: (x.serial, x.relpath))
+            for item in items:
+                yield item
+            return
+        keynames = [k.name for k in typedkeys]
+        for relpath, keyname, serial in conn.db_read_typedkeys(keynames):
+            if serial <= since_serial or serial > self.at_serial:
+                continue
+            (keyname, back_serial, val) = conn.get_changes(serial)[relpath]
+            yield RelpathInfo(
+                relpath=relpath, keyname=keyname,
+                serial=serial, back_serial=back_serial,
+                value=val)
+
     def iter_serial_and_value_backwards(self, relpath, last_serial):
         while last_serial >= 0:
             tup = self.conn.get_changes(last_serial).get(relpath)
@@ -679,6 +723,8 @@ class Transaction(object):
         if not self.dirty and not self.conn.dirty_files:
             threadlog.debug("nothing to commit, just closing tx")
             return self._close()
+        for subscriber in self.keyfs._commit_subscribers:
+            subscriber(self)
         try:
             with self.conn.write_transaction() as fswriter:
                 for typedkey in self.dirty:
@@ -0,0 +1,137 @@
+"""
+Delta records for changelog entries.
+
+Instead of the full new value of a key a changelog entry can contain a
+delta against the value at ``back_serial``.  A delta is stored as
+``(DELTA_MARKER, depth, patch)``, which can't be mistaken for a regular
+value, because keys only hold dicts, sets and ints.  The depth counts the
+deltas since the last full value, after ``MAX_DELTA_CHAIN`` deltas a full
+value is written again, so reconstructing a value never has to go back
+further than that.
+
+Patches are tuples with an operation code as the first item:
+
+``("=", value)``
+    replace the value
+
+``("s", added, removed)``
+    add and remove items of a set
+
+``("d", changed, removed)``
+    ``changed`` maps keys to patches for their values and ``removed``
+    lists keys to delete from a dict
+
+``("l", start, stop, items)``
+    replace the slice ``[start:stop]`` of a list with ``items``
+"""
+from .fileutil import dumps, loads
+from .readonly import get_mutable_deepcopy
+
+
+DELTA_MARKER = "devpi-delta"
+MAX_DELTA_CHAIN = 16
+MIN_DELTA_SIZE = 1024
+
+
+def is_delta(value):
+    return (
+        isinstance(value, tuple) and len(value) == 3
+        and value[0] == DELTA_MARKER)
+
+
+def make_patch(old, new):
+    if type(old) is not type(new):
+        return ("=", new)
+    if isinstance(new, set):
+        return ("s", list(new - old), list(old - new))
+    if isinstance(new, dict):
+        changed = {}
+        for key, value in new.items():
+            if key not in old:
+                changed[key] = ("=", value)
+            elif old[key] != value:
+                changed[key] = make_patch(old[key], value)
+        removed = [key for key in old if key not in new]
+        return ("d", changed, removed)
+    if isinstance(new, list):
+        size = min(len(old), len(new))
+        start = 0
+        while start < size and old[start] == new[start]:
+            start += 1
+        end = 0
+        while end < size - start and old[-end - 1] == new[-end - 1]:
+            end += 1
+        return ("l", start, len(old) - end, new[start:len(new) - end])
+    return ("=", new)
+
+
+def apply_patch(old, patch):
+    """ apply patch to the mutable value old and return the result. """
+    op = patch[0]
+    if op == "=":
+        return patch[1]
+    if op == "s":
+        (op, added, removed) = patch
+        old.update(added)
+        old.difference_update(removed)
+        return old
+    if op == "d":
+        (op, changed, removed) = patch
+        for key in removed:
+            del old[key]
+        for key, value_patch in changed.items():
+            old[key] = apply_patch(old.get(key), value_patch)
+        return old
+    if op == "l":
+        (op, start, stop, items) = patch
+        old[start:stop] = items
+        return old
+    raise ValueError("unknown patch operation %r" % (op,))
+
+
+def encode_value(conn, relpath, back_serial, value):
+    """ return a delta record for value if it is much smaller than value
+    itself, otherwise return value unchanged. """
+    if back_serial < 0 or not isinstance(value, (dict, set)):
+        return value
+    size = len(dumps(value))
+    if size < MIN_DELTA_SIZE:
+        return value
+    raw_entry = conn.get_raw_changelog_entry(back_serial)
+    if raw_entry is None:
+        return value
+    change = loads(raw_entry)[0].get(relpath)
+    if change is None:
+        return value
+    old = change[2]
+    depth = 1
+    if is_delta(old):
+        depth = old[1] + 1
+        if depth > MAX_DELTA_CHAIN:
+            # write a full snapshot again
+            return value
+        old = get_mutable_deepcopy(conn.get_changes(back_serial)[relpath][2])
+    if type(old) is not type(value):
+        return value
+    delta = (DELTA_MARKER, depth, make_patch(old, value))
+    if len(dumps(delta)) * 2 > size:
+        return value
+    return delta
+
+
+def resolve_value(conn, relpath, back_serial, value):
+    """ return the full value for a possible delta record. """
+    if not is_delta(value):
+        return value
+    old = conn.get_changes(back_serial)[relpath][2]
+    return apply_patch(get_mutable_deepcopy(old), value[2])
+
+
+def resolve_changes(conn, changes):
+    """ replace all delta records in changes by their full values. """
+    for relpath, (keyname, back_serial, value) in changes.items():
+        if is_delta(value):
+            changes[relpath] = (
+                keyname, back_serial,
+                resolve_value(conn, relpath, back_serial, value))
+    return changes
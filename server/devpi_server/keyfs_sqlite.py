@@ -1,6 +1,7 @@
 from devpi_common.types import cached_property
 from .config import hookimpl
 from .fileutil import dumps, loads
+from .keyfs_delta import encode_value, resolve_changes
 from .log import threadlog, thread_push_log, thread_pop_log
 from .readonly import ReadonlyView
 from .readonly import ensure_deeply_readonly, get_mutable_deepcopy
@@ -46,6 +47,15 @@ class BaseConnection:
             raise KeyError(relpath)
         return tuple(row[:2])
 
+    def db_read_typedkeys(self, keynames):
+        """ Yields (relpath, keyname, serial) of all keys with one of the
+        given keynames, ordered by the serial of their last change. """
+        keynames = list(keynames)
+        q = "SELECT key, keyname, serial FROM kv WHERE keyname IN (%s) ORDER BY serial, key" % (
+            ",".join("?" * len(keynames)))
+        for row in self._sqlconn.execute(q, keynames):
+            yield tuple(row[:3])
+
     def db_write_typedkey(self, relpath, name, next_serial):
         q = "INSERT OR REPLACE INTO kv (key, keyname, serial) VALUES (?, ?, ?)"
         self._sqlconn.execute(q, (relpath, name, next_serial))
@@ -69,6 +79,7 @@ class BaseConnection:
         if changes is None:
             data = self.get_raw_changelog_entry(serial)
             changes, rel_renames = loads(data)
+            changes = resolve_changes(self, changes)
             # make values in changes read only so no calling site accidentally
             # modifies data
             changes = ensure_deeply_readonly(changes)
@@ -280,6 +291,8 @@ def devpiserver_metrics(request):
     result = []
     xom = request.registry["xom"]
     storage = xom.keyfs._storage
+    # unwrap the storage if files are kept in a blob storage
+    storage = getattr(storage, 'storage', storage)
     if not isinstance(storage, BaseStorage):
         return result
     cache = getattr(storage, '_changelog_cache', None)
@@ -313,6 +326,7 @@ class Writer:
         # at __exit__ time we write out changes to the _changelog_cache
         # so we protect here against the caller modifying the value later
         value = get_mutable_deepcopy(value)
+        value = encode_value(self.conn, typedkey.relpath, back_serial, value)
         self.changes[typedkey.relpath] = (typedkey.name, back_serial, value)
 
     def __enter__(self):
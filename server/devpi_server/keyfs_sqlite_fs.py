@@ -1,12 +1,17 @@
 from .config import hookimpl
+from .filetiers import FileTiers
+from .filetiers import parse_size
 from .fileutil import BytesForHardlink
 from .keyfs_sqlite import BaseConnection
 from .keyfs_sqlite import BaseStorage
+from .keyfs_delta import encode_value
 from .log import threadlog, thread_push_log, thread_pop_log
 from .readonly import ReadonlyView
 from .readonly import get_mutable_deepcopy
 from .fileutil import get_write_file_ensure_dir, rename, loads
 from hashlib import sha256
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import errno
 import os
 import re
@@ -18,6 +23,8 @@ import time
 class DirtyFile(object):
     def __init__(self, path, content):
         self.path = path
+        # future of the fdatasync in the background if durability is enabled
+        self.synced = None
         # use hash of path, pid and thread id to prevent conflicts
         key = "%s%i%i" % (
             path, os.getpid(), threading.current_thread().ident)
@@ -38,10 +45,16 @@ class DirtyFile(object):
                     # another thread tries to create the same folder
                     if e.errno != errno.EEXIST:
                         raise
-            os.link(content.devpi_srcpath, self.tmppath)
-        else:
-            with get_write_file_ensure_dir(self.tmppath) as f:
-                f.write(content)
+            try:
+                os.link(content.devpi_srcpath, self.tmppath)
+                return
+            except OSError as e:
+                # for example if the source is on another file system
+                threadlog.warn(
+                    "could not hard link %s, writing a copy: %s",
+                    content.devpi_srcpath, e)
+        with get_write_file_ensure_dir(self.tmppath) as f:
+            f.write(content)
 
 
 class Connection(BaseConnection):
@@ -53,6 +66,24 @@ class Connection(BaseConnection):
         path = self._basedir.join(path).strpath
         if path in self.dirty_files:
             raise RuntimeError("Can't access file %s directly during transaction" % path)
+        return self._hot_path(path)
+
+    def io_file_stored_path(self, path):
+        """ Like io_file_os_path, but with tiered storage the file isn't
+        fetched into the cache. The copy in the cold directory is returned
+        instead, for tools like devpi-fsck which read each file once. """
+        path = self._basedir.join(path).strpath
+        if path in self.dirty_files:
+            raise RuntimeError("Can't access file %s directly during transaction" % path)
+        tiers = self.storage.tiers
+        if tiers is not None:
+            return tiers.stored_path(path)
+        return path
+
+    def _hot_path(self, path):
+        tiers = self.storage.tiers
+        if tiers is not None:
+            tiers.fetch(path)
         return path
 
     def io_file_exists(self, path):
@@ -62,12 +93,18 @@ class Connection(BaseConnection):
             if dirty_file is None:
                 return False
             path = dirty_file.tmppath
+        elif self.storage.tiers is not None:
+            return self.storage.tiers.exists(path)
         return os.path.exists(path)
 
     def io_file_set(self, path, content):
         path = self._basedir.join(path).strpath
         assert not path.endswith("-tmp")
-        self.dirty_files[path] = DirtyFile(path, content)
+        dirty_file = DirtyFile(path, content)
+        if self.storage.fsync_pool is not None:
+            dirty_file.synced = self.storage.fsync_pool.submit(
+                fsync_file, dirty_file.tmppath)
+        self.dirty_files[path] = dirty_file
 
     def io_file_open(self, path):
         path = self._basedir.join(path).strpath
@@ -76,6 +113,8 @@ class Connection(BaseConnection):
             if dirty_file is None:
                 raise IOError()
             path = dirty_file.tmppath
+        else:
+            path = self._hot_path(path)
         return open(path, "rb")
 
     def io_file_get(self, path):
@@ -85,6 +124,8 @@ class Connection(BaseConnection):
             if dirty_file is None:
                 raise IOError()
             path = dirty_file.tmppath
+        else:
+            path = self._hot_path(path)
         with open(path, "rb") as f:
             return f.read()
 
@@ -95,6 +136,11 @@ class Connection(BaseConnection):
             if dirty_file is None:
                 return None
             path = dirty_file.tmppath
+        elif self.storage.tiers is not None:
+            try:
+                return self.storage.tiers.getsize(path)
+            except OSError:
+                return None
         try:
             return os.path.getsize(path)
         except OSError:
@@ -114,7 +160,13 @@ class Connection(BaseConnection):
         pending_renames = write_dirty_files(self.dirty_files)
         basedir = str(self.storage.basedir)
         rel_renames = list(make_rel_renames(basedir, pending_renames))
+        if self.storage.fsync:
+            sync_dirty_files(basedir, self.dirty_files)
         files_commit, files_del = commit_renames(basedir, rel_renames)
+        if self.storage.fsync:
+            fsync_dirs(basedir, self.dirty_files)
+        if self.storage.tiers is not None:
+            self.storage.tiers.commit(files_commit, files_del)
         message = "wrote files without increasing serial: "
         args = []
         if files_commit:
@@ -131,6 +183,18 @@ class Storage(BaseStorage):
     Connection = Connection
     db_filename = ".sqlite"
 
+    def __init__(self, basedir, notify_on_commit, cache_size,
+                 cold_dir=None, hot_cache_size=None, fsync=False):
+        self.fsync = fsync
+        self.fsync_pool = None
+        if fsync:
+            self.fsync_pool = ThreadPoolExecutor(
+                thread_name_prefix="fsync")
+        self.tiers = None
+        if cold_dir is not None:
+            self.tiers = FileTiers(basedir, cold_dir, hot_cache_size)
+        BaseStorage.__init__(self, basedir, notify_on_commit, cache_size)
+
     def perform_crash_recovery(self):
         # get last changes and verify all renames took place
         with self.get_connection() as conn:
@@ -138,7 +202,24 @@ class Storage(BaseStorage):
                 return
             data = conn.get_raw_changelog_entry(conn.last_changelog_serial)
         changes, rel_renames = loads(data)
+        if self.tiers is not None:
+            # committed files might have been evicted from the cache
+            for relpath in rel_renames:
+                suffix = tmpsuffix_for_path(relpath)
+                if suffix is not None:
+                    self.tiers.fetch(
+                        os.path.join(str(self.basedir), relpath[:-len(suffix)]))
         check_pending_renames(str(self.basedir), rel_renames)
+        if self.tiers is not None:
+            files_commit = []
+            files_del = []
+            for relpath in rel_renames:
+                suffix = tmpsuffix_for_path(relpath)
+                if suffix is None:
+                    files_del.append(relpath)
+                else:
+                    files_commit.append(relpath[:-len(suffix)])
+            self.tiers.commit(files_commit, files_del)
 
     def ensure_tables_exist(self):
         if self.sqlpath.exists():
@@ -164,10 +245,30 @@ class Storage(BaseStorage):
 
 @hookimpl
 def devpiserver_storage_backend(settings):
+    storage = Storage
+    kw = {}
+    if settings and settings.get("cold_dir"):
+        from .main import fatal
+        if not settings.get("hot_cache_size"):
+            fatal("The 'cold_dir' storage setting requires 'hot_cache_size'.")
+        try:
+            hot_cache_size = parse_size(settings["hot_cache_size"])
+        except ValueError as e:
+            fatal("%s" % e)
+        kw["cold_dir"] = os.path.expanduser(settings["cold_dir"])
+        kw["hot_cache_size"] = hot_cache_size
+    if settings and str(settings.get("fsync", "")).lower() in ("1", "yes", "true"):
+        kw["fsync"] = True
+    if kw:
+        storage = partial(Storage, **kw)
     return dict(
-        storage=Storage,
+        storage=storage,
         name="sqlite",
-        description="SQLite backend with files on the filesystem",
+        description="SQLite backend with files on the filesystem. "
+                    "With the cold_dir and hot_cache_size settings all files "
+                    "are kept in cold_dir and the server directory only "
+                    "caches the recently used ones. With fsync=yes "
+                    "files are synced to disk on commit",
         _test_markers=["storage_with_filesystem"])
 
 
@@ -190,6 +291,7 @@ class FSWriter:
         # at __exit__ time we write out changes to the _changelog_cache
         # so we protect here against the caller modifying the value later
         value = get_mutable_deepcopy(value)
+        value = encode_value(self.conn, typedkey.relpath, back_serial, value)
         self.changes[typedkey.relpath] = (typedkey.name, back_serial, value)
 
     def __enter__(self):
@@ -228,6 +330,9 @@ class FSWriter:
         rel_renames = list(
             make_rel_renames(basedir, pending_renames)
         )
+        if self.storage.fsync:
+            # the changelog entry must only reference files on disk
+            sync_dirty_files(basedir, self.conn.dirty_files)
         entry = self.changes, rel_renames
         self.conn.write_changelog_entry(self.next_serial, entry)
         self.conn.commit()
@@ -237,10 +342,59 @@ class FSWriter:
         #   renames from the changelog entry, and
         # - initialize next_serial from the max committed serial + 1
         files_commit, files_del = commit_renames(basedir, rel_renames)
+        if self.storage.fsync:
+            fsync_dirs(basedir, self.conn.dirty_files)
+        if self.storage.tiers is not None:
+            self.storage.tiers.commit(files_commit, files_del)
         self.storage.last_commit_timestamp = time.time()
         return list(self.changes), files_commit, files_del
 
 
+def fsync_file(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        getattr(os, "fdatasync", os.fsync)(fd)
+    finally:
+        os.close(fd)
+
+
+def fsync_dirs(basedir, dirty_files):
+    """ fsync the directories of the dirty files and their parents up to
+    basedir, each only once for all files of a commit. """
+    if sys.platform == "win32":
+        # directories can't be opened for syncing on windows
+        return
+    dirs = set()
+    for path in dirty_files:
+        dirpath = os.path.dirname(path)
+        while dirpath.startswith(basedir) and dirpath not in dirs:
+            dirs.add(dirpath)
+            dirpath = os.path.dirname(dirpath)
+    for dirpath in sorted(dirs):
+        try:
+            fd = os.open(dirpath, os.O_RDONLY)
+        except OSError:
+            # removed in the meantime
+            continue
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def sync_dirty_files(basedir, dirty_files):
+    """ wait until the content of all dirty files is on disk and sync the
+    directories containing them. """
+    for dirty_file in dirty_files.values():
+        if dirty_file is None:
+            continue
+        if dirty_file.synced is None:
+            fsync_file(dirty_file.tmppath)
+        else:
+            dirty_file.synced.result()
+    fsync_dirs(basedir, dirty_files)
+
+
 def drop_dirty_files(dirty_files):
     for path, dirty_file in dirty_files.items():
         if dirty_file is not None:
@@ -219,6 +219,18 @@ class XOM:
             results.update(features)
         return tuple(sorted(results))
 
+    @cached_property
+    def changelog_batch_cache(self):
+        """ encoded changelog batches served to replicas. """
+        from devpi_server.replica import ChangelogBatchCache
+        return ChangelogBatchCache()
+
+    @cached_property
+    def credentials_cache(self):
+        """ successful password validations of users. """
+        from devpi_server.auth import CredentialsCache
+        return CredentialsCache(self.config.credentials_cache_ttl)
+
     @cached_property
     def model(self):
         """ root model object. """
@@ -260,7 +272,9 @@ class XOM:
             self.config.serverdir,
             self.config.storage,
             readonly=self.is_replica(),
-            cache_size=self.config.args.keyfs_cache_size)
+            cache_size=self.config.args.keyfs_cache_size,
+            file_dedup=self.config.file_dedup,
+            blob_storage=self.config.blob_storage)
         add_keys(self, keyfs)
         try:
             keyfs.finalize_init()
@@ -1,8 +1,12 @@
 from __future__ import unicode_literals
+import copy
 import getpass
+import hashlib
 import posixpath
 import sys
+import threading
 import py
+import weakref
 import re
 import json
 from devpi_common.metadata import get_latest_version
@@ -11,6 +15,7 @@ from devpi_common.metadata import splitbasename, parse_version
 from devpi_common.url import URL
 from devpi_common.validation import validate_metadata, normalize_name
 from devpi_common.types import ensure_unicode, cached_property, parse_hash_spec
+from collections import OrderedDict
 try:
     from itertools import zip_longest
 except ImportError:
@@ -19,10 +24,11 @@ try:
     from pyramid.authorization import Allow, Authenticated, Everyone
 except ImportError:
     from pyramid.security import Allow, Authenticated, Everyone
+from repoze.lru import LRUCache
 from time import gmtime, strftime
 from .auth import hash_password, verify_and_update_password_hash
 from .config import hookimpl
-from .filestore import FileEntry
+from .filestore import FileEntry, get_dist_info_metadata
 from .log import threadlog, thread_current_log
 from .readonly import get_mutable_deepcopy
 
@@ -115,11 +121,169 @@ class NonVolatile(ModelException):
     link = None  # the conflicting link
 
 
+class StageCache:
+    """ per-process cache of stage objects.
+
+    Creating a stage needs a deep copy of the user config and a lookup of
+    the customizer class, so stages for read transactions are created once
+    per index config.  Every transaction gets its own shallow copy, so
+    attributes like ``offline`` set by one user of a stage don't leak
+    into other threads. """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._stages = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _get_bound_stages(self, tx):
+        local = self._local
+        tx_ref = getattr(local, "tx_ref", None)
+        if tx_ref is None or tx_ref() is not tx:
+            local.tx_ref = weakref.ref(tx)
+            local.stages = {}
+        return local.stages
+
+    def get(self, tx, name, ixconfig):
+        bound_stages = self._get_bound_stages(tx)
+        stage = bound_stages.get(name)
+        if stage is not None and stage.ixconfig == ixconfig:
+            return stage
+        entry = self._stages.get(name)
+        if entry is None or entry[0] != ixconfig:
+            self.misses += 1
+            return None
+        self.hits += 1
+        stage = entry[1].bind_copy()
+        bound_stages[name] = stage
+        return stage
+
+    def put(self, tx, name, ixconfig, stage):
+        with self._lock:
+            self._stages[name] = (get_mutable_deepcopy(ixconfig), stage)
+        stage = stage.bind_copy()
+        self._get_bound_stages(tx)[name] = stage
+        return stage
+
+
+class SROCache:
+    """ per-process cache of the names of the base stages in the stage
+    resolution order of each stage.
+
+    An entry computed at one serial stays valid for later serials as long
+    as no user config changed in between, which is tracked through the
+    ``on_userchange`` subscriber. """
+
+    def __init__(self, keyfs):
+        self.keyfs = keyfs
+        self.user_change_serial = -1
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, name, at_serial):
+        entry = self._entries.get(name)
+        if entry is not None:
+            (serial, stages) = entry
+            if serial == at_serial:
+                self.hits += 1
+                return stages
+            if serial < at_serial and self.user_change_serial <= serial:
+                # only valid if all user changes up to at_serial were seen
+                event_serial = self.keyfs.notifier.read_event_serial()
+                if event_serial >= at_serial and self.user_change_serial <= serial:
+                    self.hits += 1
+                    return stages
+        self.misses += 1
+
+    def put(self, name, at_serial, stages):
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None or entry[0] < at_serial:
+                self._entries[name] = (at_serial, stages)
+
+    def invalidate(self, serial):
+        with self._lock:
+            self.user_change_serial = max(self.user_change_serial, serial)
+            self._entries = dict(
+                (name, entry) for name, entry in self._entries.items()
+                if entry[0] >= serial)
+
+
+class SimpleLinksCache:
+    """ per-process cache of the merged and sorted simple links of
+    projects on private stages which only inherit from private stages.
+
+    Entries are validated like in the ``SROCache``, additionally the
+    serial of the last change of the simple links of a project on any
+    stage is tracked through the ``on_changed_simplelinks`` subscriber.
+    Only the most recently changed projects are tracked, for all others
+    the serial of the last change which was dropped is used. """
+
+    def __init__(self, keyfs, size=1000):
+        self.keyfs = keyfs
+        self.user_change_serial = -1
+        # ordered by the serial of the last change
+        self.project_change_serials = OrderedDict()
+        self.project_change_floor_serial = -1
+        self.max_changed_projects = size * 10
+        self.hits = 0
+        self.misses = 0
+        self._entries = LRUCache(size)  # is thread safe
+        self._lock = threading.Lock()
+
+    def get(self, name, project, at_serial):
+        entry = self._entries.get((name, project))
+        if entry is not None:
+            (serial, links) = entry
+            if serial == at_serial:
+                self.hits += 1
+                return links
+            if serial < at_serial and self._unchanged_since(project, serial):
+                # only valid if all changes up to at_serial were seen
+                event_serial = self.keyfs.notifier.read_event_serial()
+                if event_serial >= at_serial and self._unchanged_since(project, serial):
+                    self.hits += 1
+                    return links
+        self.misses += 1
+
+    def _unchanged_since(self, project, serial):
+        return (
+            self.user_change_serial <= serial
+            and self.project_change_serials.get(
+                project, self.project_change_floor_serial) <= serial)
+
+    def put(self, name, project, at_serial, links):
+        entry = self._entries.get((name, project))
+        if entry is None or entry[0] < at_serial:
+            self._entries.put((name, project), (at_serial, links))
+
+    def invalidate_project(self, project, serial):
+        with self._lock:
+            serials = self.project_change_serials
+            serial = max(
+                serials.pop(project, self.project_change_floor_serial), serial)
+            serials[project] = serial
+            while len(serials) > self.max_changed_projects:
+                (_, dropped_serial) = serials.popitem(last=False)
+                self.project_change_floor_serial = max(
+                    self.project_change_floor_serial, dropped_serial)
+
+    def invalidate(self, serial):
+        with self._lock:
+            self.user_change_serial = max(self.user_change_serial, serial)
+
+
 class RootModel:
     """ per-process root model object. """
     def __init__(self, xom):
         self.xom = xom
         self.keyfs = xom.keyfs
+        self.sro_cache = SROCache(xom.keyfs)
+        self.stage_cache = StageCache()
+        self.simplelinks_cache = SimpleLinksCache(xom.keyfs)
 
     def create_user(self, username, password, **kwargs):
         userlist = self.keyfs.USERLIST.get(readonly=False)
@@ -410,10 +574,26 @@ class User:
             customizer_cls=customizer_cls)
 
     def getstage(self, indexname):
-        ixconfig = self.get()["indexes"].get(indexname, {})
+        tx = self.keyfs.tx
+        if tx.write:
+            # stages might be modified, so they aren't shared
+            ixconfig = self.get()["indexes"].get(indexname, {})
+            if not ixconfig:
+                return None
+            return self._getstage(indexname, ixconfig["type"], ixconfig)
+        ixconfig = self.key.get().get("indexes", {}).get(indexname)
         if not ixconfig:
             return None
-        return self._getstage(indexname, ixconfig["type"], ixconfig)
+        stage_cache = self.xom.model.stage_cache
+        name = "%s/%s" % (self.name, indexname)
+        stage = stage_cache.get(tx, name, ixconfig)
+        if stage is None:
+            stage = stage_cache.put(
+                tx, name, ixconfig,
+                self._getstage(
+                    indexname, ixconfig["type"],
+                    get_mutable_deepcopy(ixconfig)))
+        return stage
 
     def getstages(self):
         stages = []
@@ -574,6 +754,133 @@ class UnknownCustomizer(BaseStageCustomizer):
     get_principals_for_del_verdata = get_principals_for_index_modify
 
 
+def get_projectname_shard(project):
+    return hashlib.sha256(project.encode('utf-8')).hexdigest()[:2]
+
+
+class ProjectNames:
+    """ the set of project names of a stage.
+
+    The names are distributed over up to 256 PROJNAMESSHARD keys, so
+    adding or removing a project only writes one small set to the
+    changelog. The PROJNAMESSHARDS key records which shards are in use.
+    Names from the old single PROJNAMES key are still read and are moved
+    into the shards with the first write to the stage. """
+
+    def __init__(self, keyfs, user, index):
+        self.keyfs = keyfs
+        self.user = user
+        self.index = index
+        self.key_legacy = keyfs.PROJNAMES(user=user, index=index)
+        self.key_shards = keyfs.PROJNAMESSHARDS(user=user, index=index)
+
+    def key_shard(self, shard):
+        return self.keyfs.PROJNAMESSHARD(
+            user=self.user, index=self.index, shard=shard)
+
+    def key_project_shard(self, project):
+        return self.key_shard(get_projectname_shard(project))
+
+    def __contains__(self, project):
+        if project in self.key_project_shard(project).get():
+            return True
+        return project in self.key_legacy.get()
+
+    def get(self):
+        names = set(self.key_legacy.get())
+        for shard in self.key_shards.get():
+            names.update(self.key_shard(shard).get())
+        return names
+
+    def _migrate(self):
+        names = self.key_legacy.get()
+        if not names:
+            return
+        threadlog.info(
+            "moving %s project names of %s/%s into shards",
+            len(names), self.user, self.index)
+        by_shard = {}
+        for name in names:
+            by_shard.setdefault(get_projectname_shard(name), set()).add(name)
+        with self.key_shards.update() as shards:
+            shards.update(by_shard)
+        for shard, shard_names in by_shard.items():
+            with self.key_shard(shard).update() as projects:
+                projects.update(shard_names)
+        self.key_legacy.delete()
+
+    def add(self, project):
+        """ add project and return whether it was missing before. """
+        self._migrate()
+        shard = get_projectname_shard(project)
+        key = self.key_shard(shard)
+        projects = key.get(readonly=False)
+        if project in projects:
+            return False
+        projects.add(project)
+        key.set(projects)
+        shards = self.key_shards.get(readonly=False)
+        if shard not in shards:
+            shards.add(shard)
+            self.key_shards.set(shards)
+        return True
+
+    def discard(self, project):
+        """ remove project and return whether it existed. """
+        if project not in self:
+            return False
+        self._migrate()
+        key = self.key_project_shard(project)
+        projects = key.get(readonly=False)
+        if project not in projects:
+            return False
+        projects.remove(project)
+        key.set(projects)
+        return True
+
+    def delete(self):
+        for shard in self.key_shards.get():
+            self.key_shard(shard).delete()
+        if self.key_shards.exists():
+            self.key_shards.delete()
+        if self.key_legacy.exists():
+            self.key_legacy.delete()
+
+    def get_last_serial_and_value_at(self, at_serial, project=None):
+        """ return tuple of last serial and set of names at at_serial.
+
+        Returns None if there never were any names and the set is None
+        if the names were deleted together with the index. If project
+        is given, only the shard containing it is looked at. """
+        tx = self.keyfs.tx
+        legacy_info = tx.get_last_serial_and_value_at(
+            self.key_legacy, at_serial, raise_on_error=False)
+        info = tx.get_last_serial_and_value_at(
+            self.key_shards, at_serial, raise_on_error=False)
+        if info is None:
+            # nothing moved into shards yet
+            return legacy_info
+        (last_serial, shards) = info
+        if shards is None:
+            return info
+        if project is None:
+            keys = [self.key_shard(shard) for shard in shards]
+        else:
+            keys = [self.key_project_shard(project)]
+        names = set()
+        for key in keys:
+            info = tx.get_last_serial_and_value_at(
+                key, at_serial, raise_on_error=False)
+            if info is None or info[1] is None:
+                continue
+            last_serial = max(last_serial, info[0])
+            names.update(info[1])
+        if legacy_info is not None:
+            last_serial = max(last_serial, legacy_info[0])
+            names.update(legacy_info[1] or ())
+        return (last_serial, names)
+
+
 class BaseStage(object):
     InvalidIndex = InvalidIndex
     InvalidIndexconfig = InvalidIndexconfig
@@ -597,6 +904,12 @@ class BaseStage(object):
         self.keyfs = xom.keyfs
         self.filestore = xom.filestore
 
+    def bind_copy(self):
+        """ return a shallow copy with its own customizer. """
+        stage = copy.copy(self)
+        stage.customizer = self.customizer.__class__(stage)
+        return stage
+
     def get_indexconfig_from_kwargs(self, **kwargs):
         """Normalizes values and validates keys.
 
@@ -771,25 +1084,49 @@ class BaseStage(object):
             versions.update(res)
         return self.filter_versions(project, versions)
 
+    def _filters_versions(self):
+        customizer_cls = self.customizer.__class__
+        return (
+            customizer_cls.get_versions_filter_iter
+            is not BaseStageCustomizer.get_versions_filter_iter)
+
     def get_latest_version(self, name, stable=False):
-        return get_latest_version(
-            self.filter_versions(
-                name, self.list_versions(name)),
-            stable=stable)
+        if self._filters_versions():
+            return get_latest_version(
+                self.filter_versions(
+                    name, self.list_versions(name)),
+                stable=stable)
+        kind = "stable" if stable else "latest"
+        versions = []
+        for stage, res in self.op_sro_check_mirror_whitelist(
+                "get_latest_versions_perstage", project=name):
+            if res[kind] is not None:
+                versions.append(res[kind])
+        return get_latest_version(versions)
 
     def get_latest_version_perstage(self, name, stable=False):
-        return get_latest_version(
-            self.filter_versions(
-                name, self.list_versions_perstage(name)),
-            stable=stable)
+        if self._filters_versions():
+            return get_latest_version(
+                self.filter_versions(
+                    name, self.list_versions_perstage(name)),
+                stable=stable)
+        kind = "stable" if stable else "latest"
+        return self.get_latest_versions_perstage(name)[kind]
+
+    def get_latest_versions_perstage(self, project):
+        """ Return a dict with the ``latest`` and ``stable`` version of
+        project on this stage without applying customizer filters. """
+        versions = self.list_versions_perstage(project)
+        return dict(
+            latest=get_latest_version(versions),
+            stable=get_latest_version(versions, stable=True))
 
     def get_last_project_change_serial_perstage(self, project, at_serial=None):
         tx = self.keyfs.tx
         if at_serial is None:
             at_serial = tx.at_serial
-        info = tx.get_last_serial_and_value_at(
-            self.key_projects,
-            at_serial, raise_on_error=False)
+        info = self.key_projects.get_last_serial_and_value_at(
+            at_serial, project=project)
         if info is None:
             # never existed
             return -1
@@ -842,6 +1179,14 @@ class BaseStage(object):
         and "key" is usually the basename of the link or else
         the egg-ID if the link points to an egg.
         """
+        tx = self.keyfs.tx
+        cacheable = sorted_links and not tx.write and self._results_cacheable()
+        if cacheable:
+            project = normalize_name(project)
+            cache = self.model.simplelinks_cache
+            all_links = cache.get(self.name, project, tx.at_serial)
+            if all_links is not None:
+                return list(all_links)
         all_links = []
         seen = set()
 
@@ -862,8 +1207,62 @@ class BaseStage(object):
         if sorted_links:
             all_links = [(v.key, v.href, v.require_python, v.yanked)
                         for v in sorted(map(SimplelinkMeta, all_links), reverse=True)]
+        if cacheable:
+            cache.put(self.name, project, tx.at_serial, tuple(all_links))
         return all_links
 
+    def get_dist_info_metadata_perstage(self, project):
+        """ Return a dict mapping the relpath of release files to the
+        hash_spec of their PEP 658 metadata file. """
+        data = self.key_projsimplelinks(normalize_name(project)).get()
+        return data.get("dist_info_metadata", {})
+
+    def _results_cacheable(self):
+        # mirrors fetch their links on demand and customizers and
+        # devpiserver_sro_skip may filter depending on the current request,
+        # otherwise results only change with the database
+        if self.xom.config.hook.devpiserver_sro_skip.get_hookimpls():
+            return False
+        for stage in self.sro():
+            if stage.ixconfig["type"] == "mirror":
+                return False
+            customizer_cls = stage.customizer.__class__
+            for name in (
+                    "get_projects_filter_iter",
+                    "get_simple_links_filter_iter",
+                    "get_versions_filter_iter"):
+                if getattr(customizer_cls, name) is not getattr(BaseStageCustomizer, name):
+                    return False
+        return True
+
+    def get_sro_change_serials(self, project=None):
+        """ Return a list of (stage name, last change serial) tuples for
+        all stages in the stage resolution order, or None if results of
+        this stage can change without a change in the database.
+
+        If a project is given, the serials are those of the simple links
+        of the project, so changes to other projects don't matter.
+        Otherwise the per-stage serial key is used, and None is returned
+        if a stage wasn't changed since that key was introduced, as
+        finding the serial would require a walk over the whole stage. """
+        if not self._results_cacheable():
+            return None
+        tx = self.keyfs.tx
+        serials = []
+        for stage in self.sro():
+            if project is None:
+                info = tx.get_last_serial_and_value_at(
+                    stage.key_lastchange, tx.at_serial, raise_on_error=False)
+                if info is None or info[1] is None:
+                    return None
+                serials.append((stage.name, info[0]))
+            else:
+                info = tx.get_last_serial_and_value_at(
+                    stage.key_projsimplelinks(project), tx.at_serial,
+                    raise_on_error=False)
+                serials.append((stage.name, -1 if info is None else info[0]))
+        return serials
+
     def get_whitelist_inheritance(self):
         return self.ixconfig.get("mirror_whitelist_inheritance", "union")
 
@@ -1015,6 +1414,30 @@ class BaseStage(object):
 
     def sro(self):
         """ return stage resolution order. """
+        tx = self.keyfs.tx
+        # changed user configs in a running write transaction aren't
+        # known to the cache and devpiserver_sro_skip may depend on the
+        # current request
+        cacheable = (
+            not any(key.name == "USER" for key in tx.dirty)
+            and not self.xom.config.hook.devpiserver_sro_skip.get_hookimpls())
+        names = None
+        if cacheable:
+            names = self.model.sro_cache.get(self.name, tx.at_serial)
+        if names is None:
+            stages = list(self._sro())[1:]
+            if cacheable:
+                self.model.sro_cache.put(
+                    self.name, tx.at_serial, [x.name for x in stages])
+        else:
+            # the stage objects come from the stage cache, which binds
+            # them to the current transaction
+            stages = filter(None, (self.model.getstage(x) for x in names))
+        yield self
+        for stage in stages:
+            yield stage
+
+    def _sro(self):
         todo = [self]
         todo_mirrors = []
         seen = set()
@@ -1089,7 +1512,7 @@ class PrivateStage(BaseStage):
     def __init__(self, xom, username, index, ixconfig, customizer_cls):
         super(PrivateStage, self).__init__(
             xom, username, index, ixconfig, customizer_cls)
-        self.key_projects = self.keyfs.PROJNAMES(user=username, index=index)
+        self.key_projects = ProjectNames(self.keyfs, username, index)
 
     def get_possible_indexconfig_keys(self):
         return tuple(dict(self.get_default_config_items())) + (
@@ -1155,6 +1578,14 @@ class PrivateStage(BaseStage):
             user=self.username, index=self.index,
             project=normalize_name(project), version=version)
 
+    @property
+    def key_lastchange(self):
+        return self.keyfs.STAGELASTCHANGE(user=self.username, index=self.index)
+
+    def key_projlatest(self, project):
+        return self.keyfs.PROJLATEST(user=self.username,
+            index=self.index, project=normalize_name(project))
+
     def _set_versiondata(self, metadata):
         project = normalize_name(metadata["name"])
         version = metadata["version"]
@@ -1167,26 +1598,39 @@ class PrivateStage(BaseStage):
         if version not in versions:
             versions.add(version)
             self.key_projversions(project).set(versions)
+            self._set_latest_versions(project, versions)
         self.add_project_name(project)
 
+    def _set_latest_versions(self, project, versions):
+        self.key_projlatest(project).set(dict(
+            latest=get_latest_version(versions),
+            stable=get_latest_version(versions, stable=True)))
+
+    def get_latest_versions_perstage(self, project):
+        latest = self.key_projlatest(project).get()
+        if not latest:
+            # projects stored before the key was introduced
+            return super(PrivateStage, self).get_latest_versions_perstage(
+                project)
+        return latest
+
     def add_project_name(self, project):
         project = normalize_name(project)
-        projects = self.key_projects.get(readonly=False)
-        if project not in projects:
+        if project not in self.key_projects:
             if self.customizer.readonly:
                 raise ReadonlyIndex("index is marked read only")
-            projects.add(project)
-            self.key_projects.set(projects)
+            self.key_projects.add(project)
 
     def del_project(self, project):
         project = normalize_name(project)
         for version in list(self.key_projversions(project).get()):
             self.del_versiondata(project, version, cleanup=False)
         self._regen_simplelinks(project)
-        with self.key_projects.update() as projects:
-            projects.remove(project)
+        if not self.key_projects.discard(project):
+            raise KeyError(project)
         threadlog.info("deleting project %s", project)
         self.key_projversions(project).delete()
+        self.key_projlatest(project).delete()
 
     def del_versiondata(self, project, version, cleanup=True):
         project = normalize_name(project)
@@ -1202,6 +1646,7 @@ class PrivateStage(BaseStage):
         versions.remove(version)
         self.key_projversion(project, version).delete()
         self.key_projversions(project).set(versions)
+        self._set_latest_versions(project, versions)
         if cleanup:
             if not versions:
                 self.del_project(project)
@@ -1238,6 +1683,7 @@ class PrivateStage(BaseStage):
         project = normalize_name(project_input)
         links = []
         requires_python = []
+        dist_info_metadata = {}
         for version in self.list_versions_perstage(project):
             linkstore = self.get_linkstore_perstage(project, version)
             releases = linkstore.get_links("releasefile")
@@ -1245,14 +1691,19 @@ class PrivateStage(BaseStage):
             require_python = self.get_versiondata_perstage(project,
                     version).get('requires_python')
             requires_python.extend([require_python] * len(releases))
+            for link in releases:
+                if link.linkdict.get("dist_info_metadata"):
+                    dist_info_metadata[link.relpath] = link.dist_info_metadata
         data_dict = {u"links":links, u"requires_python":requires_python}
+        if dist_info_metadata:
+            data_dict[u"dist_info_metadata"] = dist_info_metadata
         self.key_projsimplelinks(project).set(data_dict)
 
     def list_projects_perstage(self):
         return self.key_projects.get()
 
     def has_project_perstage(self, project):
-        return normalize_name(project) in self.list_projects_perstage()
+        return normalize_name(project) in self.key_projects
 
     def store_releasefile(self, project, version, filename, content,
                           last_modified=None):
@@ -1275,6 +1726,9 @@ class PrivateStage(BaseStage):
                 basename=filename,
                 file_content=content,
                 last_modified=last_modified)
+        metadata = get_dist_info_metadata(filename, content)
+        if metadata is not None:
+            linkstore.set_dist_info_metadata(link, metadata)
         self._regen_simplelinks(project)
         return link
 
@@ -1324,12 +1778,17 @@ class PrivateStage(BaseStage):
         tx = self.keyfs.tx
         if at_serial is None:
             at_serial = tx.at_serial
-        try:
-            (last_serial, projects) = tx.get_last_serial_and_value_at(
-                self.key_projects, at_serial)
-        except KeyError:
+        info = tx.get_last_serial_and_value_at(
+            self.key_lastchange, at_serial, raise_on_error=False)
+        if info is not None and info[1] is not None:
+            return info[0]
+        # the stage wasn't changed since the key was introduced
+        info = self.key_projects.get_last_serial_and_value_at(at_serial)
+        if info is None or info[1] is None:
             last_serial = -1
             projects = ()
+        else:
+            (last_serial, projects) = info
         if last_serial >= at_serial:
             return last_serial
         for project in projects:
@@ -1496,6 +1955,14 @@ class LinkStore:
             link.add_log('overwrite', None, count=overwrite + 1)
         return link
 
+    def set_dist_info_metadata(self, link, content):
+        """ store the PEP 658 metadata file of the release file link. """
+        md_entry = self.filestore.store_dist_info_metadata(link.entry, content)
+        if md_entry is None:
+            return
+        link.linkdict["dist_info_metadata"] = md_entry.hash_spec
+        self._mark_dirty()
+
     def new_reflink(self, rel, file_content, for_entrypath):
         if isinstance(for_entrypath, ELink):
             for_entrypath = for_entrypath.entrypath
@@ -1515,6 +1982,10 @@ class LinkStore:
         del_links = self.get_links(rel=rel, basename=basename, for_entrypath=for_entrypath)
         was_deleted = []
         for link in del_links:
+            if link.linkdict.get("dist_info_metadata"):
+                md_entry = self.filestore.get_dist_info_metadata_entry(link.entry)
+                if md_entry is not None:
+                    md_entry.delete()
             link.entry.delete()
             linkdicts.remove(link.linkdict)
             was_deleted.append(link.entrypath)
@@ -1621,16 +2092,55 @@ def add_keys(xom, keyfs):
     # type "stage" related
     keyfs.add_key("PROJSIMPLELINKS", "{user}/{index}/{project}/.simple", dict)
     keyfs.add_key("PROJVERSIONS", "{user}/{index}/{project}/.versions", set)
+    keyfs.add_key("PROJLATEST", "{user}/{index}/{project}/.latest", dict)
     keyfs.add_key("PROJVERSION", "{user}/{index}/{project}/{version}/.config", dict)
     keyfs.add_key("PROJNAMES", "{user}/{index}/.projects", set)
+    keyfs.add_key("PROJNAMESSHARD", "{user}/{index}/.projects.{shard}", set)
+    keyfs.add_key("PROJNAMESSHARDS", "{user}/{index}/.projectshards", set)
     keyfs.add_key("STAGEFILE",
                   "{user}/{index}/+f/{hashdir_a}/{hashdir_b}/{filename}", dict)
+    keyfs.add_key("STAGELASTCHANGE", "{user}/{index}/.lastchange", int)
+    # relpaths of all file entries with the same content
+    keyfs.add_key("FILEBLOB", "+blobs/{sha256}", set)
 
     sub = EventSubscribers(xom)
     keyfs.PROJVERSION.on_key_change(sub.on_changed_version_config)
     keyfs.STAGEFILE.on_key_change(sub.on_changed_file_entry)
     keyfs.MIRRORNAMESINIT.on_key_change(sub.on_mirror_initialnames)
     keyfs.USER.on_key_change(sub.on_userchange)
+    keyfs.PROJSIMPLELINKS.on_key_change(sub.on_changed_simplelinks)
+    keyfs.subscribe_on_commit(mark_changed_stages)
+
+
+def mark_changed_stages(tx):
+    """ set the STAGELASTCHANGE key of each private stage changed in the
+    transaction to the serial of the commit. """
+    keyfs = tx.keyfs
+    changed = set()
+    for key in tx.dirty:
+        if key.name == "STAGELASTCHANGE":
+            continue
+        params = key.params
+        if key.name == "USER":
+            try:
+                old = tx.get_original(key).get("indexes", {})
+            except KeyError:
+                old = {}
+            new = tx.get(key).get("indexes", {})
+            for index in set(old).union(new):
+                if old.get(index) != new.get(index):
+                    changed.add((params["user"], index))
+        elif "user" in params and "index" in params:
+            changed.add((params["user"], params["index"]))
+    for (user, index) in changed:
+        ixconfig = tx.get(keyfs.USER(user=user)).get("indexes", {}).get(index)
+        key = keyfs.STAGELASTCHANGE(user=user, index=index)
+        if ixconfig is None:
+            # the stage was deleted
+            if tx.exists(key):
+                tx.delete(key)
+        elif ixconfig["type"] != "mirror":
+            tx.set(key, tx.at_serial + 1)
 
 
 class EventSubscribers:
@@ -1708,8 +2218,15 @@ class EventSubscribers:
                     projectnames=stage.list_projects_perstage()
                 )
 
+    def on_changed_simplelinks(self, ev):
+        """ when the simple links of a project on a stage change. """
+        self.xom.model.simplelinks_cache.invalidate_project(
+            ev.typedkey.params["project"], ev.at_serial)
+
     def on_userchange(self, ev):
         """ when user data changes. """
+        self.xom.model.sro_cache.invalidate(ev.at_serial)
+        self.xom.model.simplelinks_cache.invalidate(ev.at_serial)
         params = ev.typedkey.params
         username = params.get("user")
         keyfs = self.xom.keyfs
@@ -1735,3 +2252,19 @@ class EventSubscribers:
                 if name not in old_indexes:
                     stage = user.getstage(name)
                     self.xom.config.hook.devpiserver_stage_created(stage=stage)
+
+
+@hookimpl
+def devpiserver_metrics(request):
+    model = request.registry["xom"].model
+    sro_cache = model.sro_cache
+    stage_cache = model.stage_cache
+    simplelinks_cache = model.simplelinks_cache
+    return [
+        ('devpi_server_sro_cache_hits', 'counter', sro_cache.hits),
+        ('devpi_server_sro_cache_misses', 'counter', sro_cache.misses),
+        ('devpi_server_sro_cache_size', 'gauge', len(sro_cache._entries)),
+        ('devpi_server_stage_cache_hits', 'counter', stage_cache.hits),
+        ('devpi_server_stage_cache_misses', 'counter', stage_cache.misses),
+        ('devpi_server_simplelinks_cache_hits', 'counter', simplelinks_cache.hits),
+        ('devpi_server_simplelinks_cache_misses', 'counter', simplelinks_cache.misses)]
@@ -1,10 +1,13 @@
+import io
 import os
 import contextlib
 import itsdangerous
+import json
 import secrets
 import threading
 import time
 import traceback
+from collections import OrderedDict
 from functools import partial
 from pluggy import HookimplMarker
 from pyramid.httpexceptions import HTTPNotFound, HTTPAccepted, HTTPBadRequest
@@ -21,9 +24,12 @@ from . import mythread
 from .config import hookimpl
 from .filestore import FileEntry
 from .fileutil import BytesForHardlink, dumps, loads
+from .keyfs import RelpathInfo
+from .keyfs_delta import is_delta
 from .log import thread_push_log, threadlog
 from .views import H_MASTER_UUID, make_uuid_headers
 from .model import UpstreamError
+from .readonly import get_mutable_deepcopy
 
 
 devpiweb_hookimpl = HookimplMarker("devpiweb")
@@ -33,6 +39,7 @@ H_REPLICA_UUID = str("X-DEVPI-REPLICA-UUID")
 H_REPLICA_OUTSIDE_URL = str("X-DEVPI-REPLICA-OUTSIDE-URL")
 H_REPLICA_FILEREPL = str("X-DEVPI-REPLICA-FILEREPL")
 H_EXPECTED_MASTER_ID = str("X-DEVPI-EXPECTED-MASTER-ID")
+H_REPLICA_DELTAS = str("X-DEVPI-REPLICA-DELTAS")
 
 MAX_REPLICA_BLOCK_TIME = 30.0
 REPLICA_USER_NAME = "+replica"
@@ -40,6 +47,8 @@ REPLICA_REQUEST_TIMEOUT = MAX_REPLICA_BLOCK_TIME * 1.25
 REPLICA_MULTIPLE_TIMEOUT = REPLICA_REQUEST_TIMEOUT / 2
 REPLICA_AUTH_MAX_AGE = REPLICA_REQUEST_TIMEOUT + 0.1
 MAX_REPLICA_CHANGES_SIZE = 5 * 1024 * 1024
+MAX_BUNDLE_FILES = 1000
+MAX_CHANGELOG_BATCH_CACHE_SIZE = 20 * MAX_REPLICA_CHANGES_SIZE
 
 
 notset = object()
@@ -100,6 +109,7 @@ class MasterChangelogRequest:
     MAX_REPLICA_BLOCK_TIME = MAX_REPLICA_BLOCK_TIME
     MAX_REPLICA_CHANGES_SIZE = MAX_REPLICA_CHANGES_SIZE
     REPLICA_MULTIPLE_TIMEOUT = REPLICA_MULTIPLE_TIMEOUT
+    MAX_BUNDLE_FILES = MAX_BUNDLE_FILES
 
     def __init__(self, request):
         self.request = request
@@ -151,6 +161,12 @@ class MasterChangelogRequest:
             raise HTTPForbidden(
                 "Authenticated identity '%r' isn't from replica." % identity)
 
+    def verify_replica(self):
+        # the newer endpoints are only available to authenticated replicas
+        self.verify_master()
+        if not isinstance(self.request.identity, ReplicaIdentity):
+            raise HTTPForbidden("Only available for replicas.")
+
     @view_config(route_name="/+changelog/{serial}")
     def get_changes(self):
         # this method is called from all replica servers
@@ -173,6 +189,10 @@ class MasterChangelogRequest:
             self._wait_for_serial(serial)
 
             raw_entry = keyfs.tx.conn.get_raw_changelog_entry(serial)
+            if not self.accepts_deltas:
+                (changes, rel_renames) = loads(raw_entry)
+                changes = self._resolve_deltas(serial, changes)
+                raw_entry = dumps((changes, rel_renames))
 
             devpi_serial = keyfs.get_current_serial()
             r = Response(body=raw_entry, status=200, headers={
@@ -191,28 +211,141 @@ class MasterChangelogRequest:
             keyfs = self.xom.keyfs
             self._wait_for_serial(start_serial)
             devpi_serial = keyfs.get_current_serial()
-            all_changes = []
-            raw_size = 0
-            start_time = time.time()
-            for serial in range(start_serial, devpi_serial + 1):
-                raw_entry = keyfs.tx.conn.get_raw_changelog_entry(serial)
-                raw_size += len(raw_entry)
-                (changes, rel_renames) = loads(raw_entry)
-                all_changes.append((serial, changes))
-                now = time.time()
-                if raw_size > self.MAX_REPLICA_CHANGES_SIZE:
-                    threadlog.debug('Changelog raw size %s' % raw_size)
-                    break
-                if (now - start_time) > (self.REPLICA_MULTIPLE_TIMEOUT):
-                    threadlog.debug('Changelog timeout %s' % raw_size)
-                    break
-            raw_entry = dumps(all_changes)
+            # replicas catching up at the same time request the same
+            # batches, so they are only built once
+            deltas = self.accepts_deltas
+            raw_entry = self.xom.changelog_batch_cache.get_or_build(
+                (start_serial, deltas),
+                partial(
+                    self._build_changes_batch,
+                    start_serial, devpi_serial, deltas))
             r = Response(body=raw_entry, status=200, headers={
                 str("Content-Type"): str("application/octet-stream"),
                 str("X-DEVPI-SERIAL"): str(devpi_serial),
             })
             return r
 
+    @view_config(route_name="/+files-manifest")
+    def get_files_manifest(self):
+        # streams one json list per line with relpath, hash_spec, size and
+        # serial of all current files, so a replica can find the files
+        # it is missing in one pass
+        self.verify_replica()
+
+        keyfs = self.xom.keyfs
+        serial = keyfs.get_current_serial()
+        keys = (keyfs.get_key('PYPIFILE_NOMD5'), keyfs.get_key('STAGEFILE'))
+
+        def iter_manifest():
+            # the transaction of the request is already finished
+            # when the response is streamed
+            with keyfs.transaction(write=False, at_serial=serial) as tx:
+                for item in tx.iter_current_relpaths(keys):
+                    if item.value is None:
+                        continue
+                    key = keyfs.get_key_instance(item.keyname, item.relpath)
+                    entry = FileEntry(key, item.value)
+                    if not entry.last_modified:
+                        continue
+                    # the file metadata has no size
+                    size = tx.conn.io_file_size(entry._storepath)
+                    line = json.dumps([
+                        item.relpath, entry.hash_spec, size, item.serial])
+                    yield line.encode('utf-8') + b'\n'
+
+        return Response(app_iter=iter_manifest(), status=200, headers={
+            str("Content-Type"): str("application/x-ndjson"),
+            str("X-DEVPI-SERIAL"): str(serial),
+        })
+
+    @view_config(
+        route_name="/+files-bundle", request_method="POST", is_mutating=False)
+    def get_files_bundle(self):
+        # streams the content of the requested files, each preceded by a
+        # json line with the relpath and size, the size is null if the
+        # file doesn't exist
+        self.verify_replica()
+
+        try:
+            relpaths = self.request.json_body
+        except ValueError:
+            raise HTTPBadRequest("could not decode json")
+        if not isinstance(relpaths, list):
+            raise HTTPBadRequest("expected list of relpaths")
+        if len(relpaths) > self.MAX_BUNDLE_FILES:
+            raise HTTPBadRequest(
+                "at most %s files per bundle" % self.MAX_BUNDLE_FILES)
+
+        keyfs = self.xom.keyfs
+        serial = keyfs.get_current_serial()
+        file_keynames = frozenset(('PYPIFILE_NOMD5', 'STAGEFILE'))
+
+        def iter_bundle():
+            # the transaction of the request is already finished
+            # when the response is streamed
+            with keyfs.transaction(write=False, at_serial=serial) as tx:
+                for relpath in relpaths:
+                    storepath = "+files/%s" % relpath
+                    size = None
+                    # only serve paths of known file keys
+                    try:
+                        key = tx.derive_key(relpath)
+                    except KeyError:
+                        key = None
+                    if key is not None and key.name in file_keynames:
+                        if tx.conn.io_file_exists(storepath):
+                            size = tx.conn.io_file_size(storepath)
+                    line = json.dumps([relpath, size])
+                    yield line.encode('utf-8') + b'\n'
+                    if size is None:
+                        continue
+                    with tx.conn.io_file_open(storepath) as f:
+                        remaining = size
+                        while remaining > 0:
+                            data = f.read(min(65536, remaining))
+                            if not data:
+                                raise RuntimeError(
+                                    "file %s changed during bundle" % relpath)
+                            remaining -= len(data)
+                            yield data
+
+        return Response(app_iter=iter_bundle(), status=200, headers={
+            str("Content-Type"): str("application/octet-stream"),
+            str("X-DEVPI-SERIAL"): str(serial),
+        })
+
+    @property
+    def accepts_deltas(self):
+        return self.request.headers.get(H_REPLICA_DELTAS) == "1"
+
+    def _resolve_deltas(self, serial, changes):
+        # older replicas only understand full values
+        if any(is_delta(x[2]) for x in changes.values()):
+            changes = get_mutable_deepcopy(
+                self.xom.keyfs.tx.conn.get_changes(serial))
+        return changes
+
+    def _build_changes_batch(self, start_serial, devpi_serial, deltas=True):
+        keyfs = self.xom.keyfs
+        all_changes = []
+        raw_size = 0
+        start_time = time.time()
+        for serial in range(start_serial, devpi_serial + 1):
+            raw_entry = keyfs.tx.conn.get_raw_changelog_entry(serial)
+            raw_size += len(raw_entry)
+            (changes, rel_renames) = loads(raw_entry)
+            if not deltas:
+                changes = self._resolve_deltas(serial, changes)
+            all_changes.append((serial, changes))
+            now = time.time()
+            if raw_size > self.MAX_REPLICA_CHANGES_SIZE:
+                threadlog.debug('Changelog raw size %s' % raw_size)
+                break
+            if (now - start_time) > (self.REPLICA_MULTIPLE_TIMEOUT):
+                threadlog.debug('Changelog timeout %s' % raw_size)
+                break
+        return dumps(all_changes)
+
     def _wait_for_serial(self, serial):
         keyfs = self.xom.keyfs
         next_serial = keyfs.get_next_serial()
@@ -232,6 +365,67 @@ class MasterChangelogRequest:
         return serial
 
 
+class ChangelogBatchCache:
+    """ Memory bounded LRU cache of encoded changelog batches keyed by
+    their start serial and whether they may contain delta records.
+
+    Changelog entries never change after they are committed, so a cached
+    batch stays valid, it just might end before the current serial. """
+
+    def __init__(self, max_size=MAX_CHANGELOG_BATCH_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._batches = OrderedDict()
+        self._building = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self._batches.get(key)
+            if data is not None:
+                self._batches.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.max_size:
+            return
+        with self._lock:
+            old = self._batches.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._batches[key] = data
+            self.size += len(data)
+            while self.size > self.max_size:
+                (key, evicted) = self._batches.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def get_or_build(self, key, build):
+        data = self.get(key)
+        if data is not None:
+            self.hits += 1
+            return data
+        with self._lock:
+            lock = self._building.setdefault(key, threading.Lock())
+        # concurrent requests for the same batch wait for the first one
+        with lock:
+            data = self.get(key)
+            if data is not None:
+                self.hits += 1
+                return data
+            self.misses += 1
+            try:
+                data = build()
+                self.put(key, data)
+            finally:
+                with self._lock:
+                    self._building.pop(key, None)
+        return data
+
+
 class ReplicaThread:
     H_REPLICA_FILEREPL = H_REPLICA_FILEREPL
     H_REPLICA_UUID = H_REPLICA_UUID
@@ -295,6 +489,18 @@ class ReplicaThread:
         self._master_serial = serial
         self._master_serial_timestamp = now
 
+    def get_master_request_headers(self):
+        config = self.xom.config
+        uuid, master_uuid = make_uuid_headers(config.nodeinfo)
+        assert uuid != master_uuid
+        token = self.auth_serializer.dumps(uuid)
+        return {
+            H_REPLICA_UUID: uuid,
+            H_EXPECTED_MASTER_ID: master_uuid,
+            H_REPLICA_OUTSIDE_URL: config.args.outside_url,
+            H_REPLICA_DELTAS: "1",
+            str('Authorization'): 'Bearer %s' % token}
+
     def fetch(self, handler, url):
         if self.initial_fetch:
             url = URL(url)
@@ -306,20 +512,13 @@ class ReplicaThread:
         log = self.log
         config = self.xom.config
         log.info("fetching %s", url)
-        uuid, master_uuid = make_uuid_headers(config.nodeinfo)
-        assert uuid != master_uuid
         try:
             self.master_contacted_at = time.time()
-            token = self.auth_serializer.dumps(uuid)
             r = self.session.get(
                 url,
                 allow_redirects=False,
                 auth=self.master_auth,
-                headers={
-                    H_REPLICA_UUID: uuid,
-                    H_EXPECTED_MASTER_ID: master_uuid,
-                    H_REPLICA_OUTSIDE_URL: config.args.outside_url,
-                    str('Authorization'): 'Bearer %s' % token},
+                headers=self.get_master_request_headers(),
                 timeout=self.REPLICA_REQUEST_TIMEOUT)
         except Exception as e:
             msg = ''.join(traceback.format_exception_only(e.__class__, e)).strip()
@@ -460,9 +659,15 @@ class FileReplicationSharedData(object):
         self.Empty = Empty
         self.xom = xom
         self.queue = PriorityQueue()
+        # files of projects requested by clients are processed first
+        self.demand_queue = PriorityQueue()
         self.error_queue = PriorityQueue()
         self.deleted = LRUCache(100)
         self.index_types = LRUCache(1000)
+        self.demanded_projects = LRUCache(100)
+        self.demand_bumps = 0
+        self._queued_by_project = {}
+        self._queued_by_project_lock = threading.Lock()
         self.errors = ReplicationErrors()
         self.importer = ImportFileReplica(self.xom, self.errors)
         self._replica_in_sync_cv = threading.Condition()
@@ -484,10 +689,63 @@ class FileReplicationSharedData(object):
             self.index_types.put(stage.name, stage.ixconfig['type'])
             is_from_mirror = self.is_from_mirror(key)
         # note the negated serial for the PriorityQueue
-        self.queue.put((
+        self.put((
             is_from_mirror, -serial, key.relpath, key.name, val, back_serial))
+
+    def _get_project(self, info):
+        value = info[4]
+        if not value:
+            return None
+        project = value.get('project')
+        if project:
+            return normalize_name(project)
+
+    def put(self, info):
+        project = self._get_project(info)
+        if project is not None:
+            if self.demanded_projects.get(project):
+                self.demand_queue.put(info)
+                self.last_added = time.time()
+                return
+            with self._queued_by_project_lock:
+                queued = self._queued_by_project.setdefault(project, {})
+                queued[info[2]] = info
+        self.queue.put(info)
         self.last_added = time.time()
 
+    def _discard_queued(self, info):
+        project = self._get_project(info)
+        if project is None:
+            return
+        with self._queued_by_project_lock:
+            queued = self._queued_by_project.get(project)
+            if queued is None or queued.get(info[2]) is not info:
+                return
+            del queued[info[2]]
+            if not queued:
+                del self._queued_by_project[project]
+
+    def demand(self, project):
+        """ Called when a client requested something of the project.
+
+        Already queued files of the project are moved to the front and
+        files of the project added later go there directly. """
+        project = normalize_name(project)
+        self.demanded_projects.put(project, True)
+        with self._queued_by_project_lock:
+            queued = self._queued_by_project.pop(project, None)
+        if not queued:
+            return
+        threadlog.info(
+            "Moving %s queued files of %s to front of queue",
+            len(queued), project)
+        # the items stay in the regular queue as well, because we can't
+        # remove them from there, but they are skipped quickly once the
+        # file exists
+        for info in queued.values():
+            self.demand_queue.put(info)
+        self.demand_bumps += len(queued)
+
     def next_ts(self, delay):
         return time.time() + delay
 
@@ -541,14 +799,20 @@ class FileReplicationSharedData(object):
             self.last_processed = time.time()
 
     def process_next(self, handler):
+        queue = self.demand_queue
         try:
-            # it seems like without the timeout this isn't triggered frequent
-            # enough, the thread was waiting a long time even though there
-            # were already/still items in the queue
-            info = self.queue.get(timeout=self.QUEUE_TIMEOUT)
+            info = queue.get_nowait()
         except self.Empty:
-            # when the regular queue is empty, we retry previously errored ones
-            return self.process_next_errored(handler)
+            queue = self.queue
+            try:
+                # it seems like without the timeout this isn't triggered frequent
+                # enough, the thread was waiting a long time even though there
+                # were already/still items in the queue
+                info = queue.get(timeout=self.QUEUE_TIMEOUT)
+            except self.Empty:
+                # when the regular queue is empty, we retry previously errored ones
+                return self.process_next_errored(handler)
+            self._discard_queued(info)
         (is_from_mirror, serial, key, keyname, value, back_serial) = info
         # negate again, because it was negated for the PriorityQueue
         serial = -serial
@@ -560,10 +824,11 @@ class FileReplicationSharedData(object):
                     traceback.format_exception_only(e.__class__, e)).strip())
             self.add_errored(is_from_mirror, serial, key, keyname, value, back_serial)
         finally:
-            self.queue.task_done()
+            queue.task_done()
             self.last_processed = time.time()
 
     def wait(self, error_queue=False):
+        self.demand_queue.join()
         self.queue.join()
         if error_queue:
             self.error_queue.join()
@@ -573,6 +838,13 @@ class FileReplicationSharedData(object):
 def devpiserver_metrics(request):
     result = []
     xom = request.registry["xom"]
+    if xom.is_master():
+        batch_cache = xom.changelog_batch_cache
+        result.extend([
+            ('devpi_server_changelog_batch_cache_evictions', 'counter', batch_cache.evictions),
+            ('devpi_server_changelog_batch_cache_hits', 'counter', batch_cache.hits),
+            ('devpi_server_changelog_batch_cache_misses', 'counter', batch_cache.misses),
+            ('devpi_server_changelog_batch_cache_size', 'gauge', batch_cache.size)])
     replica_thread = getattr(xom, 'replica_thread', None)
     if not isinstance(replica_thread, ReplicaThread):
         return result
@@ -584,6 +856,9 @@ def devpiserver_metrics(request):
     result.extend([
         ('devpi_server_replica_file_download_queue_size', 'gauge', shared_data.queue.qsize()),
         ('devpi_server_replica_file_download_error_queue_size', 'gauge', shared_data.error_queue.qsize()),
+        ('devpi_server_replica_file_download_demand_queue_size', 'gauge', shared_data.demand_queue.qsize()),
+        ('devpi_server_replica_file_download_demand_bumps', 'counter', shared_data.demand_bumps),
+        ('devpi_server_replica_file_download_queued_projects', 'gauge', len(shared_data._queued_by_project)),
         ('devpi_server_replica_deleted_cache_evictions', 'counter', deleted_cache.evictions),
         ('devpi_server_replica_deleted_cache_hits', 'counter', deleted_cache.hits),
         ('devpi_server_replica_deleted_cache_lookups', 'counter', deleted_cache.lookups),
@@ -601,6 +876,8 @@ def includeme(config):
     # config.add_request_method(devpi_token_utility, reify=True)
     config.add_route("/+changelog/{serial}", r"/+changelog/{serial:\d+}")
     config.add_route("/+changelog/{serial}-", r"/+changelog/{serial:\d+}-")
+    config.add_route("/+files-manifest", "/+files-manifest")
+    config.add_route("/+files-bundle", "/+files-bundle")
     config.scan("devpi_server.replica")
 
 
@@ -711,27 +988,43 @@ class FileReplicationThread:
 
 
 class InitialQueueThread(object):
+    # small files are fetched from master in bundles instead of
+    # separate requests
+    BUNDLE_MAX_FILE_SIZE = 1024 * 1024
+    BUNDLE_MAX_FILES = 200
+    BUNDLE_MAX_SIZE = 20 * 1024 * 1024
+
     def __init__(self, xom, shared_data):
         self.xom = xom
         self.shared_data = shared_data
+        self.session = self.xom.new_http_session("replica")
 
     def thread_run(self):
         thread_push_log("[FREPQ]")
-        keyfs = self.xom.keyfs
         threadlog.info("Queuing files for possible download from master")
-        keys = (keyfs.get_key('PYPIFILE_NOMD5'), keyfs.get_key('STAGEFILE'))
-        last_time = time.time()
-        processed = 0
-        queued = 0
         # wait until we are in sync for the first time
         with self.shared_data._replica_in_sync_cv:
             self.shared_data._replica_in_sync_cv.wait()
+        self.queue_missing_files()
+
+    def queue_missing_files(self):
+        keyfs = self.xom.keyfs
+        last_time = time.time()
+        processed = 0
+        queued = 0
+        bundled = 0
+        bundle = []
+        bundle_size = 0
+        use_bundles = self.xom.config.replica_file_search_path is None
         with keyfs.transaction(write=False) as tx:
             for user in self.xom.model.get_userlist():
                 for stage in user.getstages():
                     self.shared_data.index_types.put(stage.name, stage.ixconfig['type'])
-            relpaths = tx.iter_relpaths_at(keys, tx.at_serial)
-            for item in relpaths:
+            existing = self.get_existing_relpaths(tx)
+            items = self.iter_manifest_items(tx, existing)
+            if items is None:
+                items = self.iter_changelog_items(tx)
+            for item, size in items:
                 if item.value is None:
                     continue
                 while self.shared_data.queue.qsize() > 1000:
@@ -740,23 +1033,137 @@ class InitialQueueThread(object):
                 if time.time() - last_time > 5:
                     last_time = time.time()
                     threadlog.info(
-                        "Processed a total of %s files and queued %s so far."
-                        % (processed, queued))
+                        "Processed a total of %s files, fetched %s in bundles "
+                        "and queued %s so far." % (processed, bundled, queued))
                 processed = processed + 1
                 key = keyfs.get_key_instance(item.keyname, item.relpath)
                 entry = FileEntry(key, item.value)
-                if entry.file_exists() or not entry.last_modified:
+                if not entry.last_modified:
+                    continue
+                if self.file_exists(tx, existing, entry.relpath):
                     continue
-                is_from_mirror = self.shared_data.is_from_mirror(key, False)
-                # note the negated serial for the PriorityQueue
-                # the index_type boolean will prioritize non mirrors
-                self.shared_data.queue.put((
-                    is_from_mirror, -item.serial, item.relpath,
-                    item.keyname, item.value, item.back_serial))
-                queued = queued + 1
+                if use_bundles and size is not None and size <= self.BUNDLE_MAX_FILE_SIZE:
+                    bundle.append(item)
+                    bundle_size += size
+                    if len(bundle) >= self.BUNDLE_MAX_FILES or bundle_size >= self.BUNDLE_MAX_SIZE:
+                        failed = self.import_bundle(bundle)
+                        bundled += len(bundle) - len(failed)
+                        queued += self.queue_items(failed)
+                        bundle = []
+                        bundle_size = 0
+                    continue
+                queued += self.queue_items([item])
+            if bundle:
+                failed = self.import_bundle(bundle)
+                bundled += len(bundle) - len(failed)
+                queued += self.queue_items(failed)
         threadlog.info(
-            "Queued %s of %s files for possible download from master"
-            % (queued, processed))
+            "Fetched %s files in bundles and queued %s of %s files for "
+            "possible download from master" % (bundled, queued, processed))
+
+    def queue_items(self, items):
+        for item in items:
+            key = self.xom.keyfs.get_key_instance(item.keyname, item.relpath)
+            is_from_mirror = self.shared_data.is_from_mirror(key, False)
+            # note the negated serial for the PriorityQueue
+            # the index_type boolean will prioritize non mirrors
+            self.shared_data.put((
+                is_from_mirror, -item.serial, item.relpath,
+                item.keyname, item.value, item.back_serial))
+        return len(items)
+
+    def import_bundle(self, items):
+        try:
+            return self.shared_data.importer.import_bundle(items, self.session)
+        except Exception as e:
+            msg = ''.join(traceback.format_exception_only(e.__class__, e)).strip()
+            threadlog.warn("error fetching bundle of files: %s", msg)
+            return items
+
+    def get_existing_relpaths(self, tx):
+        # with files on the file system a single directory scan is
+        # much faster than checking each file separately
+        files_path = tx.conn.io_file_os_path("+files")
+        if files_path is None:
+            return None
+        if getattr(tx.conn.storage, "tiers", None) is not None:
+            # files evicted from the local cache are only in the cold
+            # directory, so each file has to be checked separately
+            return None
+        existing = set()
+        for dirpath, dirnames, filenames in os.walk(files_path):
+            reldir = os.path.relpath(dirpath, files_path).replace(os.sep, '/')
+            for filename in filenames:
+                if filename.endswith("-tmp"):
+                    continue
+                if reldir == '.':
+                    existing.add(filename)
+                else:
+                    existing.add("%s/%s" % (reldir, filename))
+        return existing
+
+    def file_exists(self, tx, existing, relpath):
+        if existing is None:
+            return tx.conn.io_file_exists("/".join(("+files", relpath)))
+        return relpath in existing
+
+    def iter_changelog_items(self, tx):
+        keyfs = self.xom.keyfs
+        keys = (keyfs.get_key('PYPIFILE_NOMD5'), keyfs.get_key('STAGEFILE'))
+        for item in tx.iter_relpaths_at(keys, tx.at_serial):
+            yield (item, None)
+
+    def iter_manifest_items(self, tx, existing):
+        """ Returns tuples of file info and size from the manifest of the
+        master for the files which don't exist locally, or None if the
+        master doesn't provide one. """
+        replica_thread = self.xom.replica_thread
+        url = replica_thread.master_url.joinpath("+files-manifest").url
+        try:
+            r = self.session.get(
+                url,
+                allow_redirects=False,
+                auth=replica_thread.master_auth,
+                headers=replica_thread.get_master_request_headers(),
+                stream=True,
+                timeout=replica_thread.REPLICA_REQUEST_TIMEOUT)
+        except Exception as e:
+            msg = ''.join(traceback.format_exception_only(e.__class__, e)).strip()
+            threadlog.warn("error fetching %s: %s", url, msg)
+            return None
+        if r.status_code != 200:
+            threadlog.warn(
+                "%s %s: no file manifest from master, "
+                "falling back to checking changelog", r.status_code, r.reason)
+            r.close()
+            return None
+        return self._iter_manifest_items(tx, r, existing)
+
+    def _iter_manifest_items(self, tx, r, existing):
+        with contextlib.closing(r):
+            for line in r.iter_lines():
+                if not line:
+                    continue
+                (relpath, hash_spec, size, serial) = json.loads(line)
+                if serial > tx.at_serial:
+                    # will be queued when the change is imported
+                    continue
+                if self.file_exists(tx, existing, relpath):
+                    # checked before the change is read, as most files
+                    # usually exist already
+                    continue
+                change = tx.conn.get_changes(serial).get(relpath)
+                if change is None:
+                    threadlog.warn(
+                        "file %s from manifest not found at serial %s",
+                        relpath, serial)
+                    continue
+                (keyname, back_serial, value) = change
+                item = RelpathInfo(
+                    relpath=relpath, keyname=keyname,
+                    serial=serial, back_serial=back_serial,
+                    value=value)
+                yield (item, size)
 
 
 class SimpleLinksChanged:
@@ -906,6 +1313,7 @@ class ImportFileReplica:
         self.errors = errors
         self.file_search_path = self.xom.config.replica_file_search_path
         self.use_hard_links = self.xom.config.hard_links
+        self.file_dedup = self.xom.config.file_dedup
         self.uuid, master_uuid = make_uuid_headers(xom.config.nodeinfo)
         assert self.uuid != master_uuid
 
@@ -933,6 +1341,20 @@ class ImportFileReplica:
         else:
             threadlog.info("path for existing file not found: %s", path)
 
+    def find_same_content_file(self, conn, serial, entry):
+        # another entry with the same content might already be replicated
+        with self.xom.keyfs.transaction(write=False, at_serial=serial):
+            path = entry.find_same_content_path(conn)
+        if path is None:
+            return
+        threadlog.info("checking file with same content: %s", path)
+        with open(path, "rb") as f:
+            data = BytesForHardlink(f.read())
+        if entry.check_checksum(data) is not None:
+            return
+        data.devpi_srcpath = path
+        return data
+
     def __call__(self, conn, serial, key, val, back_serial, session):
         threadlog.debug("ImportFileReplica for %s, %s", key, val)
         relpath = key.relpath
@@ -961,18 +1383,113 @@ class ImportFileReplica:
             else:
                 threadlog.error(str(err))
 
+        if self.file_dedup:
+            content = self.find_same_content_file(conn, serial, entry)
+            if content is not None:
+                conn.io_file_set(entry._storepath, content)
+                self.errors.remove(entry)
+                return
+
         threadlog.info(
             "retrieving file from master for serial %s: %s", serial, relpath)
         url = self.xom.config.master_url.joinpath(relpath).url
+        partial = self.xom.filestore.get_partial_download(entry)
+        offset = partial.open()
+        try:
+            content = self.fetch_content(
+                url, entry, partial, session, offset=offset)
+        except BaseException:
+            # keep what we got so far, the retry can continue from there
+            partial.keep()
+            raise
+        if content is None:
+            partial.discard()
+            return
+        err = entry.check_checksum(content)
+        partial.discard()
+        if err:
+            # the file we got is different, it may have changed later.
+            # we remember the error and move on
+            threadlog.error(
+                "checksum mismatch for '%s', will be retried later: "
+                "%s" % (relpath, err))
+            self.errors.add(dict(
+                url=url,
+                message=str(err),
+                relpath=entry.relpath))
+            return
+        # in case there were errors before, we can now remove them
+        self.errors.remove(entry)
+        conn.io_file_set(entry._storepath, content)
+
+    def import_bundle(self, items, session):
+        """ Fetch the files of items with a single request from master.
+
+        Returns the items which couldn't be imported, they have to be
+        fetched separately. """
+        keyfs = self.xom.keyfs
+        pending = {item.relpath: item for item in items}
+        url = self.xom.config.master_url.joinpath("+files-bundle").url
+        threadlog.info("retrieving bundle of %s files from master", len(items))
+        r = session.post(
+            url, json=list(pending), allow_redirects=False, stream=True,
+            headers=self.xom.replica_thread.get_master_request_headers(),
+            timeout=self.xom.config.args.request_timeout)
+        if r.status_code != 200:
+            threadlog.warn(
+                "%s %s: failed fetching bundle from master",
+                r.status_code, r.reason)
+            r.close()
+            return items
+        r.raw.decode_content = True
+        stream = io.BufferedReader(r.raw)
+        with contextlib.closing(r), keyfs._storage.get_connection(write=True) as conn:
+            try:
+                while pending:
+                    line = stream.readline()
+                    if not line:
+                        break
+                    (relpath, size) = json.loads(line)
+                    if size is None:
+                        continue
+                    content = stream.read(size)
+                    if len(content) != size:
+                        break
+                    item = pending.get(relpath)
+                    if item is None:
+                        continue
+                    key = keyfs.get_key_instance(item.keyname, relpath)
+                    entry = self.xom.filestore.get_file_entry_from_key(
+                        key, meta=item.value)
+                    err = entry.check_checksum(content)
+                    if err:
+                        threadlog.error(
+                            "checksum mismatch for '%s' in bundle: %s",
+                            relpath, err)
+                        continue
+                    conn.io_file_set(entry._storepath, content)
+                    self.errors.remove(entry)
+                    del pending[relpath]
+            finally:
+                # keep the files we got so far
+                conn.commit_files_without_increasing_serial()
+        return list(pending.values())
+
+    def fetch_content(self, url, entry, partial, session, offset=0):
+        relpath = entry.relpath
         # we perform the request with a special header so that
         # the master can avoid -getting "volatile" links
         token = self.auth_serializer.dumps(self.uuid)
+        headers = {
+            H_REPLICA_FILEREPL: str("YES"),
+            H_REPLICA_UUID: self.uuid,
+            str('Authorization'): 'Bearer %s' % token}
+        headers.update(partial.get_request_headers())
+        if offset:
+            threadlog.info(
+                "resuming download of %s at offset %s", relpath, offset)
         r = session.get(
-            url, allow_redirects=False,
-            headers={
-                H_REPLICA_FILEREPL: str("YES"),
-                H_REPLICA_UUID: self.uuid,
-                str('Authorization'): 'Bearer %s' % token},
+            url, allow_redirects=False, stream=True, headers=headers,
             timeout=self.xom.config.args.request_timeout)
         if r.status_code == 302:
             # mirrors might redirect to external file when
@@ -999,7 +1516,13 @@ class ImportFileReplica:
                 self.errors.remove(entry)
                 return
 
-        if r.status_code != 200:
+        if offset and r.status_code == 416:
+            # the partial data doesn't fit the file on master
+            r.close()
+            partial.restart()
+            return self.fetch_content(url, entry, partial, session)
+
+        if not partial.accept_response(r):
             threadlog.error(
                 "error downloading '%s' from master, will be retried later: "
                 "%s" % (relpath, r.reason))
@@ -1011,21 +1534,9 @@ class ImportFileReplica:
             # and raise for retrying later
             raise FileReplicationError(r, relpath)
 
-        err = entry.check_checksum(r.content)
-        if err:
-            # the file we got is different, it may have changed later.
-            # we remember the error and move on
-            threadlog.error(
-                "checksum mismatch for '%s', will be retried later: "
-                "%s" % (relpath, r.reason))
-            self.errors.add(dict(
-                url=r.url,
-                message=str(err),
-                relpath=entry.relpath))
-            return
-        # in case there were errors before, we can now remove them
-        self.errors.remove(entry)
-        conn.io_file_set(entry._storepath, r.content)
+        for data in r.iter_content(65536):
+            partial.write(data)
+        return partial.getvalue()
 
 
 class FileReplicationError(Exception):
@@ -1,5 +1,6 @@
 from __future__ import unicode_literals
 
+import hashlib
 import os
 import py
 import re
@@ -23,6 +24,7 @@ from pyramid.interfaces import IRootFactory
 from pyramid.interfaces import IRoutesMapper
 from pyramid.httpexceptions import HTTPException, HTTPFound, HTTPSuccessful
 from pyramid.httpexceptions import HTTPForbidden
+from pyramid.httpexceptions import HTTPNotModified
 from pyramid.httpexceptions import HTTPOk
 from pyramid.httpexceptions import HTTPUnauthorized
 from pyramid.httpexceptions import exception_response
@@ -34,14 +36,17 @@ from pyramid.threadlocal import RequestContext
 from pyramid.traversal import DefaultRootFactory
 from pyramid.view import exception_view_config
 from pyramid.view import view_config
+from urllib.parse import quote
 from urllib.parse import urlparse
+from uuid import uuid4
+from webob.static import FileIter
 import itertools
 import json
 from devpi_common.request import new_requests_session
 from devpi_common.validation import normalize_name, is_valid_archive_name
 
 from .config import hookimpl
-from .filestore import BadGateway
+from .filestore import BadGateway, get_dist_info_metadata
 from .model import InvalidIndex, InvalidIndexconfig, InvalidUser, InvalidUserconfig
 from .model import ReadonlyIndex
 from .model import RemoveValue
@@ -69,6 +74,9 @@ meta_headers = {str("X-DEVPI-API-VERSION"): str(API_VERSION),
 INSTALLER_USER_AGENT = r"([^ ]* )*(distribute|setuptools|pip|pex)/.*"
 INSTALLER_USER_AGENT_REGEXP = re.compile(INSTALLER_USER_AGENT)
 
+FILE_BLOCK_SIZE = 65536
+MAX_BYTE_RANGES = 100
+
 
 def abort(request, code, body):
     # if no Accept header is set, then force */*, otherwise the exception
@@ -134,6 +142,62 @@ def json_preferred(request):
     return "application/json" in request.headers.get("Accept", "")
 
 
+def parse_byte_ranges(header, size):
+    """ Return a list of (start, stop) tuples for the byte ranges in a
+    "Range" header value for a file of the given size, or None if the
+    header is invalid.  Unsatisfiable ranges are left out. """
+    (unit, sep, specs) = header.partition("=")
+    if unit.strip().lower() != "bytes" or not sep:
+        return None
+    ranges = []
+    for spec in specs.split(","):
+        (start, sep, end) = spec.strip().partition("-")
+        if not sep or not (start or end):
+            return None
+        if (start and not start.isdigit()) or (end and not end.isdigit()):
+            return None
+        if not start:
+            # suffix range with the number of bytes at the end
+            length = int(end)
+            if length:
+                ranges.append((max(size - length, 0), size))
+            continue
+        start = int(start)
+        stop = int(end) + 1 if end else size
+        if end and stop <= start:
+            return None
+        if start < size:
+            ranges.append((start, min(stop, size)))
+    return ranges
+
+
+def iter_multipart_byteranges(f, ranges, size, content_type, boundary):
+    """ Yield the parts of a multipart/byteranges body read from the
+    file-like object f and close it afterwards. """
+    try:
+        for (start, stop) in ranges:
+            yield multipart_byterange_header(
+                start, stop, size, content_type, boundary)
+            f.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                data = f.read(min(FILE_BLOCK_SIZE, remaining))
+                if not data:
+                    raise IOError("file shorter than expected")
+                remaining -= len(data)
+                yield data
+            yield b"\r\n"
+        yield ("--%s--\r\n" % boundary).encode("ascii")
+    finally:
+        f.close()
+
+
+def multipart_byterange_header(start, stop, size, content_type, boundary):
+    return (
+        "--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n" % (
+            boundary, content_type, start, stop - 1, size)).encode("ascii")
+
+
 class ContentTypePredicate(object):
     def __init__(self, val, config):
         self.val = val
@@ -524,6 +588,29 @@ class PyPIView:
             return True
         return False
 
+    def _check_etag(self, stage, *extra, project=None):
+        """ Answer with 304 if the ETag sent by the client still matches,
+        otherwise add the ETag to the response.
+
+        The ETag is derived from the change serials of all stages in the
+        stage resolution order, the request URL and the extra values,
+        which have to contain everything else the response depends on.
+        With a project only the serials of that project count. """
+        serials = stage.get_sro_change_serials(project=project)
+        if serials is None:
+            return
+        request = self.request
+        data = repr((serials, request.application_url, request.path_qs, extra))
+        etag = hashlib.sha256(data.encode("utf-8")).hexdigest()
+        if etag in request.if_none_match:
+            raise HTTPNotModified(headers={str("ETag"): str('"%s"' % etag)})
+
+        def add_etag(request, response):
+            if response.status_code == 200:
+                response.etag = etag
+
+        request.add_response_callback(add_etag)
+
     @view_config(route_name="/{user}/{index}/+simple/{project}")
     def simple_list_project_redirect(self):
         """
@@ -554,6 +641,9 @@ class PyPIView:
         stage = self.context.stage
         requested_by_installer = INSTALLER_USER_AGENT_REGEXP.match(
             request.user_agent or "")
+        self._check_etag(
+            stage, "simple", bool(requested_by_installer),
+            self._use_absolute_urls, project=project)
         try:
             result = stage.get_simplelinks(project, sorted_links=not requested_by_installer)
         except stage.UpstreamError as e:
@@ -562,6 +652,11 @@ class PyPIView:
 
         if not result:
             self.request.context.verified_project  # access will trigger 404 if not found
+        else:
+            replica_thread = getattr(self.xom, 'replica_thread', None)
+            if replica_thread is not None:
+                # files of the project are likely requested next
+                replica_thread.shared_data.demand(project)
 
         if requested_by_installer:
             # we don't need the extra stuff on the simple page for pip
@@ -613,6 +708,7 @@ class PyPIView:
             def make_url(href):
                 return url.relpath("/" + href)
 
+        dist_info_metadata = self._get_dist_info_metadata(project, result)
         for key, href, require_python, yanked in result:
             stage = "/".join(href.split("/", 2)[:2])
             attribs = 'href="%s"' % make_url(href)
@@ -620,12 +716,28 @@ class PyPIView:
                 attribs += ' data-requires-python="%s"' % escape(require_python)
             if yanked:
                 attribs += ' data-yanked=""'
+            md_hash_spec = dist_info_metadata.get(href.split("#", 1)[0])
+            if md_hash_spec:
+                # PEP 714 renamed the PEP 658 attribute, we emit both
+                attribs += ' data-dist-info-metadata="%s"' % escape(md_hash_spec)
+                attribs += ' data-core-metadata="%s"' % escape(md_hash_spec)
             data = dict(stage=stage, attribs=attribs, key=key)
             yield '{stage} <a {attribs}>{key}</a><br/>\n'.format(
                 **data).encode('utf-8')
 
         yield "</body></html>".encode("utf-8")
 
+    def _get_dist_info_metadata(self, project, result):
+        # only look at the stages the links belong to, the href of a
+        # link starts with the name of its stage
+        dist_info_metadata = {}
+        for name in set("/".join(x[1].split("/", 2)[:2]) for x in result):
+            stage = self.model.getstage(name)
+            if stage is not None:
+                dist_info_metadata.update(
+                    stage.get_dist_info_metadata_perstage(project))
+        return dist_info_metadata
+
     def _index_refresh_form(self, stage, project):
         url = self.request.route_url(
             "/{user}/{index}/+simple/{project}/refresh",
@@ -658,6 +770,7 @@ class PyPIView:
     def simple_list_all(self):
         self.log.info("starting +simple")
         stage = self.context.stage
+        self._check_etag(stage, "simple")
         try:
             stage_results = list(stage.list_projects())
         except stage.UpstreamError as e:
@@ -1140,6 +1253,7 @@ class PyPIView:
                       self.request.headers.items())
         perstage = 'ignore_bases' in self.request.GET
         context = self.context
+        self._check_etag(context.stage, "projectconfig")
         view_metadata = {}
         versions = context.list_versions(perstage=perstage)
         for version in versions:
@@ -1167,6 +1281,7 @@ class PyPIView:
 
     @view_config(route_name="/{user}/{index}/{project}/{version}", accept="application/json", request_method="GET")
     def version_get(self):
+        self._check_etag(self.context.stage, "versiondata")
         verdata = self.context.get_versiondata(perstage=False)
         view_verdata = self._make_view_verdata(verdata)
         apireturn(200, type="versiondata", result=view_verdata)
@@ -1249,11 +1364,103 @@ class PyPIView:
             return apireturn(502, e.args[0])
 
         headers = entry.gethttpheaders()
+        # allow replicas and clients to resume interrupted downloads
+        headers[str("accept-ranges")] = str("bytes")
         if self.request.method == "HEAD":
             return Response(headers=headers)
-        else:
-            content = entry.file_get_content()
-            return Response(body=content, headers=headers)
+        sendfile_headers = self._sendfile_headers(entry)
+        if sendfile_headers is not None:
+            # the web server in front sends the file itself
+            del headers[str("content-length")]
+            del headers[str("accept-ranges")]
+            headers.update(sendfile_headers)
+            return Response(headers=headers)
+        multipart_response = self._multipart_byteranges_response(
+            entry, headers)
+        if multipart_response is not None:
+            return multipart_response
+        # conditional_response lets webob answer single Range requests
+        return Response(
+            app_iter=self._file_app_iter(entry), headers=headers,
+            conditional_response=True)
+
+    def _multipart_byteranges_response(self, entry, headers):
+        """ Answer requests for multiple byte ranges, which webob doesn't
+        support.  Returns None if the request should get a normal
+        response instead, after changing the Range header of the request
+        to what webob should answer, as webob only looks at the first
+        range. """
+        request = self.request
+        range_header = request.headers.get("Range")
+        if not range_header or "," not in range_header:
+            return
+        if_range = request.headers.get("If-Range")
+        last_modified = headers.get(str("last-modified"))
+        if if_range is not None and (last_modified is None or if_range != last_modified):
+            # the file changed since the client got the other parts or
+            # we can't tell
+            request.range = None
+            return
+        size = int(headers[str("content-length")])
+        ranges = parse_byte_ranges(range_header, size)
+        if ranges is None or len(ranges) > MAX_BYTE_RANGES:
+            # invalid or too many ranges are ignored and the whole file
+            # is sent
+            request.range = None
+            return
+        if not ranges:
+            return Response(
+                status=416,
+                headers={str("content-range"): str("bytes */%d" % size)})
+        if len(ranges) == 1:
+            # the single satisfiable range is handled by webob
+            request.range = ranges[0]
+            return
+        content_type = headers.pop(str("content-type"))
+        boundary = uuid4().hex
+        headers[str("content-type")] = str(
+            "multipart/byteranges; boundary=%s" % boundary)
+        headers[str("content-length")] = str(sum(
+            len(multipart_byterange_header(
+                start, stop, size, content_type, boundary)) + stop - start + 2
+            for (start, stop) in ranges) + len(boundary) + 6)
+        app_iter = iter_multipart_byteranges(
+            entry.file_open_read(), ranges, size, content_type, boundary)
+        return Response(status=206, app_iter=app_iter, headers=headers)
+
+    def _sendfile_headers(self, entry):
+        sendfile_header = self.xom.config.sendfile_header
+        if sendfile_header is None:
+            return
+        if getattr(entry.tx.conn.storage, "tiers", None) is not None:
+            # the file could be evicted from the hot cache before the
+            # web server opens it
+            return
+        path = entry.file_os_path()
+        if path is None:
+            return
+        if sendfile_header == "x-sendfile":
+            return {str("X-Sendfile"): str(path)}
+        relpath = py.path.local(path).relto(self.xom.config.serverdir)
+        if not relpath:
+            return
+        uri = quote("/" + relpath.replace(os.sep, "/"), safe="/+")
+        return {str("X-Accel-Redirect"): str(uri)}
+
+    def _file_app_iter(self, entry):
+        request = self.request
+        path = entry.file_os_path()
+        if path is None:
+            # the storage backend doesn't keep files in the file system
+            return FileIter(entry.file_open_read())
+        f = open(path, "rb")
+        file_wrapper = request.environ.get("wsgi.file_wrapper")
+        if file_wrapper is None or request.range is not None:
+            # webob can only answer Range requests efficiently with
+            # iterators which support seeking
+            return FileIter(f)
+        # lets the server use sendfile or similar
+        return file_wrapper(f, FILE_BLOCK_SIZE)
 
     @view_config(route_name="/{user}/{index}/+e/{relpath:.*}")
     def mirror_pkgserv(self):
@@ -1300,6 +1507,7 @@ class PyPIView:
     @view_config(route_name="/{user}/{index}", accept="application/json", request_method="GET")
     def index_get(self):
         stage = self.context.stage
+        self._check_etag(stage, "indexconfig")
         result = dict(stage.ixconfig)
         # double negation :(
         add_projects = 'no_projects' not in self.request.GET
@@ -1429,28 +1637,55 @@ def _headers_from_response(r):
 
 
 def iter_cache_remote_file(xom, entry):
-    # we get and cache the file and some http headers from remote
-    r = xom.httpget(entry.url, allow_redirects=True)
-    if r.status_code != 200:
-        msg = "error %s getting %s" % (r.status_code, entry.url)
-        threadlog.error(msg)
-        raise BadGateway(msg, code=r.status_code, url=entry.url)
-    threadlog.info("reading remote: %s, target %s", r.url, entry.relpath)
-    content_size = r.headers.get("content-length")
+    # we get and cache the file and some http headers from remote,
+    # a previously interrupted download is continued with a Range request
+    partial = xom.filestore.get_partial_download(entry)
+    offset = partial.open()
+    try:
+        r = xom.httpget(
+            entry.url, allow_redirects=True,
+            extra_headers=partial.get_request_headers())
+        if offset and r.status_code == 416:
+            # the partial data doesn't fit the remote file
+            r.close()
+            partial.restart()
+            r = xom.httpget(entry.url, allow_redirects=True)
+        if not partial.accept_response(r):
+            msg = "error %s getting %s" % (r.status_code, entry.url)
+            threadlog.error(msg)
+            raise BadGateway(msg, code=r.status_code, url=entry.url)
+        offset = partial.offset
+        if offset:
+            threadlog.info(
+                "resuming remote: %s at offset %s, target %s",
+                r.url, offset, entry.relpath)
+        else:
+            threadlog.info("reading remote: %s, target %s", r.url, entry.relpath)
+        headers = _headers_from_response(r)
+        content_size = r.headers.get("content-length")
+        if content_size and offset:
+            content_size = str(int(content_size) + offset)
+            headers[str("content-length")] = content_size
+
+        yield headers
+
+        for data in partial.read_existing():
+            yield data
+        while 1:
+            data = r.raw.read(10240)
+            if not data:
+                break
+            partial.write(data)
+            yield data
+    except BaseException:
+        # keep what we got so far, the next attempt can continue from there
+        partial.keep()
+        raise
+
+    content = partial.getvalue()
+    partial.discard()
     err = None
 
-    yield _headers_from_response(r)
-
-    content = BytesIO()
-    while 1:
-        data = r.raw.read(10240)
-        if not data:
-            break
-        content.write(data)
-        yield data
-
-    content = content.getvalue()
-
     filesize = len(content)
     if content_size and int(content_size) != filesize:
         err = ValueError(
@@ -1472,6 +1707,21 @@ def iter_cache_remote_file(xom, entry):
         # to open a new one below
         tx = None
 
+    def store_dist_info_metadata():
+        # extract the PEP 658 metadata file of wheels unless it already
+        # exists or was provided by upstream with a different hash, for
+        # mirrors the simple links pick it up with their next refresh
+        metadata = get_dist_info_metadata(entry.basename, content)
+        if metadata is None:
+            return
+        md_entry = xom.filestore.get_dist_info_metadata_entry(entry)
+        if md_entry is None or md_entry.file_exists():
+            return
+        if md_entry.check_checksum(metadata) is not None:
+            return
+        xom.filestore.store_dist_info_metadata(
+            entry, metadata, hash_spec=md_entry.hash_spec)
+
     def set_content():
         entry.file_set_content(content, r.headers.get("last-modified", None))
         if entry.project:
@@ -1481,6 +1731,7 @@ def iter_cache_remote_file(xom, entry):
             # for mirror indexes this makes sure the project is in the database
             # as soon as a file was fetched
             stage.add_project_name(entry.project)
+            store_dist_info_metadata()
 
     if not entry.has_existing_metadata():
         if tx is not None:
@@ -1514,6 +1765,9 @@ def iter_remote_file_replica(xom, entry):
         threadlog.info("replica doesn't have file: %s", entry.relpath)
     (uuid, master_uuid) = make_uuid_headers(xom.config.nodeinfo)
     rt = xom.replica_thread
+    if entry.project:
+        # the other files of the project are likely requested soon
+        rt.shared_data.demand(entry.project)
     token = rt.auth_serializer.dumps(uuid)
     r = xom.httpget(
         url, allow_redirects=True,
@@ -0,0 +1 @@
+New ``devpiserver_blob_storage_backend`` plugin hook and ``--blob-storage`` option to keep the content of release files in a blob store separate from the storage backend. Files are uploaded in parallel before the database commit, and large files are uploaded in parts. The included ``fs`` blob storage keeps the files in a directory, by default ``+blobstore`` in the server directory. Each server needs a blob store of its own, because deleted files are removed from it.
@@ -0,0 +1 @@
+The master caches encoded changelog batches served to replicas, bounded to 100MB. When several replicas catch up at the same time, each batch is only read and serialized once. New metrics report hits, misses, evictions and size of the cache.
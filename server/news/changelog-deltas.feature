@@ -0,0 +1 @@
+Changelog entries for big dict and set values, like the project names of an index or the links of a release, now only store what changed since the previous value. A full value is written again after 16 deltas. Replicas receive the deltas if they announce support for them, older replicas still get full values.
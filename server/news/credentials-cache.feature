@@ -0,0 +1 @@
+Successful password validations are cached for a short time, so clients which send the password with every request, like pip with credentials in the index URL, don't pay for a full password hash verification each time. The new ``--credentials-cache-ttl`` option sets the number of seconds, use 0 to disable the cache.
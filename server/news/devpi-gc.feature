@@ -0,0 +1 @@
+New ``devpi-gc`` command to remove files in the server directory which aren't referenced by the database anymore. This includes orphaned release files, leftover temporary files from crashed transactions and partial downloads which can't be resumed. The file tree is scanned with several threads in parallel, use ``--dry-run`` to only report the files. Files modified within the last hour are kept, so they aren't removed while a running server still uses them. Set this age in seconds with ``--min-age``. A ``--blob-storage`` isn't collected, as it is managed outside of the server directory.
@@ -0,0 +1 @@
+The ``.dist-info/METADATA`` file of wheels is now extracted on upload and when a mirrored wheel is cached. It is served at ``<file>.metadata`` and advertised on simple pages with the PEP 658 ``data-dist-info-metadata`` and PEP 714 ``data-core-metadata`` attributes, so installers can resolve dependencies without downloading whole wheels. Metadata files provided by the upstream of a mirror are passed through.
@@ -0,0 +1 @@
+Simple pages and the JSON API for indexes, projects and versions now send an ``ETag`` derived from the change serials of the involved indexes and answer ``If-None-Match`` requests with ``304 Not Modified`` while nothing changed. Indexes inheriting from mirrors don't get an ``ETag``, because mirror data can change without a database change.
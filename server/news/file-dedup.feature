@@ -0,0 +1 @@
+With the new ``--file-dedup`` option, files with the same content are stored only once: for example when a release is pushed to other indexes, imported, or mirrored by several mirror indexes. The per-index files are hard links to each other. Release files with the same content are then tracked in a new ``+blobs/{sha256}`` key. Replicas with ``--file-dedup`` link such files locally instead of downloading them again from the master, if the master uses ``--file-dedup`` as well.
@@ -0,0 +1 @@
+The ``sqlite`` storage backend can keep release files in two tiers with ``--storage sqlite:cold_dir=PATH,hot_cache_size=SIZE``. All files are stored in ``cold_dir``, for example on a large but slow mount, while the server directory only caches the most recently used files up to ``hot_cache_size`` (like ``500G``). Files evicted from the cache are copied back from ``cold_dir`` on access. ``devpi-fsck`` checks the copies in ``cold_dir`` and ``devpi-gc`` removes unreferenced files there as well, both without filling the cache. With tiers ``--sendfile-header`` is ignored, as a file could be evicted before the web server sends it.
@@ -0,0 +1 @@
+Release files are no longer read into memory completely before they are served. They are streamed from the file system, using ``wsgi.file_wrapper`` when the WSGI server provides it, so servers like waitress can send them more efficiently.
@@ -0,0 +1 @@
+New ``/+files-bundle`` endpoint on the master which streams the content of many files in one response. On startup replicas fetch missing small files in bundles instead of one request per file. This is not used with ``--replica-file-search-path``.
@@ -0,0 +1 @@
+New ``/+files-manifest`` endpoint on the master which streams relpath, hash, size and serial of all current files. Replicas use it on startup together with a single directory scan to queue missing files, instead of walking the whole changelog and checking each file.
@@ -0,0 +1 @@
+``devpi-fsck`` hashes files in a pool of processes (``--workers``) and reads them in chunks instead of loading them into memory. With ``--checkpoint`` the progress is stored regularly in a file, so an interrupted check continues where it stopped. With ``--since-serial`` only files changed after the given serial are checked, and ``--json`` prints a summary including the checked serial for the next incremental run.
@@ -0,0 +1 @@
+With ``--storage sqlite:fsync=yes``, release files are synced to disk on commit, so a power loss can't leave truncated files behind. The file content is synced by a background thread pool as soon as it is written. The commit waits for these syncs and then syncs each affected directory once, both before the database commit and after the files are renamed into place.
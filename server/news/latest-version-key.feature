@@ -0,0 +1 @@
+The latest and latest stable version of each project on private indexes is stored in a new key when versions are added or removed, so ``get_latest_version`` no longer has to compare all versions of a project on every call.
@@ -0,0 +1 @@
+Requests for multiple byte ranges of release files are now answered with a ``206 Partial Content`` ``multipart/byteranges`` response streamed from the file, instead of the whole file.
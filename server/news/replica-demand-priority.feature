@@ -0,0 +1 @@
+Replicas download queued files of projects requested by clients before other files, so a freshly started replica serves what is actually used first. New metrics report the size of that queue, the number of moved files and the number of projects with queued files.
@@ -0,0 +1 @@
+Interrupted file downloads on replicas and mirrors are kept in ``+partial`` in the server directory and resumed with HTTP Range requests if the remote supports it. Release files are served with support for Range requests.
@@ -0,0 +1 @@
+New ``--sendfile-header`` option with the choices ``x-accel-redirect`` and ``x-sendfile``. With it devpi-server only checks the permissions for release file downloads and lets the web server in front send the stored file. The generated nginx config has the needed internal ``/+files/`` location.
@@ -0,0 +1 @@
+Project names of an index are now stored in up to 256 shards instead of a single set. Adding or removing a project no longer writes the complete list of names to the changelog, which matters for big mirrors like ``root/pypi``. Existing databases are migrated per index with the first write.
@@ -0,0 +1 @@
+The merged and sorted simple links of private indexes which only inherit from other private indexes are cached per project and reused until a stage in the inheritance chain changes the project or an index configuration changes.
@@ -0,0 +1 @@
+The resolved base indexes of each index are cached until a user or index configuration changes. Requests on indexes with deep inheritance no longer look up and create every base index object several times. New metrics report hits, misses and size of the cache.
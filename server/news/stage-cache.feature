@@ -0,0 +1 @@
+Stage objects for read requests are cached per index configuration and reused across requests. Each transaction gets its own lightweight copy. New metrics report hits and misses of the cache.
@@ -0,0 +1 @@
+Each write transaction which changes a private index now records its serial in a per index key, so ``get_last_change_serial_perstage`` no longer has to look at every project and version of the index.
@@ -88,6 +88,7 @@ if __name__ == "__main__":
         'console_scripts': [
             "devpi-export = devpi_server.importexport:export",
             "devpi-fsck = devpi_server.fsck:fsck",
+            "devpi-gc = devpi_server.gc:gc",
             "devpi-gen-config = devpi_server.genconfig:genconfig",
             "devpi-gen-secret = devpi_server.config:gensecret",
             "devpi-import = devpi_server.importexport:import_",
@@ -97,6 +98,7 @@ if __name__ == "__main__":
         'devpi_server': [
             "devpi-server-auth-basic = devpi_server.auth_basic",
             "devpi-server-auth-devpi = devpi_server.auth_devpi",
+            "devpi-server-blobstorage = devpi_server.blobstorage",
             "devpi-server-extpypi = devpi_server.extpypi",
             "devpi-server-genconfig = devpi_server.genconfig",
             "devpi-server-model = devpi_server.model",
@@ -87,6 +87,54 @@ class TestAuth:
             status="ok",
             from_user_object=True)
 
+    def test_auth_credentials_cache(self, auth, model, monkeypatch):
+        from devpi_server.model import User
+        username, password = "user", "world"
+        user = model.create_user(username, password)
+        calls = []
+        orig_validate = User.validate
+
+        def validate(self, authpassword):
+            calls.append(authpassword)
+            return orig_validate(self, authpassword)
+
+        monkeypatch.setattr(User, "validate", validate)
+
+        class Request:
+            pass
+
+        for i in range(2):
+            assert auth._validate(username, password, request=Request()) == dict(
+                status="ok",
+                from_user_object=True)
+        # the second request used the credentials cache
+        assert calls == [password]
+        # wrong passwords aren't cached
+        for i in range(2):
+            assert auth._validate(username, "foo", request=Request()) == dict(
+                status="reject")
+        assert calls == [password, "foo", "foo"]
+        # changing the password invalidates the entry
+        user.modify(password="new")
+        assert auth._validate(username, password, request=Request()) == dict(
+            status="reject")
+        assert calls == [password, "foo", "foo", password]
+
+
+def test_credentials_cache():
+    from devpi_server.auth import CredentialsCache
+    cache = CredentialsCache(ttl=60)
+    cache.add("user", "pass", "salt:hash")
+    assert cache.is_valid("user", "pass", "salt:hash")
+    assert not cache.is_valid("user", "other", "salt:hash")
+    assert not cache.is_valid("user", "pass", "salt:otherhash")
+    assert not cache.is_valid("other", "pass", "salt:hash")
+    # the password isn't stored
+    assert "pass" not in repr(cache._entries.data)
+    cache = CredentialsCache(ttl=0)
+    cache.add("user", "pass", "salt:hash")
+    assert not cache.is_valid("user", "pass", "salt:hash")
+
 
 def test_newsalt():
     assert newsalt() != newsalt()
@@ -0,0 +1,101 @@
+from devpi_server import blobstorage
+from devpi_server.blobstorage import FSBlobStore
+from io import BytesIO
+import pytest
+
+
+class TestFSBlobStore:
+    @pytest.fixture
+    def blobstore(self, tmpdir):
+        blobstore = FSBlobStore(tmpdir)
+        blobstore.multipart_threshold = 10
+        blobstore.part_size = 4
+        return blobstore
+
+    def test_put_single(self, blobstore, tmpdir):
+        blobstore.put("+files/a", BytesIO(b"hello"), 5)
+        assert blobstore.exists("+files/a")
+        assert blobstore.size("+files/a") == 5
+        assert blobstore.os_path("+files/a") == tmpdir.join(
+            "+blobstore", "+files", "a").strpath
+        with blobstore.open("+files/a") as f:
+            assert f.read() == b"hello"
+        blobstore.delete("+files/a")
+        assert not blobstore.exists("+files/a")
+        assert blobstore.size("+files/a") is None
+        # deleting missing files is fine
+        blobstore.delete("+files/a")
+
+    def test_put_multipart(self, blobstore, tmpdir):
+        content = b"0123456789abcdefghij"
+        blobstore.put("+files/a", BytesIO(content), len(content))
+        with blobstore.open("+files/a") as f:
+            assert f.read() == content
+        # the directory with the parts is removed
+        assert tmpdir.join("+blobstore").listdir() == [
+            tmpdir.join("+blobstore", "+files")]
+
+    def test_put_multipart_abort(self, blobstore, monkeypatch, tmpdir):
+        def multipart_put(upload, number, data):
+            raise IOError("upload failed")
+
+        monkeypatch.setattr(blobstore, "multipart_put", multipart_put)
+        content = b"0123456789abcdefghij"
+        with pytest.raises(IOError, match="upload failed"):
+            blobstore.put("+files/a", BytesIO(content), len(content))
+        assert not blobstore.exists("+files/a")
+        assert tmpdir.join("+blobstore").listdir() == []
+
+
+@pytest.fixture
+def blob_xom(makexom, tmpdir):
+    blobdir = tmpdir.join("blobs")
+    xom = makexom(
+        opts=["--blob-storage", "fs:path=%s" % blobdir],
+        plugins=[blobstorage])
+    xom.blobdir = blobdir
+    return xom
+
+
+@pytest.mark.notransaction
+def test_files_in_blob_storage(blob_xom):
+    xom = blob_xom
+    filestore = xom.filestore
+    with xom.keyfs.transaction(write=True):
+        entry = filestore.store("root", "dev", "pkg-1.0.zip", b"content")
+        # not uploaded before the commit
+        assert not xom.blobdir.join(entry._storepath).exists()
+        assert entry.file_get_content() == b"content"
+    assert xom.blobdir.join(entry._storepath).read_binary() == b"content"
+    assert not xom.config.serverdir.join(entry._storepath).exists()
+    assert xom.config.serverdir.join("+blobspool").listdir() == []
+    with xom.keyfs.transaction(write=False):
+        entry = filestore.get_file_entry(entry.relpath)
+        assert entry.file_exists()
+        assert entry.file_size() == 7
+        assert entry.file_get_content() == b"content"
+        assert entry.file_os_path() == xom.blobdir.join(entry._storepath).strpath
+    with xom.keyfs.transaction(write=True):
+        entry = filestore.get_file_entry(entry.relpath, readonly=False)
+        entry.file_delete()
+        assert not entry.file_exists()
+        assert xom.blobdir.join(entry._storepath).exists()
+    assert not xom.blobdir.join(entry._storepath).exists()
+
+
+@pytest.mark.notransaction
+def test_blob_storage_rollback(blob_xom):
+    xom = blob_xom
+    filestore = xom.filestore
+    with pytest.raises(ValueError):
+        with xom.keyfs.transaction(write=True):
+            entry = filestore.store("root", "dev", "pkg-1.0.zip", b"content")
+            raise ValueError()
+    assert not xom.blobdir.join(entry._storepath).exists()
+    assert xom.config.serverdir.join("+blobspool").listdir() == []
+
+
+def test_unknown_blob_storage(makexom):
+    from devpi_server.main import Fatal
+    with pytest.raises(Fatal, match="blob storage 'foo' can't be found"):
+        makexom(opts=["--blob-storage", "foo"])
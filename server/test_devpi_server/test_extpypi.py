@@ -120,6 +120,19 @@ class TestIndexParsing:
         assert link.hash_spec == "md5=pony"
         assert link.requires_python is None
 
+    @pytest.mark.parametrize("attr", [
+        "data-dist-info-metadata", "data-core-metadata"])
+    def test_parse_index_with_dist_info_metadata(self, attr):
+        result = parse_index(
+            self.simplepy,
+            """<a href="pkg/py-1.0-py3-none-any.whl" %s="sha256=pony" />
+               <a href="pkg/py-1.0.zip" />""" % attr)
+        (link1, link2) = sorted(
+            result.releaselinks, key=lambda x: x.basename)
+        assert link1.basename == "py-1.0-py3-none-any.whl"
+        assert link1.dist_info_metadata == "sha256=pony"
+        assert link2.dist_info_metadata is None
+
     def test_parse_index_with_yanked(self):
         result = parse_index(
             self.simplepy,
@@ -1,6 +1,7 @@
 from devpi_server.views import iter_cache_remote_file
 from webob.headers import ResponseHeaders
 import hashlib
+import os
 import pytest
 import py
 
@@ -298,6 +299,75 @@ class TestFileStore:
                 pass
         assert not entry.file_exists()
 
+    def test_iterfile_remote_resume(self, filestore, httpget, gen, xom):
+        content = b"123456"
+        md5 = hashlib.md5(content).hexdigest()
+        link = gen.pypi_package_link("pytest-3.0.zip#md5=%s" % md5, md5=False)
+        entry = filestore.maplink(link, "root", "pypi", "pytest")
+        assert entry.hash_spec
+
+        class BrokenRaw:
+            def __init__(self):
+                self.parts = [b"123"]
+
+            def read(self, size):
+                if self.parts:
+                    return self.parts.pop(0)
+                raise OSError("connection reset")
+
+        headers = ResponseHeaders({"content-length": "6"})
+        httpget.url2response[link.url_nofrag] = dict(
+            status_code=200, headers=headers, raw=BrokenRaw())
+        with pytest.raises(OSError):
+            for part in iter_cache_remote_file(xom, entry):
+                pass
+        assert not entry.file_exists()
+        partial = filestore.get_partial_download(entry)
+        assert partial.path.read_binary() == b"123"
+        # the remote answers the Range request with the missing bytes
+        headers = ResponseHeaders({
+            "content-length": "3",
+            "content-range": "bytes 3-5/6"})
+        httpget.url2response[link.url_nofrag] = dict(
+            status_code=206, headers=headers, raw=BytesIO(b"456"))
+        parts = list(iter_cache_remote_file(xom, entry))
+        assert httpget.call_log[-1]["extra_headers"]["Range"] == "bytes=3-"
+        assert parts[0]["content-length"] == "6"
+        assert b"".join(parts[1:]) == content
+        assert entry.file_get_content() == content
+        assert not partial.path.exists()
+
+    def test_iterfile_remote_resume_ignored(self, filestore, httpget, gen, xom):
+        content = b"123456"
+        md5 = hashlib.md5(content).hexdigest()
+        link = gen.pypi_package_link("pytest-3.0.zip#md5=%s" % md5, md5=False)
+        entry = filestore.maplink(link, "root", "pypi", "pytest")
+        partial = filestore.get_partial_download(entry)
+        partial.path.write_binary(b"12", ensure=True)
+        # the remote doesn't support Range and sends everything
+        headers = ResponseHeaders({"content-length": "6"})
+        httpget.url2response[link.url_nofrag] = dict(
+            status_code=200, headers=headers, raw=BytesIO(content))
+        parts = list(iter_cache_remote_file(xom, entry))
+        assert httpget.call_log[-1]["extra_headers"]["Range"] == "bytes=2-"
+        assert b"".join(parts[1:]) == content
+        assert entry.file_get_content() == content
+        assert not partial.path.exists()
+
+    def test_iterfile_remote_no_resume_without_hash(self, filestore, httpget, gen, xom):
+        link = gen.pypi_package_link("pytest-3.0.zip", md5=False)
+        entry = filestore.maplink(link, "root", "pypi", "pytest")
+        assert not entry.hash_spec
+        partial = filestore.get_partial_download(entry)
+        partial.path.write_binary(b"12", ensure=True)
+        headers = ResponseHeaders({"content-length": "3"})
+        httpget.url2response[link.url] = dict(
+            status_code=200, headers=headers, raw=BytesIO(b"123"))
+        for part in iter_cache_remote_file(xom, entry):
+            pass
+        assert httpget.call_log[-1]["extra_headers"] == {}
+        assert entry.file_get_content() == b"123"
+
     def test_store_and_iter(self, filestore):
         content = b"hello"
         entry = filestore.store("user", "index", "something-1.0.zip", content)
@@ -327,3 +397,51 @@ def test_maplink_nochange(filestore, gen):
     assert py.builtin._istext(entry1.hash_spec)
     filestore.keyfs.commit_transaction_in_thread()
     assert filestore.keyfs.get_current_serial() == last_serial
+
+
+def test_store_same_content_refs(filestore):
+    filestore.keyfs.file_dedup = True
+    filestore.keyfs.restart_as_write_transaction()
+    content = b"hello"
+    entry1 = filestore.store("user", "index1", "something-1.0.zip", content)
+    entry2 = filestore.store("user", "index2", "something-1.0.zip", content)
+    assert entry1.blob_key == entry2.blob_key
+    assert entry1.blob_key.get() == {entry1.relpath, entry2.relpath}
+    entry1.delete()
+    assert entry2.blob_key.get() == {entry2.relpath}
+    entry2.delete()
+    assert not filestore.keyfs.FILEBLOB(
+        sha256=getdigest(content, "sha256")).exists()
+
+
+def test_store_same_content_no_refs_without_dedup(filestore):
+    assert not filestore.keyfs.file_dedup
+    filestore.keyfs.restart_as_write_transaction()
+    content = b"hello"
+    entry = filestore.store("user", "index1", "something-1.0.zip", content)
+    blob_key = entry.blob_key
+    assert not blob_key.exists()
+    entry.delete()
+    assert not blob_key.exists()
+
+
+@pytest.mark.storage_with_filesystem
+@pytest.mark.parametrize("file_dedup", [False, True])
+def test_store_same_content_hard_linked(makexom, file_dedup):
+    opts = ["--file-dedup"] if file_dedup else []
+    xom = makexom(opts=opts)
+    filestore = xom.filestore
+    content = b"hello"
+    with xom.keyfs.transaction(write=True):
+        entry1 = filestore.store("user", "index1", "something-1.0.zip", content)
+    with xom.keyfs.transaction(write=True):
+        entry2 = filestore.store("user", "index2", "something-1.0.zip", content)
+    with xom.keyfs.transaction(write=False):
+        path1 = entry1.file_os_path()
+        path2 = entry2.file_os_path()
+    assert os.path.samefile(path1, path2) is file_dedup
+    with xom.keyfs.transaction(write=True):
+        filestore.get_file_entry(entry1.relpath).delete()
+    with xom.keyfs.transaction(write=False):
+        entry2 = filestore.get_file_entry(entry2.relpath)
+        assert entry2.file_get_content() == content
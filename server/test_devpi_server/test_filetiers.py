@@ -0,0 +1,170 @@
+from devpi_server.filetiers import FileTiers
+from devpi_server.filetiers import parse_size
+import pytest
+import threading
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("100", 100),
+    ("2K", 2048),
+    ("3m", 3 * 1024 ** 2),
+    ("1GB", 1024 ** 3),
+    ("4T", 4 * 1024 ** 4)])
+def test_parse_size(value, expected):
+    assert parse_size(value) == expected
+
+
+@pytest.mark.parametrize("value", ["", "G", "1.5G", "-1", "10X"])
+def test_parse_size_invalid(value):
+    with pytest.raises(ValueError):
+        parse_size(value)
+
+
+class TestFileTiers:
+    @pytest.fixture
+    def tiers(self, tmpdir):
+        return FileTiers(tmpdir.join("hot"), tmpdir.join("cold"), 10)
+
+    def write_committed(self, tiers, tmpdir, name, content):
+        tmpdir.join("hot", "+files", name).write_binary(content, ensure=True)
+        tiers.commit(["+files/%s" % name], [])
+        return tmpdir.join("hot", "+files", name)
+
+    def test_commit_copies_to_cold(self, tiers, tmpdir):
+        path = self.write_committed(tiers, tmpdir, "a", b"12345")
+        assert path.read_binary() == b"12345"
+        assert tmpdir.join("cold", "+files", "a").read_binary() == b"12345"
+        assert tiers.size == 5
+        tiers.commit([], ["+files/a"])
+        assert not tmpdir.join("cold", "+files", "a").exists()
+        assert tiers.size == 0
+
+    def test_evict_least_recently_used(self, tiers, tmpdir):
+        a = self.write_committed(tiers, tmpdir, "a", b"12345")
+        b = self.write_committed(tiers, tmpdir, "b", b"12345")
+        assert tiers.fetch(a.strpath)
+        c = self.write_committed(tiers, tmpdir, "c", b"12345")
+        assert tiers.size == 10
+        assert a.exists()
+        assert not b.exists()
+        assert c.exists()
+        assert tiers.exists(b.strpath)
+        assert tiers.getsize(b.strpath) == 5
+        # fetching b evicts a, which is now the least recently used
+        assert tiers.fetch(b.strpath)
+        assert b.read_binary() == b"12345"
+        assert not a.exists()
+        assert not tiers.fetch(tmpdir.join("hot", "+files", "d").strpath)
+
+    def test_stored_path(self, tiers, tmpdir):
+        a = self.write_committed(tiers, tmpdir, "a", b"12345")
+        b = self.write_committed(tiers, tmpdir, "b", b"123456")
+        assert not a.exists()
+        cold_a = tmpdir.join("cold", "+files", "a")
+        assert tiers.stored_path(a.strpath) == cold_a.strpath
+        # the file isn't fetched
+        assert not a.exists()
+        assert b.exists()
+        assert tiers.stored_path(b.strpath) == tmpdir.join(
+            "cold", "+files", "b").strpath
+        missing = tmpdir.join("hot", "+files", "c").strpath
+        assert tiers.stored_path(missing) == missing
+
+    def test_existing_files_are_scanned(self, tiers, tmpdir):
+        tmpdir.join("hot", "+files", "a").write_binary(b"123456", ensure=True)
+        tmpdir.join("hot", "+files", "b-tmp").write_binary(b"123456")
+        self.write_committed(tiers, tmpdir, "c", b"123456")
+        # "a" predates the cold directory and is copied there on eviction
+        assert not tmpdir.join("hot", "+files", "a").exists()
+        assert tmpdir.join("cold", "+files", "a").read_binary() == b"123456"
+        assert tmpdir.join("hot", "+files", "b-tmp").exists()
+
+    def test_evict_copies_without_lock(self, monkeypatch, tiers, tmpdir):
+        from devpi_server import filetiers
+        a = tmpdir.join("hot", "+files", "a")
+        a.write_binary(b"123456", ensure=True)
+        orig_copy_file = filetiers.copy_file
+        lock_states = []
+
+        def try_lock():
+            locked = tiers._lock.acquire(False)
+            if locked:
+                tiers._lock.release()
+            lock_states.append(locked)
+
+        def copy_file(source, dest):
+            # check whether another thread could get the lock
+            thread = threading.Thread(target=try_lock)
+            thread.start()
+            thread.join()
+            if source == a.strpath:
+                # the file is used while it is copied
+                tiers.accessed(source)
+            return orig_copy_file(source, dest)
+
+        monkeypatch.setattr(filetiers, "copy_file", copy_file)
+        b = self.write_committed(tiers, tmpdir, "b", b"123456")
+        assert lock_states == [True, True]
+        # "a" was copied, but not evicted, because it was accessed
+        assert tmpdir.join("cold", "+files", "a").read_binary() == b"123456"
+        assert a.exists()
+        assert not b.exists()
+        assert tiers.size == 6
+
+    def test_unusable_cold_dir(self, caplog, tmpdir):
+        tmpdir.join("file").write("")
+        tiers = FileTiers(tmpdir.join("hot"), tmpdir.join("file", "cold"), 4)
+        path = self.write_committed(tiers, tmpdir, "a", b"12345")
+        # the file stays in the cache, even though it is too large
+        assert path.read_binary() == b"12345"
+        assert tiers.size == 5
+        assert "could not copy %s to cold storage" % path in caplog.text
+
+
+@pytest.mark.no_storage_option
+@pytest.mark.storage_with_filesystem
+@pytest.mark.notransaction
+def test_storage_with_tiers(makexom, tmpdir):
+    cold_dir = tmpdir.join("cold")
+    xom = makexom(opts=[
+        "--storage", "sqlite:cold_dir=%s,hot_cache_size=6" % cold_dir])
+    filestore = xom.filestore
+    with xom.keyfs.transaction(write=True):
+        first = filestore.store("root", "dev", "first-1.0.zip", b"first")
+    with xom.keyfs.transaction(write=True):
+        second = filestore.store("root", "dev", "second-1.0.zip", b"second")
+    serverdir = xom.config.serverdir
+    assert not serverdir.join(first._storepath).exists()
+    assert cold_dir.join(first._storepath).exists()
+    with xom.keyfs.transaction(write=False):
+        entry = filestore.get_file_entry(first.relpath)
+        assert entry.file_exists()
+        assert entry.file_size() == 5
+        assert not serverdir.join(first._storepath).exists()
+        assert entry.file_get_content() == b"first"
+    assert serverdir.join(first._storepath).exists()
+    assert not serverdir.join(second._storepath).exists()
+    with xom.keyfs.transaction(write=True):
+        filestore.get_file_entry(second.relpath, readonly=False).file_delete()
+    assert not cold_dir.join(second._storepath).exists()
+
+
+def test_storage_tiers_need_size(makexom, tmpdir):
+    from devpi_server.main import Fatal
+    with pytest.raises(Fatal, match="requires 'hot_cache_size'"):
+        makexom(opts=["--storage", "sqlite:cold_dir=%s" % tmpdir])
+
+
+@pytest.mark.no_storage_option
+@pytest.mark.storage_with_filesystem
+@pytest.mark.notransaction
+def test_storage_with_unusable_cold_dir(makexom, tmpdir):
+    tmpdir.join("file").write("")
+    cold_dir = tmpdir.join("file", "cold")
+    xom = makexom(opts=[
+        "--storage", "sqlite:cold_dir=%s,hot_cache_size=2" % cold_dir])
+    serial = xom.keyfs.get_current_serial()
+    with xom.keyfs.transaction(write=True):
+        entry = xom.filestore.store("root", "dev", "pkg-1.0.zip", b"content")
+    assert xom.keyfs.get_current_serial() == serial + 1
+    assert xom.config.serverdir.join(entry._storepath).read_binary() == b"content"
@@ -0,0 +1,165 @@
+from devpi_server.fsck import fsck
+from devpi_server.fsck import iter_ordered_results
+import json
+import pytest
+
+
+def double(x):
+    return x * 2
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_iter_ordered_results(workers):
+    results = iter_ordered_results(double, iter(range(100)), workers)
+    assert list(results) == [x * 2 for x in range(100)]
+
+
+@pytest.fixture
+def xom(makexom, tmpdir):
+    from devpi_server.init import init
+    serverdir = tmpdir.join("server")
+    init(argv=["devpi-init", "--serverdir", serverdir])
+    return makexom(opts=["--serverdir", serverdir])
+
+
+@pytest.fixture
+def run_fsck(capsys, caplog, xom):
+    def run_fsck(*args):
+        capsys.readouterr()
+        caplog.clear()
+        ret = fsck(argv=[
+            "devpi-fsck", "--serverdir", xom.config.serverdir, "--json"]
+            + list(args))
+        (out, err) = capsys.readouterr()
+        assert ret is None
+        return json.loads(out), caplog.text
+    return run_fsck
+
+
+@pytest.mark.notransaction
+@pytest.mark.storage_with_filesystem
+@pytest.mark.parametrize("workers", [1, 2])
+def test_fsck(run_fsck, workers, xom):
+    filestore = xom.filestore
+    with xom.keyfs.transaction(write=True):
+        missing = filestore.store("root", "dev", "missing-1.0.zip", b"missing")
+    with xom.keyfs.transaction(write=True):
+        filestore.store("root", "dev", "good-1.0.zip", b"good")
+        corrupt = filestore.store("root", "dev", "corrupt-1.0.zip", b"corrupt")
+    serverdir = xom.config.serverdir
+    serverdir.join(missing._storepath).remove()
+    serverdir.join(corrupt._storepath).write_binary(b"bad")
+    (summary, err) = run_fsck("--workers", workers)
+    assert summary == dict(
+        serial=xom.keyfs.get_current_serial(), since_serial=-1,
+        processed=3, missing=1, mismatches=1)
+    assert "Missing file %s" % missing.relpath in err
+    assert "%s - sha256 mismatch" % corrupt.relpath in err
+
+
+@pytest.mark.notransaction
+@pytest.mark.storage_with_filesystem
+def test_fsck_since_serial(run_fsck, xom):
+    filestore = xom.filestore
+    with xom.keyfs.transaction(write=True):
+        filestore.store("root", "dev", "old-1.0.zip", b"old")
+    (summary, err) = run_fsck()
+    assert summary["processed"] == 1
+    with xom.keyfs.transaction(write=True):
+        filestore.store("root", "dev", "new-1.0.zip", b"new")
+    (summary, err) = run_fsck("--since-serial", summary["serial"])
+    assert summary["processed"] == 1
+    (summary, err) = run_fsck("--since-serial", summary["serial"])
+    assert summary["processed"] == 0
+
+
+@pytest.mark.notransaction
+@pytest.mark.storage_with_filesystem
+def test_fsck_checkpoint(run_fsck, tmpdir, xom):
+    filestore = xom.filestore
+    with xom.keyfs.transaction(write=True):
+        first = filestore.store("root", "dev", "first-1.0.zip", b"first")
+        second = filestore.store("root", "dev", "second-1.0.zip", b"second")
+    (first, second) = sorted([first, second], key=lambda x: x.relpath)
+    checkpoint = tmpdir.join("checkpoint")
+    checkpoint.write(json.dumps(dict(
+        since_serial=-1, position=[xom.keyfs.get_current_serial(), first.relpath],
+        processed=1, missing=1, mismatches=0)))
+    (summary, err) = run_fsck("--checkpoint", checkpoint)
+    assert "Continuing after %s" % first.relpath in err
+    assert summary["processed"] == 2
+    assert summary["missing"] == 1
+    assert not checkpoint.exists()
+    # a checkpoint from a run with other options is ignored
+    checkpoint.write(json.dumps(dict(
+        since_serial=0, position=[xom.keyfs.get_current_serial(), first.relpath],
+        processed=1, missing=1, mismatches=0)))
+    (summary, err) = run_fsck("--checkpoint", checkpoint)
+    assert "Ignoring checkpoint" in err
+    assert summary["processed"] == 2
+    assert summary["missing"] == 0
+
+
+@pytest.mark.notransaction
+@pytest.mark.storage_with_filesystem
+def test_fsck_checkpoint_on_interrupt(monkeypatch, run_fsck, tmpdir, xom):
+    from devpi_server import fsck as fsck_mod
+    filestore = xom.filestore
+    with xom.keyfs.transaction(write=True):
+        first = filestore.store("root", "dev", "first-1.0.zip", b"first")
+        second = filestore.store("root", "dev", "second-1.0.zip", b"second")
+    (first, second) = sorted([first, second], key=lambda x: x.relpath)
+    check_file = fsck_mod.check_file
+
+    def interrupting_check_file(task):
+        if task[1] == second.relpath:
+            raise KeyboardInterrupt()
+        return check_file(task)
+
+    monkeypatch.setattr(fsck_mod, "check_file", interrupting_check_file)
+    checkpoint = tmpdir.join("checkpoint")
+    with pytest.raises(KeyboardInterrupt):
+        run_fsck("--workers", 1, "--checkpoint", checkpoint)
+    state = json.loads(checkpoint.read())
+    assert state["position"] == [xom.keyfs.get_current_serial(), first.relpath]
+    assert state["processed"] == 1
+    monkeypatch.setattr(fsck_mod, "check_file", check_file)
+    (summary, err) = run_fsck("--checkpoint", checkpoint)
+    assert summary["processed"] == 2
+    assert not checkpoint.exists()
+
+
+@pytest.mark.no_storage_option
+@pytest.mark.notransaction
+def test_fsck_tiers(capsys, makexom, monkeypatch, tmpdir):
+    from devpi_server.filetiers import FileTiers
+    from devpi_server.init import init
+    serverdir = tmpdir.join("server")
+    cold_dir = tmpdir.join("cold")
+    storage = "sqlite:cold_dir=%s,hot_cache_size=6" % cold_dir
+    init(argv=["devpi-init", "--serverdir", serverdir, "--storage", storage])
+    xom = makexom(opts=["--serverdir", serverdir, "--storage", storage])
+    filestore = xom.filestore
+    with xom.keyfs.transaction(write=True):
+        first = filestore.store("root", "dev", "first-1.0.zip", b"first")
+    with xom.keyfs.transaction(write=True):
+        second = filestore.store("root", "dev", "second-1.0.zip", b"second")
+    assert not serverdir.join(first._storepath).exists()
+    # the copy in the cold directory is checked
+    cold_dir.join(first._storepath).write_binary(b"bad")
+    fetched = []
+    fetch = FileTiers.fetch
+    monkeypatch.setattr(
+        FileTiers, "fetch",
+        lambda self, path: fetched.append(path) or fetch(self, path))
+    capsys.readouterr()
+    fsck(argv=[
+        "devpi-fsck", "--serverdir", serverdir, "--storage", storage,
+        "--json", "--workers", "1"])
+    (out, err) = capsys.readouterr()
+    assert json.loads(out) == dict(
+        serial=xom.keyfs.get_current_serial(), since_serial=-1,
+        processed=2, missing=0, mismatches=1)
+    # nothing was fetched into the cache
+    assert serverdir.join(first._storepath).strpath not in fetched
+    assert not serverdir.join(first._storepath).exists()
@@ -0,0 +1,100 @@
+from devpi_server.gc import gc
+from devpi_server.gc import iter_files
+from devpi_server.gc import iter_garbage
+import os
+import pytest
+
+
+def test_iter_files(tmpdir):
+    tmpdir.ensure("a")
+    tmpdir.ensure("b", "c")
+    tmpdir.ensure("b", "d", "e", "f")
+    tmpdir.ensure("g", dir=1)
+    assert sorted(iter_files(tmpdir.strpath, workers=2)) == [
+        "a", "b/c", "b/d/e/f"]
+    assert list(iter_files(tmpdir.join("missing").strpath)) == []
+
+
+@pytest.mark.notransaction
+@pytest.mark.storage_with_filesystem
+def test_iter_garbage(xom):
+    serverdir = xom.config.serverdir
+    filestore = xom.filestore
+    with xom.keyfs.transaction(write=True):
+        live = filestore.store("root", "dev", "live-1.0.zip", b"live")
+        deleted = filestore.store("root", "dev", "deleted-1.0.zip", b"gone")
+    with xom.keyfs.transaction(write=True):
+        filestore.get_file_entry(deleted.relpath, readonly=False).delete()
+    files_path = serverdir.join("+files")
+    partial_path = serverdir.join("+partial")
+    live_path = files_path.join(live.relpath)
+    assert live_path.exists()
+    orphan = files_path.join(deleted.relpath).ensure()
+    tmp = files_path.join(live.relpath + "-0123abcd-tmp").ensure()
+    # the partial download of an existing file is garbage
+    finished = partial_path.join(live.relpath).ensure()
+    with xom.keyfs.transaction(write=True):
+        entry = filestore.store("root", "dev", "resume-1.0.zip", b"resume")
+        entry.file_delete()
+        resumable = partial_path.join(entry.relpath).ensure()
+    with xom.keyfs.transaction(write=False) as tx:
+        garbage = sorted(iter_garbage(
+            tx, files_path.strpath, partial_path.strpath))
+    assert garbage == sorted([
+        ("orphan", orphan.strpath),
+        ("tmp", tmp.strpath),
+        ("partial", finished.strpath)])
+    assert resumable.exists()
+    # recently modified files might belong to running transactions
+    os.utime(orphan.strpath, (1000, 1000))
+    with xom.keyfs.transaction(write=False) as tx:
+        garbage = list(iter_garbage(
+            tx, files_path.strpath, partial_path.strpath,
+            keep_newer_than=2000))
+    assert garbage == [("orphan", orphan.strpath)]
+
+
+def test_gc_cmdline(tmpdir):
+    from devpi_server.init import init
+    init(argv=["devpi-init", "--serverdir", tmpdir])
+    orphan = tmpdir.join("+files", "root", "pypi", "+f", "123", "456", "orphan-1.0.zip")
+    orphan.ensure()
+    # the file is too new by default
+    assert gc(argv=["devpi-gc", "--serverdir", tmpdir]) == 0
+    assert orphan.exists()
+    assert gc(argv=[
+        "devpi-gc", "--serverdir", tmpdir, "--min-age", "0", "--dry-run"]) == 0
+    assert orphan.exists()
+    assert gc(argv=["devpi-gc", "--serverdir", tmpdir, "--min-age", "0"]) == 0
+    assert not orphan.exists()
+
+
+def test_gc_cmdline_blob_storage(capfd, tmpdir):
+    from devpi_server.init import init
+    serverdir = tmpdir.join("server")
+    blob_storage = "fs:path=%s" % tmpdir.join("blobs")
+    init(argv=[
+        "devpi-init", "--serverdir", serverdir,
+        "--blob-storage", blob_storage])
+    orphan = tmpdir.join("blobs", "+files", "orphan-1.0.zip").ensure()
+    assert gc(argv=[
+        "devpi-gc", "--serverdir", serverdir,
+        "--blob-storage", blob_storage, "--min-age", "0"]) == 1
+    assert "not collected" in capfd.readouterr().err
+    assert orphan.exists()
+
+
+def test_gc_cmdline_tiers(tmpdir):
+    from devpi_server.init import init
+    serverdir = tmpdir.join("server")
+    cold_dir = tmpdir.join("cold")
+    storage = "sqlite:cold_dir=%s,hot_cache_size=1K" % cold_dir
+    init(argv=["devpi-init", "--serverdir", serverdir, "--storage", storage])
+    relpath = ("+files", "root", "pypi", "+f", "123", "456", "orphan-1.0.zip")
+    orphan = serverdir.join(*relpath).ensure()
+    cold_orphan = cold_dir.join(*relpath).ensure()
+    assert gc(argv=[
+        "devpi-gc", "--serverdir", serverdir, "--storage", storage,
+        "--min-age", "0"]) == 0
+    assert not orphan.exists()
+    assert not cold_orphan.exists()
@@ -507,6 +507,96 @@ class TestTransactionIsolation:
             assert tx.conn.get_raw_changelog_entry(10000) is None
 
 
+@notransaction
+class TestDeltaRecords:
+    def get_raw_value(self, keyfs, key, serial):
+        from devpi_server.fileutil import loads
+        with keyfs.transaction() as tx:
+            raw_entry = tx.conn.get_raw_changelog_entry(serial)
+        return loads(raw_entry)[0][key.relpath][2]
+
+    @pytest.mark.parametrize("old, new", [
+        ({1, 2, 3}, {2, 3, 4}),
+        ({"a": 1, "b": [1, 2, 3], "c": {"d": 1}},
+         {"a": 2, "b": [1, 5, 3, 4], "c": {"e": 2}}),
+        ([1, 2, 3], [0, 1, 2, 3]),
+        ([1, 2, 3], [1, 3]),
+        ({"a": [1]}, {"a": (1,)})])
+    def test_patch_roundtrip(self, old, new):
+        from copy import deepcopy
+        from devpi_server.keyfs_delta import apply_patch, make_patch
+        patch = make_patch(old, new)
+        assert apply_patch(deepcopy(old), patch) == new
+
+    def test_set_delta(self, keyfs):
+        from devpi_server.keyfs_delta import is_delta
+        S = keyfs.add_key("NAME", "hello", set)
+        names = set("project%04d" % i for i in range(500))
+        with keyfs.transaction(write=True):
+            S.set(names)
+        with keyfs.transaction(write=True) as tx:
+            S.set(names | {"new"})
+        serial = tx.commit_serial
+        assert not is_delta(self.get_raw_value(keyfs, S, serial - 1))
+        assert self.get_raw_value(keyfs, S, serial)[2] == ("s", ["new"], [])
+        with keyfs.transaction() as tx:
+            assert tx.get_value_at(S, serial - 1) == names
+            assert tx.get_value_at(S, serial) == names | {"new"}
+            assert S.get() == names | {"new"}
+
+    def test_dict_delta(self, keyfs):
+        from devpi_server.keyfs_delta import is_delta
+        D = keyfs.add_key("NAME", "hello", dict)
+        links = [dict(href="pkg-%s.zip" % i, hash="sha256=%064d" % i)
+                 for i in range(50)]
+        with keyfs.transaction(write=True):
+            D.set({"name": "pkg", "+elinks": links})
+        with keyfs.transaction(write=True) as tx:
+            D.set({"name": "pkg", "+elinks": links + [dict(href="new.zip")]})
+        value = self.get_raw_value(keyfs, D, tx.commit_serial)
+        assert is_delta(value)
+        assert value[2] == ("d", {"+elinks": ("l", 50, 50, [{"href": "new.zip"}])}, [])
+        with keyfs.transaction():
+            assert D.get()["+elinks"][-1] == {"href": "new.zip"}
+            assert len(D.get()["+elinks"]) == 51
+
+    def test_snapshot(self, keyfs, monkeypatch):
+        from devpi_server import keyfs_delta
+        monkeypatch.setattr(keyfs_delta, "MAX_DELTA_CHAIN", 2)
+        S = keyfs.add_key("NAME", "hello", set)
+        names = set("project%04d" % i for i in range(500))
+        with keyfs.transaction(write=True):
+            S.set(names)
+        depths = []
+        for i in range(4):
+            names.add("new%s" % i)
+            with keyfs.transaction(write=True) as tx:
+                S.set(names)
+            value = self.get_raw_value(keyfs, S, tx.commit_serial)
+            depths.append(value[1] if keyfs_delta.is_delta(value) else 0)
+        assert depths == [1, 2, 0, 1]
+        with keyfs.transaction():
+            assert S.get() == names
+
+    def test_import_changes(self, keyfs, storage, tmpdir):
+        from devpi_server.fileutil import loads
+        S = keyfs.add_key("NAME", "hello", set)
+        names = set("project%04d" % i for i in range(500))
+        with keyfs.transaction(write=True):
+            S.set(names)
+        with keyfs.transaction(write=True):
+            S.set(names | {"new"})
+        new_keyfs = KeyFS(tmpdir.join("newkeyfs"), storage)
+        S2 = new_keyfs.add_key("NAME", "hello", set)
+        for serial in range(2):
+            with keyfs.transaction() as tx:
+                raw_entry = tx.conn.get_raw_changelog_entry(serial)
+            new_keyfs.import_changes(serial, loads(raw_entry)[0])
+        with new_keyfs.transaction() as tx:
+            assert tx.get_value_at(S2, 0) == names
+            assert S2.get() == names | {"new"}
+
+
 @notransaction
 class TestDeriveKey:
     def test_direct_from_file(self, keyfs):
@@ -70,3 +70,38 @@ class TestRenameFileLogic:
                 # abort transaction
                 raise RuntimeError
         assert not os.path.exists(tmppath)
+
+
+@pytest.mark.no_storage_option
+@pytest.mark.storage_with_filesystem
+@pytest.mark.notransaction
+@pytest.mark.skipif("sys.platform == 'win32'")
+def test_fsync_on_commit(makexom, monkeypatch):
+    from devpi_server import keyfs_sqlite_fs
+    xom = makexom(opts=["--storage", "sqlite:fsync=yes"])
+    synced_files = []
+    fsync_file = keyfs_sqlite_fs.fsync_file
+
+    def record_fsync_file(path):
+        synced_files.append(path)
+        fsync_file(path)
+
+    synced_dirs = []
+    fsync = os.fsync
+
+    def record_fsync(fd):
+        synced_dirs.append(os.fstat(fd).st_ino)
+        fsync(fd)
+
+    monkeypatch.setattr(keyfs_sqlite_fs, "fsync_file", record_fsync_file)
+    monkeypatch.setattr(os, "fsync", record_fsync)
+    with xom.keyfs.transaction(write=True) as tx:
+        tx.conn.io_file_set("+files/a/b", b"b")
+        tx.conn.io_file_set("+files/a/c", b"c")
+        tmppaths = sorted(x.tmppath for x in tx.conn.dirty_files.values())
+    assert sorted(synced_files) == tmppaths
+    basedir = xom.keyfs.basedir
+    dirs = [basedir, basedir.join("+files"), basedir.join("+files", "a")]
+    # each directory is synced before the commit and after the renames
+    assert sorted(synced_dirs) == sorted(2 * [x.stat().ino for x in dirs])
+    assert basedir.join("+files", "a", "b").read_binary() == b"b"
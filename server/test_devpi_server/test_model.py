@@ -81,6 +81,145 @@ def test_has_mirror_base(model, pypistage):
     assert stage2.has_mirror_base("pytest")
 
 
+@pytest.mark.notransaction
+def test_sro_cache(model, xom):
+    sro_cache = model.sro_cache
+    with xom.keyfs.transaction(write=True):
+        user = model.create_user("user1", "pass")
+        user.create_stage("stage1", bases=())
+        user.create_stage("stage2", bases=("user1/stage1",))
+    with xom.keyfs.transaction():
+        stage = model.getstage("user1/stage2")
+        assert [x.name for x in stage.sro()] == ["user1/stage2", "user1/stage1"]
+        (hits, misses) = (sro_cache.hits, sro_cache.misses)
+        assert [x.name for x in stage.sro()] == ["user1/stage2", "user1/stage1"]
+        assert (sro_cache.hits, sro_cache.misses) == (hits + 1, misses)
+    with xom.keyfs.transaction(write=True):
+        stage = model.getstage("user1/stage2")
+        stage.modify(bases=())
+        # the changed config isn't committed yet, so the cache is skipped
+        assert [x.name for x in stage.sro()] == ["user1/stage2"]
+    with xom.keyfs.transaction():
+        stage = model.getstage("user1/stage2")
+        assert [x.name for x in stage.sro()] == ["user1/stage2"]
+
+
+@pytest.mark.notransaction
+def test_stage_cache(model, xom):
+    stage_cache = model.stage_cache
+    with xom.keyfs.transaction(write=True):
+        user = model.create_user("user1", "pass")
+        user.create_stage("stage1", bases=())
+        # write transactions get fresh objects
+        assert model.getstage("user1/stage1") is not model.getstage("user1/stage1")
+    with xom.keyfs.transaction():
+        stage = model.getstage("user1/stage1")
+        assert model.getstage("user1/stage1") is stage
+        stage.offline = True
+    (hits, misses) = (stage_cache.hits, stage_cache.misses)
+    with xom.keyfs.transaction():
+        stage2 = model.getstage("user1/stage1")
+        # a new transaction gets its own copy of the cached stage
+        assert stage2 is not stage
+        assert stage2.customizer.stage is stage2
+        assert not hasattr(stage2, "offline")
+    assert (stage_cache.hits, stage_cache.misses) == (hits + 1, misses)
+    with xom.keyfs.transaction(write=True):
+        model.getstage("user1/stage1").modify(title="foo")
+    with xom.keyfs.transaction():
+        stage3 = model.getstage("user1/stage1")
+        assert stage3.ixconfig["title"] == "foo"
+    assert stage_cache.misses == misses + 1
+
+
+@pytest.mark.notransaction
+def test_simplelinks_cache(model, xom):
+    cache = model.simplelinks_cache
+    with xom.keyfs.transaction(write=True):
+        user = model.create_user("user1", "pass")
+        stage1 = user.create_stage("stage1", bases=())
+        stage2 = user.create_stage("stage2", bases=("user1/stage1",))
+        register_and_store(stage1, "pkg-1.0.zip")
+        register_and_store(stage2, "pkg-1.1.zip")
+    with xom.keyfs.transaction():
+        stage = model.getstage("user1/stage2")
+        links = stage.get_simplelinks("pkg")
+        assert [x[0] for x in links] == ["pkg-1.1.zip", "pkg-1.0.zip"]
+        (hits, misses) = (cache.hits, cache.misses)
+        assert stage.get_simplelinks("pkg") == links
+        assert (cache.hits, cache.misses) == (hits + 1, misses)
+    with xom.keyfs.transaction(write=True):
+        register_and_store(model.getstage("user1/stage1"), "pkg-1.2.zip")
+        # write transactions don't use the cache
+        links = model.getstage("user1/stage2").get_simplelinks("pkg")
+        assert [x[0] for x in links] == [
+            "pkg-1.2.zip", "pkg-1.1.zip", "pkg-1.0.zip"]
+        assert (cache.hits, cache.misses) == (hits + 1, misses)
+    with xom.keyfs.transaction():
+        links = model.getstage("user1/stage2").get_simplelinks("pkg")
+        assert [x[0] for x in links] == [
+            "pkg-1.2.zip", "pkg-1.1.zip", "pkg-1.0.zip"]
+
+
+def test_simplelinks_cache_invalidate(model, monkeypatch):
+    from devpi_server.model import SimpleLinksCache
+    event_serial = 4
+    monkeypatch.setattr(
+        model.keyfs.notifier, "read_event_serial", lambda: event_serial)
+    cache = SimpleLinksCache(model.keyfs)
+    cache.put("user/index", "pkg", 5, ("link",))
+    cache.put("user/index", "other", 5, ("link",))
+    assert cache.get("user/index", "pkg", 5) == ("link",)
+    # the notifier hasn't seen the newer serial yet
+    assert cache.get("user/index", "pkg", 7) is None
+    event_serial = 7
+    assert cache.get("user/index", "pkg", 7) == ("link",)
+    cache.invalidate_project("pkg", 6)
+    assert cache.get("user/index", "pkg", 7) is None
+    assert cache.get("user/index", "other", 7) == ("link",)
+    cache.invalidate(6)
+    assert cache.get("user/index", "other", 7) is None
+
+
+def test_simplelinks_cache_changed_projects_bounded(model, monkeypatch):
+    from devpi_server.model import SimpleLinksCache
+    monkeypatch.setattr(
+        model.keyfs.notifier, "read_event_serial", lambda: 10)
+    cache = SimpleLinksCache(model.keyfs)
+    cache.max_changed_projects = 2
+    cache.put("user/index", "pkg", 5, ("link",))
+    cache.invalidate_project("foo", 4)
+    cache.invalidate_project("bar", 6)
+    assert cache.get("user/index", "pkg", 10) == ("link",)
+    cache.invalidate_project("baz", 7)
+    # the oldest change was dropped
+    assert list(cache.project_change_serials) == ["bar", "baz"]
+    assert cache.project_change_floor_serial == 4
+    assert cache.get("user/index", "pkg", 10) == ("link",)
+    cache.invalidate_project("ham", 8)
+    # projects without a tracked change count as changed at the floor
+    assert cache.project_change_floor_serial == 6
+    assert cache.get("user/index", "pkg", 10) is None
+
+
+def test_sro_cache_invalidate(model, monkeypatch):
+    from devpi_server.model import SROCache
+    event_serial = 4
+    monkeypatch.setattr(
+        model.keyfs.notifier, "read_event_serial", lambda: event_serial)
+    sro_cache = SROCache(model.keyfs)
+    sro_cache.put("user/index", 5, ["stage"])
+    assert sro_cache.get("user/index", 5) == ["stage"]
+    # the notifier hasn't seen the newer serial yet
+    assert sro_cache.get("user/index", 7) is None
+    event_serial = 7
+    assert sro_cache.get("user/index", 7) == ["stage"]
+    assert sro_cache.get("user/index", 4) is None
+    sro_cache.invalidate(6)
+    assert sro_cache.get("user/index", 7) is None
+    assert sro_cache.get("user/index", 5) is None
+
+
 def test_get_mirror_whitelist_info(model, pypistage):
     pypistage.mock_simple("pytest", "<a href='pytest-1.0.zip' /a>")
     assert pypistage.get_mirror_whitelist_info("pytest") == dict(
@@ -394,6 +533,25 @@ class TestStage:
         assert len(links) == 1
         assert links[0]["entrypath"].endswith("some-1.0.zip")
 
+    def test_store_releasefile_dist_info_metadata(self, stage, bases):
+        metadata = b"Metadata-Version: 2.1\nName: some\nVersion: 1.0\n"
+        content = zip_dict({
+            "some": {"__init__.py": ""},
+            "some-1.0.dist-info": {"METADATA": metadata}})
+        link = register_and_store(stage, "some-1.0-py3-none-any.whl", content)
+        register_and_store(stage, "some-1.0.zip", b"123")
+        md_entry = stage.xom.filestore.get_file_entry(
+            link.entrypath + ".metadata")
+        assert md_entry.file_get_content() == metadata
+        assert md_entry.project == "some"
+        assert md_entry.version == "1.0"
+        assert link.dist_info_metadata == md_entry.hash_spec
+        assert stage.get_dist_info_metadata_perstage("some") == {
+            link.entrypath: md_entry.hash_spec}
+        stage.del_entry(link.entry)
+        assert stage.get_dist_info_metadata_perstage("some") == {}
+        assert not md_entry.file_exists()
+
     def test_store_releasefile_fails_if_not_registered(self, stage):
         with pytest.raises(stage.MissesRegistration):
             stage.store_releasefile("someproject", "1.0",
@@ -982,6 +1140,38 @@ class TestStage:
         stage.set_versiondata(udict(name="hello", version="0.9"))
         assert stage.get_latest_version_perstage("hello") == "1.1"
 
+    def test_get_latest_versions_perstage(self, stage):
+        stage.set_versiondata(udict(name="hello", version="1.0"))
+        stage.set_versiondata(udict(name="hello", version="1.1rc1"))
+        assert stage.key_projlatest("hello").get() == dict(
+            latest="1.1rc1", stable="1.0")
+        assert stage.get_latest_version_perstage("hello") == "1.1rc1"
+        assert stage.get_latest_version_perstage("hello", stable=True) == "1.0"
+        stage.del_versiondata("hello", "1.1rc1")
+        assert stage.get_latest_versions_perstage("hello") == dict(
+            latest="1.0", stable="1.0")
+        stage.del_project("hello")
+        assert not stage.key_projlatest("hello").exists()
+
+    def test_get_latest_versions_perstage_legacy(self, stage):
+        stage.set_versiondata(udict(name="hello", version="1.0"))
+        stage.set_versiondata(udict(name="hello", version="2.0a1"))
+        # projects stored before the key existed don't have it
+        stage.key_projlatest("hello").delete()
+        assert stage.get_latest_version_perstage("hello") == "2.0a1"
+        assert stage.get_latest_version_perstage("hello", stable=True) == "1.0"
+
+    def test_get_latest_version_inheritance(self, user, model, stage):
+        stage_base_name = stage.index + "base"
+        user.create_stage(index=stage_base_name, bases=(stage.name,))
+        stage_sub = model.getstage(stage.username, stage_base_name)
+        stage_sub.set_versiondata(udict(name="hello", version="1.0"))
+        stage.set_versiondata(udict(name="hello", version="1.1"))
+        stage.set_versiondata(udict(name="hello", version="1.2.dev1"))
+        assert stage_sub.get_latest_version("hello") == "1.2.dev1"
+        assert stage_sub.get_latest_version("hello", stable=True) == "1.1"
+        assert stage_sub.get_latest_version("other") is None
+
     def test_get_versiondata_latest_inheritance(self, user, model, stage):
         stage_base_name = stage.index + "base"
         user.create_stage(index=stage_base_name, bases=(stage.name,))
@@ -1120,6 +1310,34 @@ class TestStage:
         assert stage.get_versiondata("hello", "1.0")
         assert stage.get_versiondata("This", "1.0")
 
+    def test_project_names_sharded(self, stage):
+        keyfs = stage.keyfs
+        for name in ("hello", "world", "pkg"):
+            stage.add_project_name(name)
+        assert stage.list_projects_perstage() == {"hello", "world", "pkg"}
+        assert not keyfs.PROJNAMES(user=stage.username, index=stage.index).exists()
+        shards = keyfs.PROJNAMESSHARDS(user=stage.username, index=stage.index).get()
+        assert len(shards) > 1
+        key = stage.key_projects.key_project_shard("hello")
+        assert "hello" in key.get()
+        assert "world" not in key.get()
+        assert stage.has_project_perstage("Hello")
+        stage.del_project("hello")
+        assert not stage.has_project_perstage("hello")
+        assert stage.list_projects_perstage() == {"world", "pkg"}
+
+    def test_project_names_legacy(self, stage):
+        keyfs = stage.keyfs
+        key_legacy = keyfs.PROJNAMES(user=stage.username, index=stage.index)
+        key_legacy.set({"hello", "world"})
+        assert stage.list_projects_perstage() == {"hello", "world"}
+        assert stage.has_project_perstage("world")
+        # the first write moves the names into the shards
+        stage.add_project_name("pkg")
+        assert not key_legacy.exists()
+        assert stage.list_projects_perstage() == {"hello", "world", "pkg"}
+        assert "world" in stage.key_projects.key_project_shard("world").get()
+
     @pytest.mark.notransaction
     def test_get_last_change_serial_perstage(self, xom):
         current_serial = xom.keyfs.get_current_serial()
@@ -1215,6 +1433,37 @@ class TestStage:
         with xom.keyfs.transaction(write=False):
             assert stage.get_last_change_serial_perstage() == serial_before_new_stage
 
+    @pytest.mark.notransaction
+    def test_get_last_change_serial_perstage_key(self, xom):
+        model = xom.model
+        with xom.keyfs.transaction(write=True):
+            user = model.create_user("hello", password="123")
+            stage = user.create_stage(index="world", type="stage")
+            user.create_stage(index="mirror", type="mirror")
+        created_serial = xom.keyfs.get_current_serial()
+        with xom.keyfs.transaction(write=False):
+            assert stage.key_lastchange.get() == created_serial
+            assert stage.get_last_change_serial_perstage() == created_serial
+            assert not xom.keyfs.STAGELASTCHANGE(
+                user="hello", index="mirror").exists()
+        with xom.keyfs.transaction(write=True):
+            stage.set_versiondata(udict(name="pkg", version="1.0"))
+        current_serial = xom.keyfs.get_current_serial()
+        with xom.keyfs.transaction(write=False):
+            assert stage.key_lastchange.get() == current_serial
+            assert stage.get_last_change_serial_perstage() == current_serial
+            assert stage.get_last_change_serial_perstage(
+                at_serial=created_serial) == created_serial
+        # stages changed before the key existed use the fallback
+        with xom.keyfs.transaction(write=True):
+            stage.key_lastchange.delete()
+        with xom.keyfs.transaction(write=False):
+            assert stage.get_last_change_serial_perstage() == current_serial
+        with xom.keyfs.transaction(write=True):
+            stage.delete()
+        with xom.keyfs.transaction(write=False):
+            assert not stage.key_lastchange.exists()
+
     @pytest.mark.notransaction
     def test_get_last_project_change_serial_perstage(self, xom):
         with xom.keyfs.transaction(write=True) as tx:
@@ -1238,8 +1487,7 @@ class TestStage:
         with xom.keyfs.transaction(write=True) as tx:
             # no change in db yet
             assert tx.at_serial == (first_serial + 1)
-            with stage.key_projects.update() as projects:
-                projects.remove('pkg')
+            assert stage.key_projects.discard('pkg')
             assert stage.list_projects_perstage() == set()
         with xom.keyfs.transaction() as tx:
             # the deletion of the project name updated the db
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import hashlib
+import json
 import os
 import pytest
 from devpi_server.log import thread_pop_log
@@ -46,11 +47,13 @@ class TestChangelog:
 
     @pytest.fixture(params=[False, True])
     def reqchangelog(self, request, auth_serializer, testapp, xom):
-        def reqchangelog(serial):
+        def reqchangelog(serial, headers=None):
             token = auth_serializer.dumps(self.replica_uuid)
             req_headers = {H_REPLICA_UUID: self.replica_uuid,
                            H_REPLICA_OUTSIDE_URL: self.replica_url,
                            str('Authorization'): 'Bearer %s' % token}
+            if headers:
+                req_headers.update(headers)
             url = "/+changelog/%s" % serial
             use_multi_endpoint = request.param
             if use_multi_endpoint:
@@ -76,6 +79,32 @@ class TestChangelog:
         data = loads(body)
         assert "this" in str(data)
 
+    def test_deltas(self, testapp, noiter, reqchangelog, xom):
+        from devpi_server.keyfs_delta import is_delta
+        from devpi_server.replica import H_REPLICA_DELTAS
+        key = xom.keyfs.add_key("BIGSET", "bigset", set)
+        names = set("project%04d" % i for i in range(500))
+        with xom.keyfs.transaction(write=True):
+            key.set(names)
+        with xom.keyfs.transaction(write=True):
+            key.set(names | {"new"})
+        latest_serial = self.get_latest_serial(testapp)
+
+        def get_value(headers=None):
+            data = loads(b''.join(
+                reqchangelog(latest_serial, headers=headers).app_iter))
+            if isinstance(data, list):
+                ((serial, changes),) = data
+            else:
+                (changes, rel_renames) = data
+            return changes["bigset"][2]
+
+        # older replicas get the full value
+        assert get_value() == names | {"new"}
+        value = get_value(headers={H_REPLICA_DELTAS: "1"})
+        assert is_delta(value)
+        assert value[2] == ("s", ["new"], [])
+
     def test_wait_entry_fails(self, testapp, mapp, noiter, monkeypatch,
                                     reqchangelog):
         mapp.create_user("this", password="p")
@@ -156,6 +185,83 @@ class TestMultiChangelog:
         assert isinstance(data, list)
         assert len(data) < latest_serial
 
+    def test_batch_cache(self, mapp, noiter, reqchangelogs, testapp, xom):
+        mapp.create_user("this", password="p")
+        latest_serial = self.get_latest_serial(testapp)
+        cache = xom.changelog_batch_cache
+        body1 = b''.join(reqchangelogs(0).app_iter)
+        assert (cache.hits, cache.misses) == (0, 1)
+        body2 = b''.join(reqchangelogs(0).app_iter)
+        assert (cache.hits, cache.misses) == (1, 1)
+        assert body1 == body2
+        mapp.create_user("that", password="p")
+        # the cached batch is still valid, it just ends earlier
+        data = loads(b''.join(reqchangelogs(0).app_iter))
+        assert data[-1][0] == latest_serial
+        data = loads(b''.join(reqchangelogs(latest_serial + 1).app_iter))
+        assert "that/.config" in str(data[-1])
+        assert (cache.hits, cache.misses) == (2, 2)
+
+
+class TestChangelogBatchCache:
+    @pytest.fixture
+    def cache(self):
+        from devpi_server.replica import ChangelogBatchCache
+        return ChangelogBatchCache(max_size=10)
+
+    def test_build_once(self, cache):
+        built = []
+
+        def build():
+            built.append(1)
+            return b'123'
+
+        assert cache.get_or_build(0, build) == b'123'
+        assert cache.get_or_build(0, build) == b'123'
+        assert built == [1]
+        assert cache.size == 3
+
+    def test_evictions(self, cache):
+        cache.put(0, b'1234')
+        cache.put(1, b'1234')
+        # access makes 0 the most recently used one
+        assert cache.get(0) == b'1234'
+        cache.put(2, b'1234')
+        assert cache.evictions == 1
+        assert cache.get(1) is None
+        assert cache.get(0) == b'1234'
+        assert cache.size == 8
+        # too big batches aren't cached at all
+        cache.put(3, b'12345678901')
+        assert cache.get(3) is None
+        assert cache.size == 8
+
+    def test_concurrent_build(self, cache):
+        import threading
+        started = threading.Event()
+        release = threading.Event()
+        built = []
+        results = []
+
+        def build():
+            built.append(1)
+            started.set()
+            release.wait()
+            return b'123'
+
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(cache.get_or_build(0, build)))
+            for i in range(3)]
+        for thread in threads:
+            thread.start()
+        started.wait()
+        release.set()
+        for thread in threads:
+            thread.join()
+        assert built == [1]
+        assert results == [b'123'] * 3
+
 
 def get_raw_changelog_entry(xom, serial):
     with xom.keyfs._storage.get_connection() as conn:
@@ -398,6 +504,188 @@ class TestProxyViewToMaster:
         assert 'keep-alive' not in response.headers
 
 
+class TestFilesManifest:
+    replica_uuid = "111"
+
+    @pytest.fixture
+    def reqmanifest(self, auth_serializer, testapp):
+        def reqmanifest():
+            token = auth_serializer.dumps(self.replica_uuid)
+            r = testapp.get("/+files-manifest", headers={
+                H_REPLICA_UUID: self.replica_uuid,
+                str('Authorization'): 'Bearer %s' % token})
+            assert r.status_code == 200
+            return r
+        return reqmanifest
+
+    def test_manifest(self, mapp, reqmanifest, xom):
+        api = mapp.create_and_use()
+        content = mapp.makepkg("hello-1.0.zip", b"content1", "hello", "1.0")
+        mapp.upload_file_pypi("hello-1.0.zip", content, "hello", "1.0")
+        r = reqmanifest()
+        assert r.headers["X-DEVPI-SERIAL"] == str(xom.keyfs.get_current_serial())
+        (line,) = r.body.splitlines()
+        (relpath, hash_spec, size, serial) = json.loads(line)
+        assert relpath.startswith("%s/+f/" % api.stagename)
+        assert hash_spec == "sha256=%s" % hashlib.sha256(content).hexdigest()
+        assert size == len(content)
+        assert serial <= xom.keyfs.get_current_serial()
+
+    def test_not_for_users(self, mapp, testapp):
+        testapp.get("/+files-manifest", status=403)
+        testapp.post_json("/+files-bundle", [], status=403)
+        mapp.create_and_login_user("hello")
+        testapp.get("/+files-manifest", status=403)
+        testapp.post_json("/+files-bundle", [], status=403)
+
+    def test_manifest_deleted(self, mapp, reqmanifest):
+        mapp.create_and_use()
+        content = mapp.makepkg("hello-1.0.zip", b"content1", "hello", "1.0")
+        mapp.upload_file_pypi("hello-1.0.zip", content, "hello", "1.0")
+        mapp.delete_project("hello")
+        r = reqmanifest()
+        assert r.body == b""
+
+    def test_bundle(self, auth_serializer, mapp, testapp):
+        mapp.create_and_use()
+        content1 = mapp.makepkg("hello-1.0.zip", b"content1", "hello", "1.0")
+        mapp.upload_file_pypi("hello-1.0.zip", content1, "hello", "1.0")
+        (path,) = mapp.get_release_paths("hello")
+        relpath = path[1:]
+        token = auth_serializer.dumps(self.replica_uuid)
+        r = testapp.post_json(
+            "/+files-bundle", [relpath, "root/pypi/+f/123/456/foo.zip"],
+            headers={
+                H_REPLICA_UUID: self.replica_uuid,
+                str('Authorization'): 'Bearer %s' % token})
+        assert r.status_code == 200
+        expected = b"".join([
+            json.dumps([relpath, len(content1)]).encode('utf-8'), b"\n",
+            content1,
+            json.dumps(["root/pypi/+f/123/456/foo.zip", None]).encode('utf-8'),
+            b"\n"])
+        assert r.body == expected
+
+    def import_changes(self, xom, replica_xom):
+        # import without queuing any files
+        for serial in range(replica_xom.keyfs.get_next_serial(), xom.keyfs.get_next_serial()):
+            with xom.keyfs._storage.get_connection() as conn:
+                replica_xom.keyfs.import_changes(serial, conn.get_changes(serial))
+
+    def test_queue_missing_files(self, auth_serializer, mapp, patch_reqsessionmock, reqmanifest, replica_xom, testapp, xom):
+        mapp.create_and_use()
+        content1 = mapp.makepkg("hello-1.0.zip", b"content1", "hello", "1.0")
+        mapp.upload_file_pypi("hello-1.0.zip", content1, "hello", "1.0")
+        content2 = mapp.makepkg("hello-1.1.zip", b"content2", "hello", "1.1")
+        mapp.upload_file_pypi("hello-1.1.zip", content2, "hello", "1.1")
+        (path1, path2) = sorted(mapp.get_release_paths("hello"))
+        self.import_changes(xom, replica_xom)
+        replica_thread = replica_xom.replica_thread
+        shared_data = replica_thread.shared_data
+        assert shared_data.queue.qsize() == 0
+        # one of the files already exists on the replica
+        with replica_xom.keyfs._storage.get_connection(write=True) as conn:
+            conn.io_file_set("+files" + path1, content1)
+            conn.commit_files_without_increasing_serial()
+        initial_queue_thread = replica_thread.initial_queue_thread
+        rmock = patch_reqsessionmock(initial_queue_thread.session)
+        master_url = replica_xom.config.master_url
+        rmock.mockresponse(
+            master_url.joinpath("+files-manifest").url,
+            code=200, data=reqmanifest().body)
+        token = auth_serializer.dumps(self.replica_uuid)
+        bundle = testapp.post_json(
+            "/+files-bundle", [path2[1:]],
+            headers={
+                H_REPLICA_UUID: self.replica_uuid,
+                str('Authorization'): 'Bearer %s' % token})
+        reply = rmock.mockresponse(
+            master_url.joinpath("+files-bundle").url,
+            code=200, method="POST", data=bundle.body)
+        initial_queue_thread.queue_missing_files()
+        # the missing file was fetched in a bundle
+        (request,) = reply.requests
+        assert json.loads(request.body) == [path2[1:]]
+        assert shared_data.queue.qsize() == 0
+        with replica_xom.keyfs.transaction(write=False) as tx:
+            assert tx.conn.io_file_get("+files" + path2) == content2
+
+    def test_manifest_skips_existing_files(self, mapp, monkeypatch, reqmanifest, replica_xom, xom):
+        mapp.create_and_use()
+        content1 = mapp.makepkg("hello-1.0.zip", b"content1", "hello", "1.0")
+        mapp.upload_file_pypi("hello-1.0.zip", content1, "hello", "1.0")
+        content2 = mapp.makepkg("hello-1.1.zip", b"content2", "hello", "1.1")
+        mapp.upload_file_pypi("hello-1.1.zip", content2, "hello", "1.1")
+        (path1, path2) = sorted(mapp.get_release_paths("hello"))
+        self.import_changes(xom, replica_xom)
+        manifest = reqmanifest().body
+        initial_queue_thread = replica_xom.replica_thread.initial_queue_thread
+
+        class Response:
+            def iter_lines(self):
+                return iter(manifest.splitlines())
+
+            def close(self):
+                pass
+
+        with replica_xom.keyfs.transaction(write=False) as tx:
+            serials = []
+            orig_get_changes = tx.conn.get_changes
+
+            def get_changes(serial):
+                serials.append(serial)
+                return orig_get_changes(serial)
+
+            monkeypatch.setattr(tx.conn, "get_changes", get_changes)
+            items = list(initial_queue_thread._iter_manifest_items(
+                tx, Response(), {path1[1:]}))
+        ((item, size),) = items
+        assert "/" + item.relpath == path2
+        assert size == len(content2)
+        # the change of the existing file wasn't read
+        assert serials == [item.serial]
+
+    def test_queue_missing_files_bundle_fails(self, mapp, patch_reqsessionmock, reqmanifest, replica_xom, xom):
+        mapp.create_and_use()
+        content1 = mapp.makepkg("hello-1.0.zip", b"content1", "hello", "1.0")
+        mapp.upload_file_pypi("hello-1.0.zip", content1, "hello", "1.0")
+        (path,) = mapp.get_release_paths("hello")
+        self.import_changes(xom, replica_xom)
+        replica_thread = replica_xom.replica_thread
+        shared_data = replica_thread.shared_data
+        initial_queue_thread = replica_thread.initial_queue_thread
+        rmock = patch_reqsessionmock(initial_queue_thread.session)
+        master_url = replica_xom.config.master_url
+        rmock.mockresponse(
+            master_url.joinpath("+files-manifest").url,
+            code=200, data=reqmanifest().body)
+        rmock.mockresponse(
+            master_url.joinpath("+files-bundle").url,
+            code=404, method="POST", data=b"")
+        initial_queue_thread.queue_missing_files()
+        assert shared_data.queue.qsize() == 1
+        (is_from_mirror, serial, relpath, keyname, value, back_serial) = \
+            shared_data.queue.get()
+        assert "/" + relpath == path
+        assert keyname == "STAGEFILE"
+        assert value["hash_spec"]
+
+    def test_queue_missing_files_fallback(self, mapp, patch_reqsessionmock, replica_xom, xom):
+        mapp.create_and_use()
+        content1 = mapp.makepkg("hello-1.0.zip", b"content1", "hello", "1.0")
+        mapp.upload_file_pypi("hello-1.0.zip", content1, "hello", "1.0")
+        self.import_changes(xom, replica_xom)
+        replica_thread = replica_xom.replica_thread
+        initial_queue_thread = replica_thread.initial_queue_thread
+        rmock = patch_reqsessionmock(initial_queue_thread.session)
+        # an older master doesn't know the manifest
+        rmock.mockresponse(
+            replica_xom.config.master_url.joinpath("+files-manifest").url,
+            code=404, data=b"")
+        initial_queue_thread.queue_missing_files()
+        assert replica_thread.shared_data.queue.qsize() == 1
+
+
 def replay(xom, replica_xom, events=True):
     if replica_xom.replica_thread.replica_in_sync_at is None:
         # allow on_import to run right away, so we don't need to rely
@@ -494,6 +782,35 @@ class TestUseExistingFiles:
         # check the number of links of the file
         assert existing_path.stat().nlink == 2
 
+    @pytest.mark.storage_with_filesystem
+    @pytest.mark.skipif(not hasattr(os, 'link'),
+                        reason="OS doesn't support hard links")
+    def test_file_dedup(self, caplog, make_replica_xom, mapp, patch_reqsessionmock, xom):
+        # the master only tracks files with the same content with dedup
+        xom.keyfs.file_dedup = True
+        # prepare the same release on two indexes on master
+        api1 = mapp.create_and_use()
+        content1 = mapp.makepkg("hello-1.0.zip", b"content1", "hello", "1.0")
+        mapp.upload_file_pypi("hello-1.0.zip", content1, "hello", "1.0")
+        (path,) = mapp.get_release_paths('hello')
+        mapp.create_index("dev2")
+        mapp.use(api1.user + "/dev2")
+        mapp.upload_file_pypi("hello-1.0.zip", content1, "hello", "1.0")
+        # create the replica which hard links files with the same content
+        replica_xom = make_replica_xom(options=['--file-dedup'])
+        (frthread,) = replica_xom.replica_thread.file_replication_threads
+        frt_reqmock = patch_reqsessionmock(frthread.session)
+        # only the first file is fetched from master
+        frt_reqmock.mockresponse("http://localhost" + path, 200, data=content1)
+        replay(xom, replica_xom)
+        assert len(caplog.getrecords('checking file with same content')) == 1
+        with replica_xom.keyfs.transaction(write=False):
+            (path1, path2) = [
+                replica_xom.filestore.get_file_entry(x).file_os_path()
+                for x in sorted(replica_xom.keyfs.FILEBLOB(
+                    sha256=hashlib.sha256(content1).hexdigest()).get())]
+        assert os.path.samefile(path1, path2)
+
     def test_use_existing_files_bad_data(self, caplog, make_replica_xom, mapp, monkeypatch, patch_reqsessionmock, tmpdir, xom):
         # this will be the folder to find existing files in the replica
         existing_base = tmpdir.join('existing').ensure_dir()
@@ -639,6 +956,32 @@ class TestFileReplication:
         with replica_xom.keyfs.transaction():
             assert not r_entry.file_exists()
 
+    def test_fetch_resume(self, gen, patch_reqsessionmock, xom, replica_xom):
+        (frthread,) = replica_xom.replica_thread.file_replication_threads
+        frt_reqmock = patch_reqsessionmock(frthread.session)
+        replay(xom, replica_xom)
+        content1 = b'hello world'
+        md5 = hashlib.md5(content1).hexdigest()
+        link = gen.pypi_package_link("pytest-1.8.zip#md5=%s" % md5, md5=False)
+        with xom.keyfs.transaction(write=True):
+            entry = xom.filestore.maplink(link, "root", "pypi", "pytest")
+            entry.file_set_content(content1)
+        # the bytes of an earlier interrupted download
+        partial = replica_xom.filestore.get_partial_download(entry)
+        partial.path.write_binary(content1[:5], ensure=True)
+        master_url = replica_xom.config.master_url
+        master_file_path = master_url.joinpath(entry.relpath).url
+        reply = frt_reqmock.mockresponse(
+            master_file_path, code=206, data=content1[5:],
+            headers={"content-range": "bytes 5-10/11"})
+        replay(xom, replica_xom)
+        (request,) = reply.requests
+        assert request.headers["Range"] == "bytes=5-"
+        with replica_xom.keyfs.transaction():
+            r_entry = replica_xom.filestore.get_file_entry(entry.relpath)
+            assert r_entry.file_get_content() == content1
+        assert not partial.path.exists()
+
     def test_fetch_later_deleted(self, gen, reqmock, xom, replica_xom):
         replay(xom, replica_xom)
         content1 = b'hello'
@@ -1059,6 +1402,45 @@ class TestFileReplicationSharedData:
         assert shared_data.queue.qsize() == 0
         assert result == [100, 10, 1]
 
+    def test_demand_priority(self, shared_data):
+        result = []
+        mirror_file = 'root/pypi/+f/3f8/3058ac9076112/pytest-2.0.0.zip'
+        other_file = 'root/pypi/+f/274/e88b0b3d028fe/hello-2.1.0.zip'
+        stage_file = 'root/dev/+f/123/e88b0b3d028fe/other-1.0.zip'
+        # set the index_types cache to prevent db access
+        shared_data.index_types.put('root/pypi', 'mirror')
+        shared_data.index_types.put('root/dev', 'stage')
+
+        def handler(is_from_mirror, serial, key, keyname, value, back_serial):
+            result.append(key)
+
+        for relpath, project in (
+                (mirror_file, 'pytest'),
+                (other_file, 'hello'),
+                (stage_file, 'other')):
+            key = shared_data.xom.keyfs.get_key_instance('STAGEFILE', relpath)
+            shared_data.on_import(None, 0, key, dict(project=project), -1)
+        assert shared_data.queue.qsize() == 3
+        assert len(shared_data._queued_by_project) == 3
+        shared_data.demand('PyTest')
+        assert shared_data.demand_queue.qsize() == 1
+        assert shared_data.demand_bumps == 1
+        assert len(shared_data._queued_by_project) == 2
+        # files of the requested project come before anything else,
+        # the bumped item stays in the regular queue
+        for i in range(4):
+            shared_data.process_next(handler)
+        assert result == [mirror_file, stage_file, other_file, mirror_file]
+        assert shared_data._queued_by_project == {}
+        # later files of recently requested projects go to the front directly
+        result.clear()
+        key = shared_data.xom.keyfs.get_key_instance('STAGEFILE', mirror_file)
+        shared_data.on_import(None, 1, key, dict(project='pytest'), -1)
+        assert shared_data.demand_queue.qsize() == 1
+        assert shared_data.queue.qsize() == 0
+        shared_data.process_next(handler)
+        assert result == [mirror_file]
+
     def test_error_queued(self, shared_data):
         relpath = 'root/dev/+f/274/e88b0b3d028fe/pytest-2.1.0.zip'
         key = shared_data.xom.keyfs.get_key_instance('STAGEFILE', relpath)
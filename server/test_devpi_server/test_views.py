@@ -6,6 +6,7 @@ import pytest
 import py
 import json
 import posixpath
+from urllib.parse import unquote
 from bs4 import BeautifulSoup
 
 from pyramid.response import Response
@@ -446,6 +447,68 @@ def test_simple_page_pypi_serial(pypistage, testapp):
     assert "X-PYPI-LAST-SERIAL" not in r.headers
 
 
+def test_simple_page_dist_info_metadata(mapp, testapp):
+    metadata = b"Metadata-Version: 2.1\nName: pkg1\nVersion: 2.6\n"
+    content = zip_dict({"pkg1-2.6.dist-info": {"METADATA": metadata}})
+    md_hash_spec = get_default_hash_spec(metadata)
+    api = mapp.create_and_use()
+    mapp.upload_file_pypi("pkg1-2.6-py3-none-any.whl", content, "pkg1", "2.6")
+    mapp.upload_file_pypi("pkg1-2.6.tgz", b"123", "pkg1", "2.6")
+    r = testapp.get(api.index + "/+simple/pkg1/")
+    (wheel_link, sdist_link) = sorted(getlinks(r.text), key=lambda x: x.text)
+    assert wheel_link.get("data-dist-info-metadata") == md_hash_spec
+    assert wheel_link.get("data-core-metadata") == md_hash_spec
+    assert sdist_link.get("data-dist-info-metadata") is None
+    url = URL(r.request.url).joinpath(wheel_link.get("href")).url_nofrag
+    r = testapp.get(url + ".metadata")
+    assert r.body == metadata
+
+
+def test_simple_page_dist_info_metadata_mirror(pypistage, testapp):
+    metadata = b"Metadata-Version: 2.1\nName: hello\nVersion: 1.0\n"
+    content = zip_dict({"hello-1.0.dist-info": {"METADATA": metadata}})
+    hash_spec = get_default_hash_spec(content)
+    md_hash_spec = get_default_hash_spec(metadata)
+    pypistage.mock_simple("hello", text=(
+        '<a href="hello-1.0-py3-none-any.whl#%s" data-core-metadata="%s"/>'
+        '<a href="hello-1.0-py2-none-any.whl#%s"/>' % (
+            hash_spec, md_hash_spec, hash_spec)))
+
+    def mock_extfile(path, content):
+        # mimetypes doesn't know wheels, so the content type is set here
+        pypistage.xom.httpget.mockresponse(
+            URL(pypistage.mirror_url).joinpath(path).url,
+            content=content, headers={
+                "content-length": len(content),
+                "content-type": "application/octet-stream",
+                "last-modified": "today"})
+
+    mock_extfile(
+        "/simple/hello/hello-1.0-py3-none-any.whl.metadata", metadata)
+    mock_extfile("/simple/hello/hello-1.0-py2-none-any.whl", content)
+    r = testapp.get("/root/pypi/+simple/hello/")
+    simple_url = URL(r.request.url)
+    (py2_link, py3_link) = sorted(getlinks(r.text), key=lambda x: x.text)
+    # passed through from upstream
+    assert py3_link.get("data-dist-info-metadata") == md_hash_spec
+    url = simple_url.joinpath(py3_link.get("href")).url_nofrag
+    r = testapp.get(url + ".metadata")
+    assert r.body == metadata
+    # extracted once the wheel is cached and the links are refreshed
+    assert py2_link.get("data-dist-info-metadata") is None
+    url = simple_url.joinpath(py2_link.get("href")).url_nofrag
+    testapp.get(url)
+    r = testapp.get("/root/pypi/+simple/hello/")
+    (py2_link, py3_link) = sorted(getlinks(r.text), key=lambda x: x.text)
+    assert py2_link.get("data-dist-info-metadata") is None
+    pypistage.cache_retrieve_times.expire("hello")
+    r = testapp.get("/root/pypi/+simple/hello/")
+    (py2_link, py3_link) = sorted(getlinks(r.text), key=lambda x: x.text)
+    assert py2_link.get("data-dist-info-metadata") == md_hash_spec
+    r = testapp.get(url + ".metadata")
+    assert r.body == metadata
+
+
 def test_simple_refresh(mapp, model, pypistage, testapp):
     pypistage.mock_simple("hello", "<html/>")
     r = testapp.xget(200, "/root/pypi/+simple/hello/")
@@ -485,6 +548,68 @@ def test_inheritance_versiondata(mapp):
     assert len(r["result"]) == 1
 
 
+@pytest.mark.parametrize("path", [
+    "/+simple/package/", "/+simple/", "/package", "/package/1.0", ""])
+def test_etag_not_modified(mapp, testapp, path):
+    api1 = mapp.create_and_use()
+    mapp.upload_file_pypi("package-1.0.tar.gz", b'123',
+                          "package", "1.0", indexname=api1.stagename)
+    api2 = mapp.create_index(
+        "dev2", indexconfig={"bases": (api1.stagename,)})
+    mapp.upload_file_pypi("package-1.0.zip", b'456',
+                          "package", "1.0", indexname=api2.stagename)
+    headers = {"Accept": "application/json"}
+    r = testapp.get(api2.index + path, headers=headers)
+    assert r.status_code == 200
+    etag = r.headers["ETag"]
+    headers["If-None-Match"] = etag
+    r = testapp.get(api2.index + path, headers=headers)
+    assert r.status_code == 304
+    assert r.headers["ETag"] == etag
+    assert r.body == b""
+    # a change in a base invalidates the ETag
+    mapp.upload_file_pypi("package-1.1.tar.gz", b'789',
+                          "package", "1.1", indexname=api1.stagename)
+    r = testapp.get(api2.index + path, headers=headers)
+    assert r.status_code == 200
+    assert r.headers["ETag"] != etag
+
+
+def test_etag_simple_page_per_project(mapp, testapp):
+    api = mapp.create_and_use()
+    mapp.upload_file_pypi("package-1.0.tar.gz", b'123',
+                          "package", "1.0", indexname=api.stagename)
+    r = testapp.get(api.index + "/+simple/package/")
+    etag = r.headers["ETag"]
+    # changes to other projects keep the ETag of the simple page
+    mapp.upload_file_pypi("other-1.0.tar.gz", b'456',
+                          "other", "1.0", indexname=api.stagename)
+    r = testapp.get(
+        api.index + "/+simple/package/", headers={"If-None-Match": etag})
+    assert r.status_code == 304
+
+
+def test_etag_without_lastchange_key(mapp, model, testapp, xom):
+    api = mapp.create_and_use()
+    mapp.upload_file_pypi("package-1.0.tar.gz", b'123',
+                          "package", "1.0", indexname=api.stagename)
+    # like for stages which weren't changed since the key was introduced
+    with xom.keyfs.transaction(write=True):
+        model.getstage(api.stagename).key_lastchange.delete()
+    r = testapp.get(api.index, headers={"Accept": "application/json"})
+    assert r.status_code == 200
+    assert "ETag" not in r.headers
+    r = testapp.get(api.index + "/+simple/package/")
+    assert "ETag" in r.headers
+
+
+def test_etag_mirror(pypistage, testapp):
+    pypistage.mock_simple("pkg", '<a href="/pkg-1.0.zip" />')
+    r = testapp.get("/root/pypi/+simple/pkg/")
+    assert r.status_code == 200
+    assert "ETag" not in r.headers
+
+
 @pytest.mark.parametrize("project", ["pkg", "pkg-some"])
 @pytest.mark.parametrize("stagename", [None, "root/pypi"])
 def test_simple_refresh_inherited(mapp, model, pypistage, testapp, project,
@@ -545,9 +670,8 @@ def test_simple_with_removed_base(caplog, mapp, testapp):
     assert len(caplog.getrecords('refers to non-existing')) == 1
     testapp.xget(200, "/user1/dev/+simple/pkg/")
     records = caplog.getrecords('refers to non-existing')
+    # the resolved bases are cached, so the warning isn't repeated
     assert [x.args for x in records] == [
-        ('user1/dev', 'user1/prod'),
-        ('user1/dev', 'user1/prod'),
         ('user1/dev', 'user1/prod')]
 
 
@@ -644,6 +768,173 @@ def test_pkgserv_caching(mapp, testapp):
     assert r.cache_control.private is None
 
 
+def test_pkgserv_range(mapp, testapp):
+    mapp.create_and_use()
+    mapp.upload_file_pypi("pkg1-2.6.tgz", b"123456", "pkg1", "2.6")
+    (path,) = mapp.get_release_paths("pkg1")
+    r = testapp.get(path)
+    assert r.headers["accept-ranges"] == "bytes"
+    r = testapp.get(path, headers={"Range": "bytes=2-"}, status=206)
+    assert r.body == b"3456"
+    assert r.headers["content-range"] == "bytes 2-5/6"
+    assert r.headers["content-length"] == "4"
+    testapp.get(path, headers={"Range": "bytes=10-"}, status=416)
+
+
+def test_pkgserv_multiple_ranges(mapp, monkeypatch, testapp):
+    mapp.create_and_use()
+    mapp.upload_file_pypi("pkg1-2.6.tgz", b"0123456789", "pkg1", "2.6")
+    (path,) = mapp.get_release_paths("pkg1")
+    r = testapp.head(path)
+    assert r.headers["content-length"] == "10"
+    assert r.headers["accept-ranges"] == "bytes"
+    r = testapp.get(path, headers={"Range": "bytes=1-2, 5-, -2"}, status=206)
+    content_type = r.headers["content-type"]
+    assert content_type.startswith("multipart/byteranges; boundary=")
+    boundary = content_type.split("=", 1)[1]
+    assert int(r.headers["content-length"]) == len(r.body)
+    parts = r.body.split(("--%s" % boundary).encode("ascii"))
+    assert parts[0] == b""
+    assert parts[-1] == b"--\r\n"
+    assert [x.split(b"\r\n\r\n", 1)[1] for x in parts[1:-1]] == [
+        b"12\r\n", b"56789\r\n", b"89\r\n"]
+    assert b"Content-Range: bytes 5-9/10" in parts[2]
+    # only one satisfiable range
+    r = testapp.get(path, headers={"Range": "bytes=2-3,20-30"}, status=206)
+    assert r.body == b"23"
+    r = testapp.get(path, headers={"Range": "bytes=20-30,2-3"}, status=206)
+    assert r.body == b"23"
+    assert r.headers["content-range"] == "bytes 2-3/10"
+    testapp.get(path, headers={"Range": "bytes=20-,30-"}, status=416)
+    # a changed file gets the full response
+    r = testapp.get(path, headers={
+        "Range": "bytes=1-2,5-", "If-Range": "Sat, 01 Jan 2000 00:00:00 GMT"})
+    assert r.status_code == 200
+    assert r.body == b"0123456789"
+    # invalid ranges are ignored
+    r = testapp.get(path, headers={"Range": "bytes=3-1,5-"})
+    assert r.status_code == 200
+    assert r.body == b"0123456789"
+    r = testapp.get(path, headers={"Range": "bytes=1-2,garbage"})
+    assert r.status_code == 200
+    assert r.body == b"0123456789"
+    # as are too many ranges
+    monkeypatch.setattr(devpi_server.views, "MAX_BYTE_RANGES", 2)
+    r = testapp.get(path, headers={"Range": "bytes=1-2,4-5,7-8"})
+    assert r.status_code == 200
+    assert r.body == b"0123456789"
+
+
+def test_pkgserv_multiple_ranges_without_last_modified(mapp, monkeypatch, testapp):
+    from devpi_server.filestore import FileEntry
+    mapp.create_and_use()
+    mapp.upload_file_pypi("pkg1-2.6.tgz", b"0123456789", "pkg1", "2.6")
+    (path,) = mapp.get_release_paths("pkg1")
+    gethttpheaders = FileEntry.gethttpheaders
+
+    def gethttpheaders_without_last_modified(self):
+        headers = gethttpheaders(self)
+        del headers["last-modified"]
+        return headers
+
+    monkeypatch.setattr(
+        FileEntry, "gethttpheaders", gethttpheaders_without_last_modified)
+    # without a date to compare to, If-Range gets the full response
+    r = testapp.get(path, headers={
+        "Range": "bytes=1-2,5-", "If-Range": "Sat, 01 Jan 2000 00:00:00 GMT"})
+    assert r.status_code == 200
+    assert r.body == b"0123456789"
+
+
+@pytest.mark.parametrize(("header", "expected"), [
+    ("bytes=0-0", [(0, 1)]),
+    ("bytes=0-", [(0, 10)]),
+    ("bytes=-3", [(7, 10)]),
+    ("bytes=-20", [(0, 10)]),
+    ("bytes=5-20, 1-1", [(5, 10), (1, 2)]),
+    ("bytes=10-", []),
+    ("bytes=-0", []),
+    ("bytes=2-1", None),
+    ("bytes=a-b", None),
+    ("bytes=-", None),
+    ("items=0-1", None)])
+def test_parse_byte_ranges(header, expected):
+    from devpi_server.views import parse_byte_ranges
+    assert parse_byte_ranges(header, 10) == expected
+
+
+def test_pkgserv_file_wrapper(mapp, testapp, xom):
+    mapp.create_and_use()
+    mapp.upload_file_pypi("pkg1-2.6.tgz", b"123456", "pkg1", "2.6")
+    (path,) = mapp.get_release_paths("pkg1")
+    wrapped = []
+
+    def file_wrapper(f, block_size):
+        wrapped.append(f)
+        return iter(lambda: f.read(block_size), b"")
+
+    environ = {"wsgi.file_wrapper": file_wrapper}
+    r = testapp.get(path, extra_environ=environ)
+    assert r.body == b"123456"
+    with xom.keyfs.transaction(write=False) as tx:
+        has_os_path = tx.conn.io_file_os_path("x") is not None
+    if not has_os_path:
+        # storage backends without files don't use the file wrapper
+        assert wrapped == []
+    else:
+        (f,) = wrapped
+        assert f.name.endswith("pkg1-2.6.tgz")
+    # range requests use a seekable iterator
+    r = testapp.get(
+        path, headers={"Range": "bytes=2-"}, extra_environ=environ, status=206)
+    assert r.body == b"3456"
+    assert len(wrapped) <= 1
+
+
+@pytest.mark.parametrize("header", ["x-accel-redirect", "x-sendfile"])
+def test_pkgserv_sendfile_header(makexom, maketestapp, makemapp, header):
+    xom = makexom(["--sendfile-header", header])
+    testapp = maketestapp(xom)
+    mapp = makemapp(testapp)
+    mapp.create_and_use()
+    mapp.upload_file_pypi("pkg1-2.6.tgz", b"123456", "pkg1", "2.6")
+    (path,) = mapp.get_release_paths("pkg1")
+    with xom.keyfs.transaction(write=False):
+        entry = xom.filestore.get_file_entry(path.strip("/"))
+        os_path = entry.file_os_path()
+    r = testapp.get(path)
+    if os_path is None:
+        # files aren't stored in the file system
+        assert r.body == b"123456"
+        return
+    assert r.body == b""
+    assert r.cache_control.max_age == 365000000
+    assert "last-modified" in r.headers
+    if header == "x-sendfile":
+        assert r.headers["X-Sendfile"] == os_path
+    else:
+        uri = r.headers["X-Accel-Redirect"]
+        assert uri.startswith("/+files/")
+        assert xom.config.serverdir.join(unquote(uri)).strpath == os_path
+
+
+@pytest.mark.no_storage_option
+@pytest.mark.storage_with_filesystem
+def test_pkgserv_sendfile_header_with_tiers(makexom, maketestapp, makemapp, tmpdir):
+    xom = makexom([
+        "--sendfile-header", "x-sendfile",
+        "--storage", "sqlite:cold_dir=%s,hot_cache_size=1M" % tmpdir])
+    testapp = maketestapp(xom)
+    mapp = makemapp(testapp)
+    mapp.create_and_use()
+    mapp.upload_file_pypi("pkg1-2.6.tgz", b"123456", "pkg1", "2.6")
+    (path,) = mapp.get_release_paths("pkg1")
+    r = testapp.get(path)
+    # the file is sent by devpi-server, as it could be evicted
+    assert "X-Sendfile" not in r.headers
+    assert r.body == b"123456"
+
+
 def test_pkgserv_remote_failure(httpget, pypistage, testapp):
     pypistage.mock_simple("package", '<a href="/package-1.0.zip" />')
     r = testapp.get("/root/pypi/+simple/package/")